@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import os, sqlite3, datetime, io, socket, csv
+import os, sqlite3, datetime, io, socket, csv, threading, json, shutil, tempfile, time
 import qrcode
 from flask import Flask, g, render_template, request, redirect, url_for, flash, jsonify, send_file, session
+from werkzeug.security import generate_password_hash, check_password_hash
 import functools
+import click
 
+import colunar
+import custo_estoque as custo
+import extrato_bancario as extrato
+import importar_estoque_csv as importador
+import movimentos_estoque as ledger
 
 try:
     import qrcode  # pip install qrcode[pil]
 except Exception:
     qrcode = None
+try:
+    import numpy as np  # pip install numpy (motores de reposição/relatórios)
+except Exception:
+    np = None
 APP_TITLE = "FCAR Reparação Automotiva"
 DEFAULT_DB_PATH = os.path.join(os.path.dirname(__file__), "oficina.db")
 DB_PATH = os.getenv("FCAR_DB_PATH") or os.getenv("DB_PATH") or DEFAULT_DB_PATH
@@ -26,7 +37,7 @@ def get_db():
                 os.makedirs(d, exist_ok=True)
         except Exception:
             pass
-        db = g._db = sqlite3.connect(DB_PATH)
+        db = g._db = sqlite3.connect(DB_PATH, timeout=30)
         db.row_factory = sqlite3.Row
     return db
 
@@ -66,7 +77,8 @@ CREATE TABLE IF NOT EXISTS inventory(
     price REAL NOT NULL DEFAULT 0,
     is_labor INTEGER NOT NULL DEFAULT 0,
     cost_price REAL NOT NULL DEFAULT 0,
-    repasse_value REAL NOT NULL DEFAULT 0
+    repasse_value REAL NOT NULL DEFAULT 0,
+    reserved REAL NOT NULL DEFAULT 0     -- soma de os_stock_reserved (mantida na escrita)
 );
 CREATE TABLE IF NOT EXISTS mechanics(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -102,6 +114,83 @@ CREATE TABLE IF NOT EXISTS order_items(
 );
 
 
+CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_mech_created ON orders(mechanic_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_orders_vehicle ON orders(vehicle_id, id);
+CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id);
+CREATE INDEX IF NOT EXISTS idx_clients_name ON clients(name);
+CREATE INDEX IF NOT EXISTS idx_vehicles_client ON vehicles(client_id, id);
+
+-- totais por dia e mecânico (relatório por mecânico); recalculado por dia a cada escrita de OS
+CREATE TABLE IF NOT EXISTS mechanic_daily_stats(
+    day TEXT NOT NULL,                   -- YYYY-MM-DD (de orders.created_at)
+    mechanic_id INTEGER NOT NULL,
+    os_count INTEGER NOT NULL DEFAULT 0,
+    base_labor REAL NOT NULL DEFAULT 0,  -- orders.labor
+    labor_items REAL NOT NULL DEFAULT 0, -- itens is_labor=1
+    parts REAL NOT NULL DEFAULT 0,       -- itens is_labor=0
+    PRIMARY KEY(day, mechanic_id)
+);
+
+-- log do portal do mecânico (só inclusão; horas saem das sessões inicio -> próximo evento)
+CREATE TABLE IF NOT EXISTS mechanic_activity_log(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mechanic_id INTEGER NOT NULL,
+    os_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,                  -- inicio/fim/obs/peca/servico
+    description TEXT,
+    qty REAL,
+    hours REAL,
+    unit_value REAL,
+    uid TEXT UNIQUE,                     -- id do formulário no tablet (reenvio não duplica)
+    created_at TEXT NOT NULL,            -- YYYY-MM-DD HH:MM:SS
+    FOREIGN KEY(mechanic_id) REFERENCES mechanics(id)
+);
+CREATE INDEX IF NOT EXISTS idx_mech_log_mech_time ON mechanic_activity_log(mechanic_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_mech_log_os ON mechanic_activity_log(os_id, id);
+CREATE TRIGGER IF NOT EXISTS trg_mech_log_no_update BEFORE UPDATE ON mechanic_activity_log
+BEGIN
+    SELECT RAISE(ABORT, 'mechanic_activity_log é somente inclusão');
+END;
+CREATE TRIGGER IF NOT EXISTS trg_mech_log_no_delete BEFORE DELETE ON mechanic_activity_log
+BEGIN
+    SELECT RAISE(ABORT, 'mechanic_activity_log é somente inclusão');
+END;
+
+-- comissão: % por tipo de item (itens com inventory.repasse_value usam o valor fixo)
+CREATE TABLE IF NOT EXISTS commission_rules(
+    item_type TEXT PRIMARY KEY,          -- MAO_DE_OBRA/SERVICO/PECA
+    percent REAL NOT NULL DEFAULT 0
+);
+-- repasse calculado por mês (mês x mecânico x tipo); o mês sai de commission_months quando muda
+CREATE TABLE IF NOT EXISTS commission_cache(
+    month TEXT NOT NULL,                 -- YYYY-MM
+    mechanic_id INTEGER NOT NULL,
+    item_type TEXT NOT NULL,
+    items INTEGER NOT NULL DEFAULT 0,
+    base REAL NOT NULL DEFAULT 0,
+    payout REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY(month, mechanic_id, item_type)
+);
+CREATE TABLE IF NOT EXISTS commission_months(
+    month TEXT PRIMARY KEY,
+    computed_at TEXT NOT NULL
+);
+
+-- recência/frequência/valor por cliente (OS não canceladas); refeito por cliente a cada escrita de OS
+CREATE INDEX IF NOT EXISTS idx_orders_client_created ON orders(client_id, created_at);
+CREATE TABLE IF NOT EXISTS client_stats(
+    client_id INTEGER PRIMARY KEY,
+    first_visit TEXT NOT NULL,           -- YYYY-MM-DD
+    last_visit TEXT NOT NULL,
+    visits INTEGER NOT NULL DEFAULT 0,
+    monetary REAL NOT NULL DEFAULT 0,    -- mão de obra + itens
+    avg_ticket REAL NOT NULL DEFAULT 0,
+    avg_interval_days REAL,              -- média de dias entre visitas (NULL com 1 visita)
+    updated_at TEXT NOT NULL,
+    FOREIGN KEY(client_id) REFERENCES clients(id)
+);
+
 CREATE TABLE IF NOT EXISTS os_stock_applied(
     os_id INTEGER NOT NULL,
     inventory_id INTEGER NOT NULL,
@@ -111,20 +200,72 @@ CREATE TABLE IF NOT EXISTS os_stock_applied(
     FOREIGN KEY(os_id) REFERENCES orders(id),
     FOREIGN KEY(inventory_id) REFERENCES inventory(id)
 );
+-- importação de estoque pelo navegador (o job roda em thread e grava o progresso aqui)
+CREATE TABLE IF NOT EXISTS stock_import_jobs(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT,
+    status TEXT NOT NULL DEFAULT 'NA_FILA',   -- NA_FILA/PROCESSANDO/CONCLUIDO/ERRO
+    bytes_total INTEGER NOT NULL DEFAULT 0,
+    bytes_done INTEGER NOT NULL DEFAULT 0,
+    rows INTEGER NOT NULL DEFAULT 0,
+    inserted INTEGER NOT NULL DEFAULT 0,
+    updated INTEGER NOT NULL DEFAULT 0,
+    unchanged INTEGER NOT NULL DEFAULT 0,
+    skipped INTEGER NOT NULL DEFAULT 0,
+    errors TEXT,                              -- JSON [[linha, mensagem], ...]
+    message TEXT,
+    created_at TEXT NOT NULL,
+    finished_at TEXT
+);
+-- reserva de peças das OS abertas (ainda não baixadas do estoque)
+CREATE TABLE IF NOT EXISTS os_stock_reserved(
+    os_id INTEGER NOT NULL,
+    inventory_id INTEGER NOT NULL,
+    qty REAL NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY(os_id, inventory_id),
+    FOREIGN KEY(os_id) REFERENCES orders(id),
+    FOREIGN KEY(inventory_id) REFERENCES inventory(id)
+);
+CREATE INDEX IF NOT EXISTS idx_os_stock_reserved_inv ON os_stock_reserved(inventory_id);
 CREATE TABLE IF NOT EXISTS agenda(
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     client_id INTEGER NOT NULL,
     vehicle_id INTEGER,
     mechanic_id INTEGER,
     date TEXT NOT NULL,
-    time TEXT NOT NULL,
+    time TEXT NOT NULL,                  -- HH:MM
     notes TEXT,
     created_at TEXT NOT NULL,
     whatsapp_sent INTEGER NOT NULL DEFAULT 0,
+    duration_min INTEGER NOT NULL DEFAULT 60,
     FOREIGN KEY(client_id) REFERENCES clients(id),
     FOREIGN KEY(vehicle_id) REFERENCES vehicles(id),
     FOREIGN KEY(mechanic_id) REFERENCES mechanics(id)
 );
+-- conflito de horário do mecânico no dia / grade da semana
+CREATE INDEX IF NOT EXISTS idx_agenda_mech_date ON agenda(mechanic_id, date, time);
+CREATE INDEX IF NOT EXISTS idx_agenda_date ON agenda(date, time);
+
+-- serviços recorrentes por veículo (intervalo estimado pelo histórico de order_items) -> revisões previstas
+CREATE TABLE IF NOT EXISTS service_due(
+    vehicle_id INTEGER NOT NULL,
+    item_key TEXT NOT NULL,              -- 'I<inventory_id>' ou 'D<DESCRIÇÃO>'
+    item TEXT NOT NULL,
+    occurrences INTEGER NOT NULL,        -- dias distintos em que foi feito
+    last_date TEXT NOT NULL,             -- YYYY-MM-DD
+    last_os_id INTEGER,
+    interval_days INTEGER NOT NULL,      -- mediana dos intervalos
+    due_date TEXT NOT NULL,
+    agenda_id INTEGER,                   -- agendamento criado para esta previsão (zera quando o serviço é refeito)
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY(vehicle_id, item_key)
+);
+CREATE INDEX IF NOT EXISTS idx_service_due_due ON service_due(due_date);
+-- veículos com OS alteradas desde o último cálculo (refresh incremental)
+CREATE TABLE IF NOT EXISTS service_due_dirty(
+    vehicle_id INTEGER PRIMARY KEY
+);
 
 -- =========================
 -- Financeiro (PRO)
@@ -172,6 +313,101 @@ CREATE TABLE IF NOT EXISTS fin_transaction_items(
     FOREIGN KEY(tx_id) REFERENCES fin_transactions(id),
     FOREIGN KEY(inventory_id) REFERENCES inventory(id)
 );
+CREATE INDEX IF NOT EXISTS idx_fin_tx_date ON fin_transactions(date, id);
+CREATE INDEX IF NOT EXISTS idx_fin_tx_ref ON fin_transactions(ref_type, ref_id);
+CREATE INDEX IF NOT EXISTS idx_fin_tx_dash ON fin_transactions(date, status, ttype, payment_method_id, amount);
+CREATE INDEX IF NOT EXISTS idx_fin_tx_due ON fin_transactions(status, due_date, ttype, amount);
+-- conciliação: casa por (status, tipo, valor em centavos, vencimento) numa busca de igualdade + faixa
+CREATE INDEX IF NOT EXISTS idx_fin_tx_match ON fin_transactions(status, ttype, CAST(ROUND(amount * 100) AS INTEGER), COALESCE(due_date, date));
+
+-- extratos importados (banco / maquininha) e suas linhas para conciliação
+CREATE TABLE IF NOT EXISTS fin_statements(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT,
+    source TEXT NOT NULL,                -- CSV/OFX
+    payment_method_id INTEGER,           -- se informado, só casa com lançamentos dessa forma
+    window_days INTEGER NOT NULL DEFAULT 3,
+    lines INTEGER NOT NULL DEFAULT 0,
+    duplicates INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    FOREIGN KEY(payment_method_id) REFERENCES fin_payment_methods(id)
+);
+CREATE TABLE IF NOT EXISTS fin_statement_lines(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    statement_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    ttype TEXT NOT NULL,                 -- IN/OUT
+    amount_cents INTEGER NOT NULL,
+    description TEXT,
+    fitid TEXT,
+    line_hash TEXT NOT NULL UNIQUE,      -- reimportar o mesmo extrato não duplica linhas
+    status TEXT NOT NULL DEFAULT 'ABERTO', -- ABERTO/SUGERIDO/CONCILIADO
+    tx_id INTEGER,
+    match_days INTEGER,
+    FOREIGN KEY(statement_id) REFERENCES fin_statements(id),
+    FOREIGN KEY(tx_id) REFERENCES fin_transactions(id)
+);
+CREATE INDEX IF NOT EXISTS idx_fin_stmt_lines_stmt ON fin_statement_lines(statement_id, status, id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_fin_stmt_lines_tx ON fin_statement_lines(tx_id) WHERE tx_id IS NOT NULL;
+
+-- resumo mensal (mês x tipo x status x forma x categoria) mantido por trigger em toda escrita;
+-- forma/categoria sem valor ficam como 0 para a chave primária funcionar
+CREATE TABLE IF NOT EXISTS fin_monthly_summary(
+    month TEXT NOT NULL,                 -- YYYY-MM
+    ttype TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payment_method_id INTEGER NOT NULL DEFAULT 0,
+    category_id INTEGER NOT NULL DEFAULT 0,
+    total REAL NOT NULL DEFAULT 0,
+    cnt INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(month, ttype, status, payment_method_id, category_id)
+);
+CREATE TRIGGER IF NOT EXISTS trg_fin_summary_ins AFTER INSERT ON fin_transactions
+BEGIN
+    INSERT INTO fin_monthly_summary(month, ttype, status, payment_method_id, category_id, total, cnt)
+    VALUES (substr(NEW.date, 1, 7), NEW.ttype, NEW.status, COALESCE(NEW.payment_method_id, 0), COALESCE(NEW.category_id, 0), NEW.amount, 1)
+    ON CONFLICT(month, ttype, status, payment_method_id, category_id)
+    DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_fin_summary_del AFTER DELETE ON fin_transactions
+BEGIN
+    UPDATE fin_monthly_summary SET total = total - OLD.amount, cnt = cnt - 1
+     WHERE month = substr(OLD.date, 1, 7) AND ttype = OLD.ttype AND status = OLD.status
+       AND payment_method_id = COALESCE(OLD.payment_method_id, 0) AND category_id = COALESCE(OLD.category_id, 0);
+    DELETE FROM fin_monthly_summary
+     WHERE month = substr(OLD.date, 1, 7) AND ttype = OLD.ttype AND status = OLD.status
+       AND payment_method_id = COALESCE(OLD.payment_method_id, 0) AND category_id = COALESCE(OLD.category_id, 0)
+       AND cnt <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_fin_summary_upd
+AFTER UPDATE OF date, ttype, status, payment_method_id, category_id, amount ON fin_transactions
+BEGIN
+    UPDATE fin_monthly_summary SET total = total - OLD.amount, cnt = cnt - 1
+     WHERE month = substr(OLD.date, 1, 7) AND ttype = OLD.ttype AND status = OLD.status
+       AND payment_method_id = COALESCE(OLD.payment_method_id, 0) AND category_id = COALESCE(OLD.category_id, 0);
+    INSERT INTO fin_monthly_summary(month, ttype, status, payment_method_id, category_id, total, cnt)
+    VALUES (substr(NEW.date, 1, 7), NEW.ttype, NEW.status, COALESCE(NEW.payment_method_id, 0), COALESCE(NEW.category_id, 0), NEW.amount, 1)
+    ON CONFLICT(month, ttype, status, payment_method_id, category_id)
+    DO UPDATE SET total = total + excluded.total, cnt = cnt + 1;
+    DELETE FROM fin_monthly_summary
+     WHERE month = substr(OLD.date, 1, 7) AND ttype = OLD.ttype AND status = OLD.status
+       AND payment_method_id = COALESCE(OLD.payment_method_id, 0) AND category_id = COALESCE(OLD.category_id, 0)
+       AND cnt <= 0;
+END;
+CREATE INDEX IF NOT EXISTS idx_fin_tx_items_tx ON fin_transaction_items(tx_id, flow);
+
+-- Outbox: eventos "OS alterada" gravados na mesma transação da OS.
+-- Um worker em segundo plano materializa o financeiro (agrupando edições da mesma OS).
+CREATE TABLE IF NOT EXISTS fin_outbox(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    os_id INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    processed_at TEXT,                   -- NULL = pendente
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try_at TEXT,                    -- backoff após falha
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_fin_outbox_pending ON fin_outbox(processed_at, os_id);
 
 -- =========================
 -- Compras de estoque
@@ -226,6 +462,8 @@ def seed_mechanics(db):
 
 def init_db():
     db = get_db()
+    # WAL: leituras não esperam escrita e os INSERTs curtos dos tablets não se bloqueiam
+    db.execute("PRAGMA journal_mode=WAL")
     db.executescript(SCHEMA_SQL)
     db.commit()
 
@@ -237,6 +475,18 @@ def init_db():
         db.execute("ALTER TABLE inventory ADD COLUMN cost_price REAL NOT NULL DEFAULT 0")
     if "repasse_value" not in cols:
         db.execute("ALTER TABLE inventory ADD COLUMN repasse_value REAL NOT NULL DEFAULT 0")
+    new_reserved = "reserved" not in cols
+    if new_reserved:
+        db.execute("ALTER TABLE inventory ADD COLUMN reserved REAL NOT NULL DEFAULT 0")
+
+    # PIN do portal do mecânico
+    mcols = [r["name"] for r in db.execute("PRAGMA table_info(mechanics)").fetchall()]
+    if "pin" not in mcols:
+        db.execute("ALTER TABLE mechanics ADD COLUMN pin TEXT")
+    # o PIN fica com hash (o login escolhe o mecânico, então não precisa ser único)
+    db.execute("DROP INDEX IF EXISTS idx_mechanics_pin")
+    for r in db.execute("SELECT id, pin FROM mechanics WHERE pin IS NOT NULL AND pin NOT LIKE '%:%'").fetchall():
+        db.execute("UPDATE mechanics SET pin=? WHERE id=?", (generate_password_hash(r["pin"]), r["id"]))
 
     # garante colunas novas na OS (pagamento/financeiro)
     ocols = [r["name"] for r in db.execute("PRAGMA table_info(orders)").fetchall()]
@@ -254,6 +504,17 @@ def init_db():
         db.execute("ALTER TABLE order_items ADD COLUMN is_labor INTEGER NOT NULL DEFAULT 0")
     db.commit()
 
+    # duração dos agendamentos (checagem de conflito e capacidade dos mecânicos)
+    acols = [r["name"] for r in db.execute("PRAGMA table_info(agenda)").fetchall()]
+    if "duration_min" not in acols:
+        db.execute(f"ALTER TABLE agenda ADD COLUMN duration_min INTEGER NOT NULL DEFAULT {AGENDA_DURACAO_PADRAO}")
+        db.commit()
+
+    # reservas: na 1ª vez monta a partir das OS abertas
+    if new_reserved:
+        rebuild_os_reservations(db)
+        db.commit()
+
     # seeds do financeiro (métodos e categorias)
     try:
         if db.execute("SELECT COUNT(*) c FROM fin_payment_methods").fetchone()["c"] == 0:
@@ -282,8 +543,40 @@ def init_db():
         seed_inventory(db)
     if db.execute("SELECT COUNT(*) c FROM mechanics").fetchone()["c"] == 0:
         seed_mechanics(db)
+    db.executemany(
+        "INSERT OR IGNORE INTO commission_rules(item_type, percent) VALUES (?,?)",
+        list(COMMISSION_DEFAULTS.items()),
+    )
+    db.commit()
+
+    # resumo mensal do financeiro: na 1ª vez monta a partir dos lançamentos existentes
+    if db.execute("SELECT 1 FROM fin_monthly_summary LIMIT 1").fetchone() is None:
+        rebuild_fin_monthly_summary(db)
+        db.commit()
+
+    # estatística diária por mecânico: na 1ª vez monta a partir das OS existentes
+    if db.execute("SELECT 1 FROM mechanic_daily_stats LIMIT 1").fetchone() is None:
+        refresh_mechanic_daily_stats(db)
+        db.commit()
+
+    # RFM por cliente: na 1ª vez monta a partir das OS existentes
+    if db.execute("SELECT 1 FROM client_stats LIMIT 1").fetchone() is None:
+        refresh_client_stats(db)
+        db.commit()
+
+    # revisões previstas: na 1ª vez calcula a frota toda (depois só os veículos marcados)
+    if np is not None and db.execute("SELECT 1 FROM service_due LIMIT 1").fetchone() is None:
+        refresh_service_due(db)
+        db.commit()
+
+    # livro de movimentos de estoque (na 1ª vez lança o saldo de abertura) + checkpoint
+    ledger.ensure_schema(db)
+    ledger.take_checkpoints(db)
     db.commit()
 
+    # log de mudanças do cache colunar dos relatórios (triggers nas tabelas de colunar.TABLES)
+    colunar.ensure_schema(db)
+
 
 
 def _csv_response(filename: str, header: list[str], rows: list[tuple]):
@@ -446,6 +739,9 @@ def cliente_edit(cid):
     return render_template("cliente_edit.html", c=c, title="Editar Cliente")
 
 
+VEICULOS_OS_LIMITE = 200  # OS mais recentes no painel do cliente (o resto fica no histórico por veículo)
+
+
 @login_required
 @app.route("/veiculos/<int:client_id>", methods=["GET","POST"])
 def veiculos(client_id):
@@ -470,10 +766,13 @@ def veiculos(client_id):
         LEFT JOIN mechanics m ON m.id=o.mechanic_id
         WHERE o.client_id = ?
         ORDER BY o.id DESC
+        LIMIT ?
         """,
-        (client_id,)
+        (client_id, VEICULOS_OS_LIMITE)
     ).fetchall()
-    return render_template("veiculos.html", c=c, vs=vs, os_rows=os_rows, title="Veículos")
+    os_total = db.execute("SELECT COUNT(*) FROM orders WHERE client_id = ?", (client_id,)).fetchone()[0]
+    return render_template("veiculos.html", c=c, vs=vs, os_rows=os_rows, os_total=os_total,
+                           os_limite=VEICULOS_OS_LIMITE, title="Veículos")
 
 @login_required
 @app.route("/veiculos/<int:client_id>/<int:vehicle_id>/delete", methods=["POST"])
@@ -484,6 +783,7 @@ def veiculo_delete(client_id, vehicle_id):
     db = get_db()
     # remove vínculo do veículo nas OS
     db.execute("UPDATE orders SET vehicle_id = NULL WHERE vehicle_id = ?", (vehicle_id,))
+    mark_service_due(db, [vehicle_id])
     # remove o veículo do cliente
     db.execute("DELETE FROM vehicles WHERE id = ? AND client_id = ?", (vehicle_id, client_id))
     db.commit()
@@ -532,26 +832,120 @@ def veiculo_transferir(client_id, vehicle_id):
         "UPDATE orders SET client_id = ? WHERE vehicle_id = ? AND client_id = ?",
         (new_client_id, vehicle_id, client_id),
     )
+    refresh_client_stats(db, [client_id, new_client_id])
 
     db.commit()
     flash("Veículo transferido para outro cliente.", "ok")
     return redirect(url_for("veiculos", client_id=new_client_id))
 
 
+VEICULO_HISTORICO_PAGINA = 30
+
+
+@app.route("/veiculos/<int:client_id>/<int:vehicle_id>/historico")
+@login_required
+def veiculo_historico(client_id, vehicle_id):
+    """Linha do tempo do veículo em duas consultas pelo idx_orders_vehicle (+ idx_order_items_order):
+    1) página de OS por id (keyset, ?antes=<id>), custo fixo seja qual for o tamanho do histórico;
+    2) só na 1ª página: totais do veículo + resumo de peças/serviços (última vez que cada um foi feito)."""
+    db = get_db()
+    v = db.execute(
+        "SELECT * FROM vehicles WHERE id = ? AND client_id = ?", (vehicle_id, client_id)
+    ).fetchone()
+    if not v:
+        flash("Veículo não encontrado para este cliente.", "error")
+        return redirect(url_for("veiculos", client_id=client_id))
+    antes = request.args.get("antes", type=int)
+
+    os_rows = db.execute(
+        """
+        SELECT o.id, o.created_at, o.status, m.name AS mech, COALESCE(o.labor, 0) AS labor, it.itens,
+               COALESCE(o.labor, 0) + it.itens AS total
+          FROM orders o
+          JOIN (SELECT x.id, (SELECT COALESCE(SUM(oi.total), 0) FROM order_items oi WHERE oi.order_id = x.id) AS itens
+                  FROM orders x
+                 WHERE x.vehicle_id = ? AND x.id < ?
+                 ORDER BY x.id DESC
+                 LIMIT ?) it ON it.id = o.id
+          LEFT JOIN mechanics m ON m.id = o.mechanic_id
+         ORDER BY o.id DESC
+        """,
+        (vehicle_id, antes or 2**62, VEICULO_HISTORICO_PAGINA + 1),
+    ).fetchall()
+    proximo = os_rows[VEICULO_HISTORICO_PAGINA - 1]["id"] if len(os_rows) > VEICULO_HISTORICO_PAGINA else None
+    os_rows = os_rows[:VEICULO_HISTORICO_PAGINA]
+
+    totals, resumo = None, []
+    if not antes:
+        # o que foi feito e quando: item do estoque ou descrição livre; com MAX(), as colunas soltas
+        # (os_id) vêm da mesma linha da última vez (comportamento documentado do SQLite).
+        # Os totais do veículo vêm juntos (mesmos valores em toda linha; uma linha só se não há itens).
+        rows = db.execute(
+            """
+            WITH os AS (
+                SELECT id, created_at, COALESCE(labor, 0) AS labor
+                  FROM orders WHERE vehicle_id = ? AND status <> 'Cancelada'
+            ),
+            itens AS (
+                SELECT COALESCE(inv.name, oi.description) AS item, oi.is_labor,
+                       COUNT(*) AS vezes, SUM(COALESCE(oi.qty, 1)) AS qtd, SUM(COALESCE(oi.total, 0)) AS total,
+                       MAX(os.created_at) AS ultima, os.id AS os_id
+                  FROM os
+                  JOIN order_items oi ON oi.order_id = os.id
+                  LEFT JOIN inventory inv ON inv.id = oi.inventory_id
+                 GROUP BY COALESCE('I' || oi.inventory_id, 'D' || UPPER(TRIM(oi.description)))
+            )
+            SELECT t.*, itens.*
+              FROM (SELECT COUNT(*) AS qtd_os, COALESCE(SUM(labor), 0) AS mao_obra,
+                           MIN(created_at) AS primeira, MAX(created_at) AS ultima_os FROM os) t
+              LEFT JOIN itens ON 1
+             ORDER BY itens.ultima DESC
+            """,
+            (vehicle_id,),
+        ).fetchall()
+        resumo = [r for r in rows if r["item"] is not None]
+        totals = {
+            "qtd_os": rows[0]["qtd_os"],
+            "total_geral": float(rows[0]["mao_obra"]) + sum(float(r["total"]) for r in resumo),
+            "primeira": rows[0]["primeira"],
+            "ultima": rows[0]["ultima_os"],
+        }
+
+    if request.args.get("format") == "json":
+        return jsonify({
+            "vehicle": dict(v),
+            "totals": totals,
+            "os": [dict(r) for r in os_rows],
+            "next": proximo,
+            "items": [{k: r[k] for k in ("item", "is_labor", "vezes", "qtd", "total", "ultima", "os_id")} for r in resumo],
+        })
+    c = db.execute("SELECT * FROM clients WHERE id=?", (client_id,)).fetchone()
+    return render_template(
+        "veiculo_historico.html", c=c, v=v, totals=totals, os_rows=os_rows, resumo=resumo,
+        antes=antes, proximo=proximo, title=f"Histórico {v['plate'] or ''}",
+    )
+
+
+def _search_page_args(default: int = 20, maximo: int = 50) -> tuple[int, int]:
+    """limit/offset dos endpoints de autocomplete (uma página por chamada; "mais" pede o offset seguinte)."""
+    limit = request.args.get("limit", default, type=int)
+    offset = request.args.get("offset", 0, type=int)
+    return max(1, min(limit, maximo)), max(0, offset)
+
+
 @app.route("/api/clients_search")
+@login_required
 def api_clients_search():
     """Endpoint de autocomplete de clientes para Nova OS e outras telas."""
     db = get_db()
     q = (request.args.get("q") or "").strip()
-    try:
-        limit = int(request.args.get("limit") or 20)
-    except ValueError:
-        limit = 20
+    limit, offset = _search_page_args()
 
+    # ORDER BY name percorre idx_clients_name e para no LIMIT (não ordena a tabela toda)
     if not q:
         rows = db.execute(
-            "SELECT id, name, phone, cpf FROM clients ORDER BY name LIMIT ?",
-            (limit,)
+            "SELECT id, name, phone, cpf FROM clients ORDER BY name LIMIT ? OFFSET ?",
+            (limit, offset)
         ).fetchall()
     else:
         like = f"%{q}%"
@@ -561,9 +955,9 @@ def api_clients_search():
             FROM clients
             WHERE name LIKE ? OR phone LIKE ? OR cpf LIKE ?
             ORDER BY name
-            LIMIT ?
+            LIMIT ? OFFSET ?
             """,
-            (like, like, like, limit),
+            (like, like, like, limit, offset),
         ).fetchall()
 
     data = []
@@ -586,6 +980,42 @@ def api_clients_search():
     return jsonify(data)
 
 
+@app.route("/api/vehicles_search")
+@login_required
+def api_vehicles_search():
+    """Autocomplete de veículos (de um cliente, com client_id, ou de todos), paginado como o de clientes."""
+    db = get_db()
+    q = (request.args.get("q") or "").strip()
+    client_id = request.args.get("client_id", type=int)
+    limit, offset = _search_page_args()
+
+    where, params = [], []
+    if client_id:
+        where.append("v.client_id = ?")
+        params.append(client_id)
+    if q:
+        like = f"%{q}%"
+        where.append("(v.plate LIKE ? OR v.model LIKE ?)")
+        params += [like, like]
+    rows = db.execute(
+        f"""
+        SELECT v.id, v.client_id, v.plate, v.model, v.year, c.name AS client_name
+        FROM vehicles v
+        JOIN clients c ON c.id = v.client_id
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY v.id DESC
+        LIMIT ? OFFSET ?
+        """,
+        (*params, limit, offset),
+    ).fetchall()
+
+    data = []
+    for r in rows:
+        label = " - ".join(p for p in (r["plate"], r["model"]) if p) or f"Veículo #{r['id']}"
+        data.append(dict(r, label=label))
+    return jsonify(data)
+
+
 
 @login_required
 @app.route("/estoque", methods=["GET","POST"])
@@ -604,11 +1034,12 @@ def estoque():
         if not name:
             flash("Nome é obrigatório.", "error")
         else:
-            db.execute(
+            cur = db.execute(
                 """INSERT INTO inventory(name, sku, stock, min_stock, price, is_labor, cost_price, repasse_value)
                    VALUES (?,?,?,?,?,?,?,?)""",
-                (name, sku, stock, min_stock, price, is_labor, cost_price, repasse_value),
+                (name, sku, 0, min_stock, price, is_labor, cost_price, repasse_value),
             )
+            ledger.record_movement(db, cur.lastrowid, stock, ledger.CADASTRO)
             db.commit()
             flash("Item adicionado ao estoque!", "ok")
         return redirect(url_for("estoque"))
@@ -654,10 +1085,14 @@ def estoque_editar(item_id):
 
         db.execute(
             """UPDATE inventory
-               SET name = ?, sku = ?, stock = ?, min_stock = ?, price = ?, is_labor = ?, cost_price = ?, repasse_value = ?
+               SET name = ?, sku = ?, min_stock = ?, price = ?, is_labor = ?, cost_price = ?, repasse_value = ?
                WHERE id = ?""",
-            (name, sku, stock, min_stock, price, is_labor, cost_price, repasse_value, item_id),
+            (name, sku, min_stock, price, is_labor, cost_price, repasse_value, item_id),
         )
+        # estoque editado à mão vira um AJUSTE no livro (delta em relação ao saldo atual)
+        ledger.set_stock(db, item_id, stock, ledger.AJUSTE)
+        if float(item["repasse_value"] or 0) != repasse_value or int(item["is_labor"] or 0) != is_labor:
+            invalidate_commissions(db)  # muda o repasse de todas as OS que usam o item
         db.commit()
         flash("Item atualizado!", "ok")
         return redirect(url_for("estoque"))
@@ -665,6 +1100,318 @@ def estoque_editar(item_id):
     return render_template("estoque_editar.html", item=item, title="Editar item de estoque")
 
 
+@app.route("/estoque/<int:item_id>/movimentos")
+@login_required
+def estoque_movimentos(item_id):
+    """Histórico do item direto do livro de movimentos (índice por item), com saldo corrido."""
+    db = get_db()
+    item = db.execute("SELECT id, name, sku, stock FROM inventory WHERE id = ?", (item_id,)).fetchone()
+    if not item:
+        flash("Item não encontrado.", "error")
+        return redirect(url_for("estoque"))
+
+    per_page = 100
+    # cursor (created_at, id) na ordem do idx_stock_mov_item(inventory_id, created_at, id)
+    before = (request.args.get("before") or "").strip()
+    try:
+        b_at, b_id = before.split("|")
+        cur = (b_at, int(b_id))
+    except ValueError:
+        before, cur = "", ("9999", 0)
+
+    # saldo depois do movimento = saldo atual - soma dos movimentos mais novos
+    newer = 0.0
+    if before:
+        newer = float(db.execute(
+            "SELECT COALESCE(SUM(qty_delta), 0) s FROM stock_movements WHERE inventory_id = ? AND (created_at, id) >= (?, ?)",
+            (item_id, *cur),
+        ).fetchone()["s"])
+    rows = db.execute(
+        """
+        SELECT p.*,
+               ? - COALESCE(SUM(p.qty_delta) OVER (
+                   ORDER BY p.created_at DESC, p.id DESC ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS balance_after
+          FROM (SELECT * FROM stock_movements
+                 WHERE inventory_id = ? AND (created_at, id) < (?, ?)
+                 ORDER BY created_at DESC, id DESC LIMIT ?) p
+         ORDER BY p.created_at DESC, p.id DESC
+        """,
+        (float(item["stock"] or 0) - newer, item_id, *cur, per_page + 1),
+    ).fetchall()
+    next_before = None
+    if len(rows) > per_page:
+        last = rows[per_page - 1]
+        next_before = f"{last['created_at']}|{last['id']}"
+    rows = rows[:per_page]
+
+    saldo_em = None
+    em = (request.args.get("em") or "").strip()
+    if em:
+        saldo_em = ledger.stock_at(db, item_id, _parse_date(em, _today_iso()) + "T23:59:59")
+
+    return render_template(
+        "estoque_movimentos.html",
+        item=item,
+        rows=rows,
+        next_before=next_before,
+        em=em,
+        saldo_em=saldo_em,
+        title=f"Movimentos - {item['name']}",
+    )
+
+
+# --------------------------
+# Reposição (velocidade de consumo)
+# --------------------------
+REORDER_WINDOWS = (7, 30, 90)
+REORDER_WEIGHTS = (0.5, 0.3, 0.2)  # peso de cada janela na taxa diária combinada
+
+
+def reorder_suggestions(db, lead_days: float = 7, cover_days: float = 30, today: datetime.date | None = None) -> list[dict]:
+    """Sugestões de compra para o catálogo inteiro.
+
+    Consumo por peça vem de uma única agregação em order_items (janelas de 7/30/90 dias,
+    OS não canceladas); a conta (taxa diária, cobertura e quantidade sugerida) é feita
+    vetorizada com numpy sobre todos os itens de uma vez.
+    - taxa = média ponderada das taxas 7/30/90 dias
+    - ponto de pedido = taxa * prazo de entrega + estoque mínimo
+    - sugestão = alvo (taxa * (prazo + cobertura) + mínimo) - disponível, arredondado pra cima
+    (disponível = estoque - reservado pelas OS abertas)
+    """
+    if np is None:
+        raise RuntimeError("numpy não está instalado (pip install numpy).")
+    today = today or datetime.date.today()
+    w7, w30, w90 = REORDER_WINDOWS
+    since = {w: (today - datetime.timedelta(days=w - 1)).strftime("%Y-%m-%d 00:00:00") for w in REORDER_WINDOWS}
+
+    cons = db.execute(
+        """
+        SELECT oi.inventory_id,
+               SUM(CASE WHEN o.created_at >= ? THEN oi.qty ELSE 0 END) AS q7,
+               SUM(CASE WHEN o.created_at >= ? THEN oi.qty ELSE 0 END) AS q30,
+               SUM(oi.qty) AS q90
+          FROM orders o
+          JOIN order_items oi ON oi.order_id = o.id
+         WHERE o.created_at >= ?
+           AND oi.inventory_id IS NOT NULL
+           AND oi.is_labor = 0
+           AND LOWER(COALESCE(o.status, '')) NOT IN ('cancelada', 'cancelado')
+         GROUP BY oi.inventory_id
+        """,
+        (since[w7], since[w30], since[w90]),
+    ).fetchall()
+    inv = db.execute(
+        "SELECT id, name, sku, stock, reserved, min_stock, cost_price FROM inventory WHERE is_labor = 0 ORDER BY id"
+    ).fetchall()
+    if not inv:
+        return []
+
+    ids = np.fromiter((r["id"] for r in inv), dtype=np.int64, count=len(inv))
+    stock = np.fromiter((float(r["stock"] or 0) for r in inv), dtype=np.float64, count=len(inv))
+    reserved = np.fromiter((float(r["reserved"] or 0) for r in inv), dtype=np.float64, count=len(inv))
+    available = stock - reserved
+    min_stock = np.fromiter((float(r["min_stock"] or 0) for r in inv), dtype=np.float64, count=len(inv))
+
+    qty = np.zeros((len(inv), 3), dtype=np.float64)
+    if cons:
+        c_ids = np.fromiter((r["inventory_id"] for r in cons), dtype=np.int64, count=len(cons))
+        c_q = np.array([(float(r["q7"] or 0), float(r["q30"] or 0), float(r["q90"] or 0)) for r in cons], dtype=np.float64)
+        pos = np.searchsorted(ids, c_ids)
+        ok = (pos < len(ids)) & (ids[np.minimum(pos, len(ids) - 1)] == c_ids)
+        qty[pos[ok]] = c_q[ok]
+
+    rates = qty / np.array(REORDER_WINDOWS, dtype=np.float64)
+    rate = rates @ np.array(REORDER_WEIGHTS, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        days_cover = np.where(rate > 0, np.maximum(available, 0) / rate, np.inf)
+    reorder_point = rate * float(lead_days) + min_stock
+    target = rate * (float(lead_days) + float(cover_days)) + min_stock
+    need = (available <= reorder_point) & (target > 0)
+    suggest = np.where(need, np.ceil(np.maximum(target - available, 0) - 1e-9), 0)
+
+    idx = np.flatnonzero(suggest > 0)
+    idx = idx[np.lexsort((-rate[idx], days_cover[idx]))]  # menos cobertura primeiro
+    out = []
+    for i in idx.tolist():
+        r = inv[i]
+        out.append({
+            "inventory_id": int(ids[i]),
+            "name": r["name"],
+            "sku": r["sku"],
+            "stock": float(stock[i]),
+            "reserved": float(reserved[i]),
+            "available": float(available[i]),
+            "min_stock": float(min_stock[i]),
+            "q7": float(qty[i, 0]),
+            "q30": float(qty[i, 1]),
+            "q90": float(qty[i, 2]),
+            "rate": float(rate[i]),
+            "days_cover": None if not np.isfinite(days_cover[i]) else float(days_cover[i]),
+            "suggested_qty": float(suggest[i]),
+            "unit_cost": float(r["cost_price"] or 0),
+        })
+    return out
+
+
+def _reorder_params():
+    try:
+        lead = max(0.0, float(request.args.get("lead") or 7))
+    except ValueError:
+        lead = 7.0
+    try:
+        cover = max(0.0, float(request.args.get("cover") or 30))
+    except ValueError:
+        cover = 30.0
+    return lead, cover
+
+
+@app.route("/estoque/reposicao")
+@login_required
+def estoque_reposicao():
+    db = get_db()
+    lead, cover = _reorder_params()
+    try:
+        rows = reorder_suggestions(db, lead, cover)
+    except RuntimeError as e:
+        flash(str(e), "error")
+        rows = []
+    if request.args.get("format") == "json":
+        return jsonify(rows)
+    return render_template(
+        "estoque_reposicao.html",
+        rows=rows,
+        lead=lead,
+        cover=cover,
+        total_cost=sum(r["suggested_qty"] * r["unit_cost"] for r in rows),
+        title="Reposição de estoque",
+    )
+
+
+@app.cli.command("estoque-checkpoint")
+def _cli_estoque_checkpoint():
+    """Grava checkpoints de saldo (agendar diariamente mantém curto o replay por data)."""
+    db = get_db()
+    n = ledger.take_checkpoints(db)
+    db.commit()
+    print(f"Checkpoints gravados: {n}")
+
+
+# --- importação de estoque pelo navegador ---
+# O upload vai para um arquivo temporário em blocos (nunca o arquivo inteiro na memória);
+# uma thread lê o CSV linha a linha com o mesmo parser do importar_estoque_csv.py
+# (mesmos nomes de coluna, lotes com executemany) e grava o progresso em stock_import_jobs
+# a cada lote, com commit por lote, então qualquer worker do gunicorn consegue mostrar o status.
+
+STOCK_IMPORT_CHUNK = 500
+STOCK_IMPORT_MAX_ERRORS = 200
+
+
+def _run_stock_import(job_id: int, path: str) -> None:
+    con = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        con.execute("UPDATE stock_import_jobs SET status='PROCESSANDO' WHERE id=?", (job_id,))
+        con.commit()
+        with open(path, "rb") as fb:
+            sample = fb.read(2048).decode("utf-8-sig", errors="ignore")
+            fb.seek(0)
+            f = io.TextIOWrapper(fb, encoding="utf-8-sig", errors="ignore", newline="")
+            reader = csv.DictReader(f, delimiter=importador.detect_delimiter(sample))
+            if not reader.fieldnames:
+                raise ValueError("CSV sem cabeçalho. Use o estoque_modelo.csv como base.")
+
+            def progress(st):
+                # commit do lote + progresso na mesma transação
+                con.execute(
+                    """UPDATE stock_import_jobs
+                          SET bytes_done=?, rows=?, inserted=?, updated=?, unchanged=?, skipped=?, errors=?
+                        WHERE id=?""",
+                    (fb.tell(), st["rows"], st["inserted"], st["updated"], st["unchanged"], st["skipped"],
+                     json.dumps(st["errors"][:STOCK_IMPORT_MAX_ERRORS]), job_id),
+                )
+                con.commit()
+
+            importador.import_rows(con, reader, chunk_size=STOCK_IMPORT_CHUNK, progress=progress)
+        con.execute(
+            "UPDATE stock_import_jobs SET status='CONCLUIDO', bytes_done=bytes_total, finished_at=? WHERE id=?",
+            (_now_iso(), job_id),
+        )
+        con.commit()
+    except Exception as e:
+        con.rollback()
+        con.execute(
+            "UPDATE stock_import_jobs SET status='ERRO', message=?, finished_at=? WHERE id=?",
+            (str(e)[:500], _now_iso(), job_id),
+        )
+        con.commit()
+    finally:
+        con.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@app.route("/estoque/importar", methods=["GET","POST"])
+@login_required
+def estoque_importar():
+    db = get_db()
+    if request.method == "POST":
+        fd, path = tempfile.mkstemp(prefix="fcar_estoque_", suffix=".csv")
+        with os.fdopen(fd, "wb") as out:
+            up = request.files.get("arquivo")
+            if up is not None:
+                filename = up.filename or "estoque.csv"
+                shutil.copyfileobj(up.stream, out, 64 * 1024)
+            else:
+                # corpo cru (ex.: curl --data-binary @estoque.csv -H "Content-Type: text/csv")
+                filename = request.args.get("nome") or "estoque.csv"
+                shutil.copyfileobj(request.stream, out, 64 * 1024)
+        size = os.path.getsize(path)
+        if size == 0:
+            os.remove(path)
+            flash("Selecione um arquivo CSV.", "error")
+            return redirect(url_for("estoque_importar"))
+
+        cur = db.execute(
+            "INSERT INTO stock_import_jobs(filename, bytes_total, created_at) VALUES (?,?,?)",
+            (filename, size, _now_iso()),
+        )
+        job_id = int(cur.lastrowid)
+        db.commit()
+        threading.Thread(target=_run_stock_import, args=(job_id, path), name=f"stock-import-{job_id}", daemon=True).start()
+        if request.args.get("format") == "json":
+            return jsonify({"job_id": job_id, "status_url": url_for("estoque_importar_job", job_id=job_id, format="json")})
+        return redirect(url_for("estoque_importar_job", job_id=job_id))
+
+    jobs = db.execute("SELECT * FROM stock_import_jobs ORDER BY id DESC LIMIT 20").fetchall()
+    return render_template("estoque_importar.html", jobs=jobs, job=None, title="Importar estoque")
+
+
+@app.route("/estoque/importar/<int:job_id>")
+@login_required
+def estoque_importar_job(job_id):
+    db = get_db()
+    job = db.execute("SELECT * FROM stock_import_jobs WHERE id=?", (job_id,)).fetchone()
+    if not job:
+        flash("Importação não encontrada.", "error")
+        return redirect(url_for("estoque_importar"))
+    data = dict(job)
+    data["errors"] = json.loads(job["errors"] or "[]")
+    data["percent"] = round(100.0 * job["bytes_done"] / job["bytes_total"], 1) if job["bytes_total"] else 0.0
+    if request.args.get("format") == "json":
+        return jsonify(data)
+    return render_template("estoque_importar.html", jobs=None, job=data, title=f"Importação #{job_id}")
+
+
+@app.cli.command("estoque-reservas")
+def _cli_estoque_reservas():
+    """Refaz as reservas de peças a partir das OS abertas (corrige inventory.reserved)."""
+    db = get_db()
+    n = rebuild_os_reservations(db)
+    db.commit()
+    print(f"Reservas refeitas: {n} linhas")
+
+
 
 
 @login_required
@@ -672,16 +1419,22 @@ def estoque_editar(item_id):
 def inventory_search():
     db = get_db()
     q = request.args.get("q","").strip()
-    limit = int(request.args.get("limit") or 20)
+    limit, offset = _search_page_args()
+    # disponível = estoque - reservado (reservado já vem somado em inventory.reserved)
     if not q:
-        items = db.execute("SELECT id, name, price, stock FROM inventory ORDER BY name LIMIT ?", (limit,)).fetchall()
+        items = db.execute("SELECT id, name, sku, price, stock, reserved FROM inventory ORDER BY name LIMIT ? OFFSET ?",
+                           (limit, offset)).fetchall()
     else:
         items = db.execute("""
-            SELECT id, name, price, stock FROM inventory
+            SELECT id, name, sku, price, stock, reserved FROM inventory
             WHERE name LIKE ? OR sku LIKE ?
-            ORDER BY name LIMIT ?
-        """, (f"%{q}%", f"%{q}%", limit)).fetchall()
-    data = [dict(id=i["id"], name=i["name"], price=i["price"], stock=i["stock"]) for i in items]
+            ORDER BY name LIMIT ? OFFSET ?
+        """, (f"%{q}%", f"%{q}%", limit, offset)).fetchall()
+    data = [
+        dict(id=i["id"], name=i["name"], sku=i["sku"], price=i["price"], stock=i["stock"],
+             reserved=i["reserved"], available=i["stock"] - i["reserved"])
+        for i in items
+    ]
     return jsonify(data)
 
 
@@ -1126,6 +1879,11 @@ def os_new():
         if not client_id:
             flash("Selecione um cliente.", "error")
             return redirect(url_for("os_new"))
+        if vehicle_id and not db.execute(
+            "SELECT 1 FROM vehicles WHERE id=? AND client_id=?", (vehicle_id, client_id)
+        ).fetchone():
+            flash("O veículo escolhido não é desse cliente.", "error")
+            return redirect(url_for("os_new", client_id=client_id))
 
         # Se não veio vehicle_id mas temos dados digitados, cria ou reaproveita veículo
         if client_id and not vehicle_id and (vehicle_plate or vehicle_text):
@@ -1188,26 +1946,34 @@ def os_new():
                 ]
             )
 
-        # --- sync financeiro (OS -> lançamento PENDENTE/EFETIVADO/CANCELADO)
-        try:
-            rcn = db.execute("SELECT name FROM clients WHERE id=?", (client_id,)).fetchone()
-            client_name = rcn["name"] if rcn else None
-            sync_os_to_finance(db, os_id, client_name, "Aberta", "Dinheiro", "Pendente", base_labor, items)
-        except Exception as e:
-            print("ERRO sync_os_to_finance (os_new):", e)
+        # OS nasce aberta: reserva as peças
+        reconcile_os_reservations(db, os_id, "Aberta", items)
+        refresh_mechanic_daily_stats(db, [created_at])
+        invalidate_commissions(db, [created_at])
+        refresh_client_stats(db, [client_id])
+        mark_service_due(db, [vehicle_id])
+
+        # --- financeiro: evento no outbox (mesma transação); o worker gera o lançamento
+        enqueue_os_finance(db, os_id)
 
         db.commit()
+        notify_fin_outbox()
         flash(f"OS #{os_id} criada!", "ok")
         return redirect(url_for("os_view", os_id=os_id))
 
-    clients = db.execute("SELECT id, name FROM clients ORDER BY name").fetchall()
-    vehicles = db.execute(
-        """SELECT v.id, v.plate, v.model, c.name AS client_name
-           FROM vehicles v JOIN clients c ON c.id=v.client_id
-           ORDER BY v.id DESC"""
-    ).fetchall()
+    # cliente e veículo são escolhidos por busca (/api/clients_search, /api/vehicles_search);
+    # a página só traz o que veio pré-selecionado na URL (ex.: "Nova OS" do histórico do veículo)
+    client = vehicle = None
+    client_id = request.args.get("client_id", type=int)
+    if client_id:
+        client = db.execute("SELECT id, name, phone, cpf FROM clients WHERE id=?", (client_id,)).fetchone()
+        vehicle_id = request.args.get("vehicle_id", type=int)
+        if client and vehicle_id:
+            vehicle = db.execute(
+                "SELECT id, plate, model FROM vehicles WHERE id=? AND client_id=?", (vehicle_id, client_id)
+            ).fetchone()
     mechs = db.execute("SELECT id, name FROM mechanics ORDER BY name").fetchall()
-    return render_template("os_new.html", clients=clients, vehicles=vehicles, mechs=mechs, title="Nova OS")
+    return render_template("os_new.html", client=client, vehicle=vehicle, mechs=mechs, title="Nova OS")
 
 @app.route("/os/<int:os_id>")
 def os_view(os_id):
@@ -1242,8 +2008,19 @@ def os_view(os_id):
     servicos_total = mao_obra + servicos_itens_total
     total = pecas_total + servicos_total
 
+    # portal do mecânico: horas por mecânico e últimas anotações
+    mech_hours = mechanic_os_hours(db, os_id)
+    mech_acts = db.execute(
+        """SELECT l.kind, l.description, l.qty, l.hours, l.unit_value, l.created_at, m.name AS mech_name
+             FROM mechanic_activity_log l LEFT JOIN mechanics m ON m.id = l.mechanic_id
+            WHERE l.os_id = ? ORDER BY l.id DESC LIMIT 30""",
+        (os_id,),
+    ).fetchall()
+
     return render_template(
         "os_view.html",
+        mech_hours=mech_hours,
+        mech_acts=mech_acts,
         o=o,
         its=its,
         pecas=pecas,
@@ -1269,10 +2046,21 @@ def qr_os(os_id):
     return send_file(buf, mimetype="image/png")
 
 
-@login_required
 @app.route("/mecanicos", methods=["GET","POST"])
+@login_required
 def mecanicos():
     db = get_db()
+    if request.method == "POST" and request.form.get("mech_id"):
+        # PIN do portal do mecânico (vazio = sem acesso ao portal)
+        pin = (request.form.get("pin") or "").strip() or None
+        if pin and (not pin.isdigit() or len(pin) < 4):
+            flash("O PIN deve ter pelo menos 4 dígitos.", "error")
+        else:
+            db.execute("UPDATE mechanics SET pin=? WHERE id=?",
+                       (generate_password_hash(pin) if pin else None, request.form.get("mech_id")))
+            db.commit()
+            flash("PIN atualizado.", "ok")
+        return redirect(url_for("mecanicos"))
     if request.method == "POST":
         name = request.form.get("name","").strip()
         if not name:
@@ -1290,8 +2078,8 @@ def mecanicos():
     return render_template("mecanicos.html", rows=rows, title="Mecânicos")
 
 
-@login_required
 @app.route("/mecanicos/<int:mech_id>/excluir", methods=["POST"])
+@login_required
 def mecanico_excluir(mech_id):
     db = get_db()
     used = db.execute("SELECT COUNT(*) c FROM orders WHERE mechanic_id=?", (mech_id,)).fetchone()["c"]
@@ -1304,87 +2092,576 @@ def mecanico_excluir(mech_id):
     return redirect(url_for("mecanicos"))
 
 
-@login_required
-@app.route("/relatorio/mecanicos")
-def relatorio_mecanicos():
-    db = get_db()
+# --------------------------
+# Portal do mecânico (tablet) + log de atividades
+# --------------------------
+# O log é só de inclusão (triggers barram UPDATE/DELETE): cada toque no tablet é um INSERT
+# pequeno e um commit curto, então vários tablets gravando ao mesmo tempo não se bloqueiam
+# (WAL + busy timeout). Horas são derivadas depois, com janela sobre os eventos.
+MECH_LOG_KINDS = ("inicio", "fim", "obs", "peca", "servico")
+MECH_LOG_MAX_SESSION_H = 12.0  # início sem fim no mesmo turno não conta mais que isso
+
+# sessões de trabalho: cada "inicio" vai até o próximo inicio/fim do mesmo mecânico (LEAD),
+# já que o mecânico só trabalha numa OS por vez
+_MECH_SESSIONS_SQL = """
+    WITH ev AS (
+        SELECT l.mechanic_id, l.os_id, l.kind, l.created_at,
+               LEAD(l.created_at) OVER (PARTITION BY l.mechanic_id ORDER BY l.created_at, l.id) AS next_at
+          FROM mechanic_activity_log l
+         WHERE l.mechanic_id IN (SELECT id FROM mechanics)
+           AND l.kind IN ('inicio', 'fim')
+           AND l.created_at >= ? AND l.created_at < date(?, '+2 days')
+    )
+    SELECT * FROM (
+        SELECT mechanic_id, os_id, substr(created_at, 1, 10) AS work_date, created_at AS started_at, next_at,
+               CASE WHEN next_at IS NOT NULL THEN MIN((julianday(next_at) - julianday(created_at)) * 24.0, ?)
+                    -- sem evento seguinte: ainda em andamento, ou esquecido (conta o teto)
+                    WHEN created_at <= datetime('now', 'localtime', ?) THEN ?
+               END AS hours
+          FROM ev
+         WHERE kind = 'inicio' AND created_at >= ? AND created_at < date(?, '+1 day')
+    ) WHERE hours IS NOT NULL
+"""
 
-    # Período (padrão: últimos 7 dias)
-    today = datetime.date.today()
-    d_end = request.args.get("end") or ""
-    d_start = request.args.get("start") or ""
 
-    try:
-        end = datetime.datetime.strptime(d_end, "%Y-%m-%d").date() if d_end else today
-    except ValueError:
-        end = today
+def _mech_sessions(start: str, end: str) -> tuple[str, list]:
+    """Subconsulta das sessões (mechanic_id, os_id, work_date, started_at, next_at, hours) com início em [start, end]."""
+    cap = MECH_LOG_MAX_SESSION_H
+    return _MECH_SESSIONS_SQL, [start, end, cap, f"-{int(cap)} hours", cap, start, end]
 
-    try:
-        start = datetime.datetime.strptime(d_start, "%Y-%m-%d").date() if d_start else (end - datetime.timedelta(days=6))
-    except ValueError:
-        start = end - datetime.timedelta(days=6)
 
-    start_ts = datetime.datetime.combine(start, datetime.time.min).strftime("%Y-%m-%d %H:%M:%S")
-    end_ts = datetime.datetime.combine(end, datetime.time.max).strftime("%Y-%m-%d %H:%M:%S")
+def _current_mechanic():
+    if not session.get("mech_id"):
+        return None
+    return {"id": session["mech_id"], "nome": session.get("mech_name") or ""}
 
-    # Percentual de repasse vindo da tela (?repasse=50, por exemplo)
-    repasse_str = request.args.get("repasse") or "50"
-    try:
-        repasse_percent = float(repasse_str)
-    except ValueError:
-        repasse_percent = 50.0
-    if repasse_percent < 0:
-        repasse_percent = 0.0
-    if repasse_percent > 100:
-        repasse_percent = 100.0
-    REPASSE_PERCENT = repasse_percent / 100.0
-
-    # Agregado por mecânico
-    raw_rows = db.execute(
-        """
-        WITH os AS (
-            SELECT id, mechanic_id, labor, created_at
-            FROM orders
-            WHERE created_at BETWEEN ? AND ?
-        ),
-        agg AS (
-            SELECT mechanic_id,
-                   COUNT(DISTINCT id) AS qtd_os,
-                   COALESCE(SUM(labor), 0) AS base_labor
-            FROM os
-            GROUP BY mechanic_id
-        ),
-        itens AS (
-            SELECT o.mechanic_id AS mechanic_id,
-                   COALESCE(SUM(CASE WHEN oi.is_labor = 1 THEN oi.total ELSE 0 END), 0) AS itens_mao_obra,
-                   COALESCE(SUM(CASE WHEN oi.is_labor = 0 THEN oi.total ELSE 0 END), 0) AS itens_pecas
-            FROM os o
-            LEFT JOIN order_items oi ON oi.order_id = o.id
-            GROUP BY o.mechanic_id
-        )
-        SELECT m.id AS mech_id,
-               m.name AS mechanic,
-               COALESCE(a.qtd_os, 0) AS qtd_os,
-               (COALESCE(a.base_labor, 0) + COALESCE(i.itens_mao_obra, 0)) AS soma_mao_obra,
-               COALESCE(i.itens_pecas, 0) AS soma_pecas,
-               (COALESCE(a.base_labor, 0) + COALESCE(i.itens_mao_obra, 0) + COALESCE(i.itens_pecas, 0)) AS total
-        FROM mechanics m
-        LEFT JOIN agg a ON a.mechanic_id = m.id
-        LEFT JOIN itens i ON i.mechanic_id = m.id
-        ORDER BY total DESC
-        """,
-        (start_ts, end_ts),
-    ).fetchall()
 
-    rows = []
-    total_os = 0
-    total_labor = 0.0
-    total_parts = 0.0
-    total_geral = 0.0
-    top_faturamento = None
-    top_os = None
+def _mech_running(db, mech_id: int):
+    """Último início/fim do mecânico (pelo idx_mech_log_mech_time): a OS em andamento ou None."""
+    r = db.execute(
+        """SELECT kind, os_id, created_at FROM mechanic_activity_log
+            WHERE mechanic_id = ? AND kind IN ('inicio', 'fim')
+            ORDER BY created_at DESC, id DESC LIMIT 1""",
+        (mech_id,),
+    ).fetchone()
+    return r if r and r["kind"] == "inicio" else None
 
-    for r in raw_rows:
+
+def _mech_os_card(db, os_id: int):
+    o = db.execute(
+        """SELECT o.id, o.status, c.name AS cliente_nome,
+                  TRIM(COALESCE(v.plate, '') || ' ' || COALESCE(v.model, '')) AS veiculo
+             FROM orders o
+             JOIN clients c ON c.id = o.client_id
+             LEFT JOIN vehicles v ON v.id = o.vehicle_id
+            WHERE o.id = ?""",
+        (os_id,),
+    ).fetchone()
+    return dict(o) if o else None
+
+
+MECH_LOGIN_MAX_FALHAS = 5         # tentativas erradas de PIN por IP e por mecânico...
+MECH_LOGIN_JANELA = 15 * 60       # ...dentro desta janela (segundos)
+
+_mech_falhas: dict[str, list[float]] = {}
+_mech_falhas_lock = threading.Lock()
+
+
+def _mech_login_bloqueado(chaves) -> bool:
+    agora = time.monotonic()
+    with _mech_falhas_lock:
+        for k in chaves:
+            recentes = [t for t in _mech_falhas.get(k, []) if agora - t < MECH_LOGIN_JANELA]
+            _mech_falhas[k] = recentes
+            if len(recentes) >= MECH_LOGIN_MAX_FALHAS:
+                return True
+    return False
+
+
+def _mech_login_falhou(chaves) -> None:
+    with _mech_falhas_lock:
+        for k in chaves:
+            _mech_falhas.setdefault(k, []).append(time.monotonic())
+
+
+@app.route("/mecanico/login", methods=["GET", "POST"])
+def mecanico_login():
+    db = get_db()
+    if request.method == "POST":
+        mech_id = request.form.get("mech_id", type=int)
+        pin = (request.form.get("pin") or "").strip()
+        chaves = [f"ip:{request.remote_addr}", f"mech:{mech_id}"]
+        if _mech_login_bloqueado(chaves):
+            flash("Muitas tentativas erradas. Aguarde alguns minutos e tente de novo.", "error")
+            return redirect(url_for("mecanico_login", next_os=request.form.get("next_os") or None))
+        m = db.execute("SELECT id, name, pin FROM mechanics WHERE id = ?", (mech_id,)).fetchone() if mech_id else None
+        if not m or not m["pin"] or not pin or not check_password_hash(m["pin"], pin):
+            _mech_login_falhou(chaves)
+            flash("Mecânico ou PIN inválido.", "error")
+            return redirect(url_for("mecanico_login", next_os=request.form.get("next_os") or None))
+        session["mech_id"] = m["id"]
+        session["mech_name"] = m["name"]
+        next_os = request.form.get("next_os") or ""
+        if next_os.isdigit():
+            return redirect(url_for("mecanico_os", os_id=int(next_os)))
+        return redirect(url_for("mecanico"))
+    mechs = db.execute("SELECT id, name FROM mechanics WHERE pin IS NOT NULL ORDER BY name").fetchall()
+    return render_template("mecanico_login.html", mechs=mechs, title="Acesso do Mecânico")
+
+
+@app.route("/mecanico/logout")
+def mecanico_logout():
+    session.pop("mech_id", None)
+    session.pop("mech_name", None)
+    return redirect(url_for("mecanico_login"))
+
+
+@app.route("/mecanico")
+def mecanico():
+    mech = _current_mechanic()
+    if not mech:
+        return redirect(url_for("mecanico_login"))
+    db = get_db()
+    placa = (request.args.get("placa") or "").strip().upper()
+    if placa:
+        norm = placa.replace("-", "").replace(" ", "")
+        rows = db.execute(
+            """SELECT o.id, o.status, o.created_at, v.plate, c.name AS client_name
+                 FROM vehicles v
+                 JOIN orders o ON o.vehicle_id = v.id
+                 JOIN clients c ON c.id = o.client_id
+                WHERE REPLACE(REPLACE(UPPER(v.plate), '-', ''), ' ', '') = ?
+                ORDER BY o.id DESC LIMIT 50""",
+            (norm,),
+        ).fetchall()
+        return render_template("mecanico.html", rows=rows, placa=placa, title="Modo Mecânico")
+    # OS abertas: as do próprio mecânico primeiro
+    os_list = [
+        dict(r) for r in db.execute(
+            """SELECT o.id, c.name AS cliente_nome,
+                      TRIM(COALESCE(v.plate, '') || ' ' || COALESCE(v.model, '')) AS veiculo
+                 FROM orders o
+                 JOIN clients c ON c.id = o.client_id
+                 LEFT JOIN vehicles v ON v.id = o.vehicle_id
+                WHERE o.status NOT IN ('Fechada', 'Cancelada')
+                ORDER BY (o.mechanic_id = ?) DESC, o.id DESC
+                LIMIT 20""",
+            (mech["id"],),
+        ).fetchall()
+    ]
+    running = _mech_running(db, mech["id"])
+    return render_template("mecanico_home.html", mech=mech, os_list=os_list, running=running, title="Portal do Mecânico")
+
+
+@app.route("/mecanico/os/<int:os_id>")
+def mecanico_os(os_id):
+    mech = _current_mechanic()
+    if not mech:
+        return redirect(url_for("mecanico_login", next_os=os_id))
+    db = get_db()
+    o = _mech_os_card(db, os_id)
+    if not o:
+        flash("OS não encontrada.", "error")
+        return redirect(url_for("mecanico"))
+    acts = db.execute(
+        """SELECT l.id, l.kind AS tipo, l.description AS descricao, l.qty AS quantidade, l.hours AS horas,
+                  l.unit_value AS valor_unitario, l.created_at, m.name AS mecanico_nome
+             FROM mechanic_activity_log l
+             LEFT JOIN mechanics m ON m.id = l.mechanic_id
+            WHERE l.os_id = ?
+            ORDER BY l.id DESC LIMIT 50""",
+        (os_id,),
+    ).fetchall()
+    running = _mech_running(db, mech["id"])
+    return render_template("mecanico_os.html", mech=mech, o=o, acts=acts, running=running,
+                           uid=os.urandom(8).hex(), title=f"OS #{os_id}")
+
+
+@app.route("/mecanico/atividade", methods=["POST"])
+def mecanico_add_atividade():
+    """Um evento do tablet = um INSERT. O uid do formulário evita duplicar em toque duplo/reenvio."""
+    mech = _current_mechanic()
+    as_json = request.args.get("format") == "json" or request.is_json
+    if not mech:
+        if as_json:
+            return jsonify({"ok": False, "error": "login"}), 401
+        return redirect(url_for("mecanico_login"))
+    f = request.get_json(silent=True) or request.form
+    kind = (f.get("tipo") or "").strip().lower()
+    try:
+        os_id = int(f.get("os_id") or 0)
+    except (TypeError, ValueError):
+        os_id = 0
+
+    def num(key):
+        try:
+            return float(str(f.get(key)).replace(",", ".")) if f.get(key) not in (None, "") else None
+        except ValueError:
+            return None
+
+    db = get_db()
+    error = None
+    if kind not in MECH_LOG_KINDS:
+        error = "Tipo de atividade inválido."
+    elif not db.execute("SELECT 1 FROM orders WHERE id = ?", (os_id,)).fetchone():
+        error = "OS não encontrada."
+    elif kind in ("obs", "peca", "servico") and not (f.get("descricao") or "").strip():
+        error = "Descreva a atividade."
+    elif kind == "fim":
+        run = _mech_running(db, mech["id"])
+        if not run:
+            error = "Nenhum trabalho em andamento."
+        else:
+            os_id = run["os_id"]  # o fim fecha o que estiver em andamento
+    if error:
+        if as_json:
+            return jsonify({"ok": False, "error": error}), 400
+        flash(error, "error")
+        return redirect(url_for("mecanico_os", os_id=os_id) if os_id else url_for("mecanico"))
+
+    cur = db.execute(
+        """INSERT OR IGNORE INTO mechanic_activity_log(mechanic_id, os_id, kind, description, qty, hours, unit_value, uid, created_at)
+           VALUES (?,?,?,?,?,?,?,?,?)""",
+        (mech["id"], os_id, kind, (f.get("descricao") or "").strip() or None, num("quantidade"), num("horas"),
+         num("valor_unitario"), (f.get("uid") or "").strip() or None,
+         datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+    )
+    db.commit()
+    if as_json:
+        return jsonify({"ok": True, "id": cur.lastrowid if cur.rowcount else None, "duplicate": cur.rowcount == 0})
+    return redirect(url_for("mecanico_os", os_id=os_id))
+
+
+@app.route("/relatorio/mecanicos/logs")
+@login_required
+def relatorio_mecanico_logs():
+    """Horas por dia x mecânico x OS a partir do log (sessões por LEAD) + observações do dia;
+    totais por mecânico e por OS no período com SUM() OVER."""
+    db = get_db()
+    today = datetime.date.today()
+    try:
+        end = datetime.date.fromisoformat(request.args.get("end") or "") if request.args.get("end") else today
+    except ValueError:
+        end = today
+    try:
+        start = datetime.date.fromisoformat(request.args.get("start") or "") if request.args.get("start") else end - datetime.timedelta(days=6)
+    except ValueError:
+        start = end - datetime.timedelta(days=6)
+    sessions_sql, params = _mech_sessions(start.isoformat(), end.isoformat())
+    rows = db.execute(
+        f"""
+        WITH s AS ({sessions_sql}),
+        notes AS (
+            SELECT mechanic_id, os_id, substr(created_at, 1, 10) AS work_date,
+                   group_concat(description, ' • ') AS description
+              FROM mechanic_activity_log
+             WHERE mechanic_id IN (SELECT id FROM mechanics)
+               AND kind IN ('obs', 'peca', 'servico')
+               AND created_at >= ? AND created_at < date(?, '+1 day')
+             GROUP BY 1, 2, 3
+        ),
+        k AS (
+            SELECT mechanic_id, os_id, work_date, hours, NULL AS description FROM s
+            UNION ALL
+            SELECT mechanic_id, os_id, work_date, 0, description FROM notes
+        ),
+        day AS (
+            SELECT work_date, mechanic_id, os_id, SUM(hours) AS hours, group_concat(description, ' • ') AS description
+              FROM k GROUP BY work_date, mechanic_id, os_id
+        )
+        SELECT d.work_date, d.mechanic_id, m.name AS mech_name, d.os_id, ROUND(d.hours, 2) AS hours, d.description,
+               ROUND(SUM(d.hours) OVER (PARTITION BY d.mechanic_id), 2) AS mech_hours,
+               ROUND(SUM(d.hours) OVER (PARTITION BY d.os_id), 2) AS os_hours
+          FROM day d
+          JOIN mechanics m ON m.id = d.mechanic_id
+         ORDER BY d.work_date DESC, m.name, d.os_id
+        """,
+        params + [start.isoformat(), end.isoformat()],
+    ).fetchall()
+    totals = {}
+    for r in rows:
+        totals[r["mech_name"]] = r["mech_hours"] or 0
+    return render_template("relatorio_mecanico_logs.html", rows=rows, totals=totals, start=start, end=end,
+                           title="Relatório — Lançamentos de Serviços")
+
+
+def mechanic_os_hours(db, os_id: int) -> list:
+    """Horas trabalhadas na OS por mecânico (sessões de todo o histórico da OS)."""
+    first = db.execute("SELECT MIN(created_at) FROM mechanic_activity_log WHERE os_id = ?", (os_id,)).fetchone()[0]
+    if not first:
+        return []
+    sessions_sql, params = _mech_sessions(first[:10], _today_iso())
+    return db.execute(
+        f"""SELECT m.name AS mech_name, ROUND(SUM(s.hours), 2) AS hours
+              FROM ({sessions_sql}) s JOIN mechanics m ON m.id = s.mechanic_id
+             WHERE s.os_id = ? GROUP BY s.mechanic_id ORDER BY hours DESC""",
+        params + [os_id],
+    ).fetchall()
+
+
+def refresh_mechanic_daily_stats(db, days=None) -> int:
+    """Recalcula mechanic_daily_stats a partir das OS (sem commit).
+    days: datas/timestamps das OS alteradas (só esses dias são refeitos, pelo idx_orders_created);
+    None refaz tudo (migração / `flask mecanicos-resumo`). Recalcular o dia inteiro em vez de
+    somar deltas deixa o resultado certo seja qual for a ordem em que itens e OS são gravados."""
+    select = """
+        INSERT INTO mechanic_daily_stats(day, mechanic_id, os_count, base_labor, labor_items, parts)
+        SELECT substr(o.created_at, 1, 10), o.mechanic_id, COUNT(*), SUM(COALESCE(o.labor, 0)),
+               SUM((SELECT COALESCE(SUM(CASE WHEN oi.is_labor = 1 THEN oi.total ELSE 0 END), 0)
+                      FROM order_items oi WHERE oi.order_id = o.id)),
+               SUM((SELECT COALESCE(SUM(CASE WHEN oi.is_labor = 0 THEN oi.total ELSE 0 END), 0)
+                      FROM order_items oi WHERE oi.order_id = o.id))
+          FROM orders o
+         WHERE o.mechanic_id IS NOT NULL AND {where}
+         GROUP BY 1, 2
+    """
+    if days is None:
+        db.execute("DELETE FROM mechanic_daily_stats")
+        db.execute(select.format(where="o.created_at IS NOT NULL"))
+        return db.execute("SELECT COUNT(*) FROM mechanic_daily_stats").fetchone()[0]
+    n = 0
+    for day in sorted({str(d)[:10] for d in days if d}):
+        db.execute("DELETE FROM mechanic_daily_stats WHERE day = ?", (day,))
+        n += db.execute(
+            select.format(where="o.created_at >= ? AND o.created_at < date(?, '+1 day')"), (day, day)
+        ).rowcount
+    return n
+
+
+@app.cli.command("mecanicos-resumo")
+def _cli_mecanicos_resumo():
+    """Refaz a estatística diária por mecânico (mechanic_daily_stats) a partir das OS."""
+    db = get_db()
+    n = refresh_mechanic_daily_stats(db)
+    db.commit()
+    print(f"Resumo por mecânico refeito: {n} linhas (dia x mecânico)")
+
+
+# --------------------------
+# Comissão dos mecânicos (repasse por item)
+# --------------------------
+# MAO_DE_OBRA = orders.labor; FIXO = item com inventory.repasse_value (valor fixo x qtd);
+# SERVICO / PECA = demais itens, pelo percentual da regra
+COMMISSION_TYPES = ("MAO_DE_OBRA", "FIXO", "SERVICO", "PECA")
+COMMISSION_DEFAULTS = {"MAO_DE_OBRA": 50.0, "SERVICO": 50.0, "PECA": 0.0}
+COMMISSION_LABELS = {"MAO_DE_OBRA": "Mão de obra da OS", "FIXO": "Serviço (repasse fixo)",
+                     "SERVICO": "Serviço (%)", "PECA": "Peças (%)"}
+
+_COMMISSION_LINES_SQL = """
+    WITH os AS (
+        SELECT id, mechanic_id, created_at, COALESCE(labor, 0) AS labor
+          FROM orders
+         WHERE mechanic_id IS NOT NULL AND created_at >= ? AND created_at < ?
+    ),
+    lines AS (
+        SELECT os.id AS os_id, os.mechanic_id, os.created_at, 'MAO_DE_OBRA' AS item_type,
+               'Mão de obra' AS description, 1 AS qty, os.labor AS base, NULL AS fixed
+          FROM os WHERE os.labor <> 0
+        UNION ALL
+        SELECT os.id, os.mechanic_id, os.created_at,
+               CASE WHEN COALESCE(inv.repasse_value, 0) > 0 THEN 'FIXO'
+                    WHEN COALESCE(inv.is_labor, oi.is_labor, 0) = 1 THEN 'SERVICO'
+                    ELSE 'PECA' END,
+               oi.description, COALESCE(oi.qty, 1), COALESCE(oi.total, 0),
+               CASE WHEN COALESCE(inv.repasse_value, 0) > 0 THEN inv.repasse_value * COALESCE(oi.qty, 1) END
+          FROM os
+          JOIN order_items oi ON oi.order_id = os.id
+          LEFT JOIN inventory inv ON inv.id = oi.inventory_id
+    )
+    SELECT l.*, COALESCE(l.fixed, l.base * COALESCE(r.percent, 0) / 100.0) AS payout
+      FROM lines l
+      LEFT JOIN commission_rules r ON r.item_type = l.item_type
+"""
+
+
+def compute_commissions(db, start: str, end_excl: str) -> list:
+    """Repasse de todos os mecânicos em [start, end_excl) numa consulta só, agrupado por
+    mecânico e tipo de item: (mechanic_id, item_type, items, base, payout)."""
+    return db.execute(
+        f"""SELECT mechanic_id, item_type, COUNT(*) AS items, SUM(base) AS base, SUM(payout) AS payout
+              FROM ({_COMMISSION_LINES_SQL}) GROUP BY mechanic_id, item_type""",
+        (start, end_excl),
+    ).fetchall()
+
+
+def _month_bounds(month: str) -> tuple[str, str]:
+    d = datetime.date.fromisoformat(month + "-01")
+    nxt = (d.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return d.isoformat(), nxt.isoformat()
+
+
+def commission_month(db, month: str) -> list:
+    """Repasse do mês (YYYY-MM) vindo de commission_cache; se o mês não está calculado
+    (ou foi invalidado por uma OS/regra alterada), calcula e grava. Não faz commit."""
+    if db.execute("SELECT 1 FROM commission_months WHERE month=?", (month,)).fetchone() is None:
+        db.execute("DELETE FROM commission_cache WHERE month=?", (month,))
+        db.executemany(
+            "INSERT INTO commission_cache(month, mechanic_id, item_type, items, base, payout) VALUES (?,?,?,?,?,?)",
+            [(month, r["mechanic_id"], r["item_type"], r["items"], r["base"], r["payout"])
+             for r in compute_commissions(db, *_month_bounds(month))],
+        )
+        db.execute("INSERT INTO commission_months(month, computed_at) VALUES (?,?)", (month, _now_iso()))
+    return db.execute(
+        "SELECT mechanic_id, item_type, items, base, payout FROM commission_cache WHERE month=?", (month,)
+    ).fetchall()
+
+
+def commission_totals(db, start: datetime.date, end: datetime.date) -> dict[int, float]:
+    """Repasse por mecânico no período [start, end]: meses inteiros pelo cache,
+    pontas de mês quebrado calculadas na hora."""
+    out: dict[int, float] = {}
+
+    def add(rows):
+        for r in rows:
+            out[r["mechanic_id"]] = out.get(r["mechanic_id"], 0.0) + float(r["payout"] or 0)
+
+    d = start
+    while d <= end:
+        m_start = d.replace(day=1)
+        m_next = (m_start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        seg_end = min(end, m_next - datetime.timedelta(days=1))
+        if d == m_start and seg_end == m_next - datetime.timedelta(days=1):
+            add(commission_month(db, m_start.strftime("%Y-%m")))
+        else:
+            add(compute_commissions(db, d.isoformat(), (seg_end + datetime.timedelta(days=1)).isoformat()))
+        d = seg_end + datetime.timedelta(days=1)
+    return out
+
+
+def invalidate_commissions(db, days=None) -> None:
+    """Marca meses do cache de comissão para recalcular (days=None: todos, ex. regra alterada)."""
+    if days is None:
+        db.execute("DELETE FROM commission_months")
+        return
+    db.executemany("DELETE FROM commission_months WHERE month=?", [(m,) for m in {str(d)[:7] for d in days if d}])
+
+
+@app.route("/relatorio/comissoes", methods=["GET", "POST"])
+@login_required
+def relatorio_comissoes():
+    db = get_db()
+    if request.method == "POST":
+        db.executemany(
+            "INSERT INTO commission_rules(item_type, percent) VALUES (?,?) "
+            "ON CONFLICT(item_type) DO UPDATE SET percent = excluded.percent",
+            [(t, max(0.0, min(100.0, float(request.form.get(f"pct_{t}") or 0)))) for t in COMMISSION_DEFAULTS],
+        )
+        invalidate_commissions(db)
+        db.commit()
+        flash("Regras de comissão atualizadas.", "ok")
+        return redirect(url_for("relatorio_comissoes", mes=request.form.get("mes")))
+
+    month = request.args.get("mes") or datetime.date.today().strftime("%Y-%m")
+    try:
+        m_start, m_next = _month_bounds(month)
+    except ValueError:
+        month = datetime.date.today().strftime("%Y-%m")
+        m_start, m_next = _month_bounds(month)
+    mechs = {r["id"]: r["name"] for r in db.execute("SELECT id, name FROM mechanics").fetchall()}
+
+    if request.args.get("format") == "csv":
+        if request.args.get("detalhe"):
+            rows = db.execute(
+                f"SELECT * FROM ({_COMMISSION_LINES_SQL}) ORDER BY mechanic_id, os_id", (m_start, m_next)
+            ).fetchall()
+            return _csv_response(
+                f"comissoes_{month}_itens.csv",
+                ["mecanico", "os", "data", "tipo", "descricao", "qtd", "valor_item", "repasse"],
+                [(mechs.get(r["mechanic_id"], r["mechanic_id"]), r["os_id"], r["created_at"][:10], r["item_type"],
+                  r["description"], r["qty"], f"{r['base']:.2f}", f"{r['payout']:.2f}") for r in rows],
+            )
+        rows = commission_month(db, month)
+        db.commit()
+        return _csv_response(
+            f"comissoes_{month}.csv",
+            ["mecanico", "tipo", "itens", "valor_base", "repasse"],
+            [(mechs.get(r["mechanic_id"], r["mechanic_id"]), r["item_type"], r["items"],
+              f"{r['base']:.2f}", f"{r['payout']:.2f}") for r in rows],
+        )
+
+    rows = commission_month(db, month)
+    db.commit()
+    by_mech: dict[int, dict] = {}
+    for r in rows:
+        m = by_mech.setdefault(r["mechanic_id"], {"mechanic": mechs.get(r["mechanic_id"], f"#{r['mechanic_id']}"),
+                                                  "types": {}, "base": 0.0, "payout": 0.0})
+        m["types"][r["item_type"]] = float(r["payout"] or 0)
+        m["base"] += float(r["base"] or 0)
+        m["payout"] += float(r["payout"] or 0)
+    ranking = sorted(by_mech.values(), key=lambda m: m["payout"], reverse=True)
+    rules = {r["item_type"]: r["percent"] for r in db.execute("SELECT item_type, percent FROM commission_rules")}
+    return render_template(
+        "relatorio_comissoes.html", title="Comissões dos mecânicos", month=month, ranking=ranking,
+        rules=rules, types=COMMISSION_TYPES, labels=COMMISSION_LABELS,
+        total=sum(m["payout"] for m in ranking),
+    )
+
+
+REL_MECANICOS_DETALHE = 50  # OS por mecânico no detalhamento do relatório
+
+
+@login_required
+@app.route("/relatorio/mecanicos")
+def relatorio_mecanicos():
+    db = get_db()
+
+    # Período (padrão: últimos 7 dias)
+    today = datetime.date.today()
+    d_end = request.args.get("end") or ""
+    d_start = request.args.get("start") or ""
+
+    try:
+        end = datetime.datetime.strptime(d_end, "%Y-%m-%d").date() if d_end else today
+    except ValueError:
+        end = today
+
+    try:
+        start = datetime.datetime.strptime(d_start, "%Y-%m-%d").date() if d_start else (end - datetime.timedelta(days=6))
+    except ValueError:
+        start = end - datetime.timedelta(days=6)
+
+    start_ts = datetime.datetime.combine(start, datetime.time.min).strftime("%Y-%m-%d %H:%M:%S")
+    end_ts = datetime.datetime.combine(end, datetime.time.max).strftime("%Y-%m-%d %H:%M:%S")
+
+    # Repasse pelas regras de comissão (por item; meses inteiros vêm do cache)
+    repasses = commission_totals(db, start, end)
+    db.commit()  # meses recém-calculados ficam no cache
+
+    # Agregado por mecânico (soma dos dias do período em mechanic_daily_stats)
+    raw_rows = db.execute(
+        """
+        WITH agg AS (
+            SELECT mechanic_id,
+                   SUM(os_count) AS qtd_os,
+                   SUM(base_labor) AS base_labor,
+                   SUM(labor_items) AS itens_mao_obra,
+                   SUM(parts) AS itens_pecas
+            FROM mechanic_daily_stats
+            WHERE day BETWEEN ? AND ?
+            GROUP BY mechanic_id
+        )
+        SELECT m.id AS mech_id,
+               m.name AS mechanic,
+               COALESCE(a.qtd_os, 0) AS qtd_os,
+               (COALESCE(a.base_labor, 0) + COALESCE(a.itens_mao_obra, 0)) AS soma_mao_obra,
+               COALESCE(a.itens_pecas, 0) AS soma_pecas,
+               (COALESCE(a.base_labor, 0) + COALESCE(a.itens_mao_obra, 0) + COALESCE(a.itens_pecas, 0)) AS total
+        FROM mechanics m
+        LEFT JOIN agg a ON a.mechanic_id = m.id
+        ORDER BY total DESC
+        """,
+        (start.isoformat(), end.isoformat()),
+    ).fetchall()
+
+    rows = []
+    total_os = 0
+    total_labor = 0.0
+    total_parts = 0.0
+    total_geral = 0.0
+    top_faturamento = None
+    top_os = None
+
+    for r in raw_rows:
         qtd = r["qtd_os"] or 0
         mao = float(r["soma_mao_obra"] or 0)
         pec = float(r["soma_pecas"] or 0)
@@ -1392,7 +2669,7 @@ def relatorio_mecanicos():
 
         ticket = tot / qtd if qtd else 0
         perc_mao = (mao / tot * 100) if tot > 0 else 0
-        repasse_valor = tot * REPASSE_PERCENT
+        repasse_valor = repasses.get(r["mech_id"], 0.0)
 
         total_os += qtd
         total_labor += mao
@@ -1424,12 +2701,13 @@ def relatorio_mecanicos():
         "total_labor": total_labor,
         "total_parts": total_parts,
         "total_geral": total_geral,
-        "repasse_percent": repasse_percent,
+        "total_repasse": sum(repasses.values()),
         "top_faturamento": top_faturamento,
         "top_os": top_os,
     }
 
-    # Detalhamento por OS no período (para tabela analítica)
+    # Detalhamento por OS no período (para tabela analítica): só as últimas OS de cada mecânico,
+    # pelo idx_orders_mech_created, para o custo não crescer com o tamanho do período
     os_rows = db.execute(
         """
         SELECT
@@ -1440,24 +2718,27 @@ def relatorio_mecanicos():
             c.name AS client_name,
             v.plate,
             COALESCE(o.labor, 0) AS labor,
-            COALESCE(SUM(oi.total), 0) AS soma_pecas,
-            COALESCE(SUM(oi.total), 0) + COALESCE(o.labor, 0) AS total_os
-        FROM orders o
-        JOIN mechanics m ON m.id = o.mechanic_id
+            (SELECT COALESCE(SUM(oi.total), 0) FROM order_items oi WHERE oi.order_id = o.id) AS soma_pecas,
+            (SELECT COALESCE(SUM(oi.total), 0) FROM order_items oi WHERE oi.order_id = o.id) + COALESCE(o.labor, 0) AS total_os
+        FROM mechanics m
+        JOIN orders o ON o.id IN (
+            SELECT x.id FROM orders x
+             WHERE x.mechanic_id = m.id AND x.created_at BETWEEN ? AND ?
+             ORDER BY x.created_at DESC
+             LIMIT ?
+        )
         JOIN clients c ON c.id = o.client_id
         LEFT JOIN vehicles v ON v.id = o.vehicle_id
-        LEFT JOIN order_items oi ON oi.order_id = o.id
-        WHERE o.created_at BETWEEN ? AND ?
-        GROUP BY o.id
         ORDER BY m.name, o.id DESC
         """,
-        (start_ts, end_ts),
+        (start_ts, end_ts, REL_MECANICOS_DETALHE),
     ).fetchall()
 
     return render_template(
         "relatorio_mecanicos.html",
         rows=rows,
         os_rows=os_rows,
+        detalhe_limite=REL_MECANICOS_DETALHE,
         summary=summary,
         start=start,
         end=end,
@@ -1465,6 +2746,632 @@ def relatorio_mecanicos():
     )
 
 
+# --------------------------
+# Clientes: recência / frequência / valor (RFM)
+# --------------------------
+REL_CLIENTES_PAGINA = 50
+REL_CLIENTES_ORDEM = {
+    "recencia": "s.last_visit",
+    "frequencia": "s.visits",
+    "valor": "s.monetary",
+    "ticket": "s.avg_ticket",
+    "nome": "c.name COLLATE NOCASE",
+}
+
+
+def refresh_client_stats(db, client_ids=None) -> int:
+    """Recalcula client_stats numa passada agregada sobre orders (+ soma dos itens por OS) (sem commit).
+    client_ids: clientes cujas OS mudaram (só eles são refeitos, pelo idx_orders_client_created);
+    None refaz tudo (migração / `flask clientes-rfm`)."""
+    select = """
+        INSERT INTO client_stats(client_id, first_visit, last_visit, visits, monetary, avg_ticket,
+                                 avg_interval_days, updated_at)
+        SELECT client_id, MIN(day), MAX(day), COUNT(*), SUM(total), SUM(total) / COUNT(*),
+               CASE WHEN COUNT(*) > 1 THEN (julianday(MAX(day)) - julianday(MIN(day))) / (COUNT(*) - 1) END,
+               ?
+          FROM (
+              SELECT o.client_id, substr(o.created_at, 1, 10) AS day,
+                     COALESCE(o.labor, 0)
+                     + (SELECT COALESCE(SUM(oi.total), 0) FROM order_items oi WHERE oi.order_id = o.id) AS total
+                FROM orders o
+               WHERE o.status <> 'Cancelada' AND o.created_at IS NOT NULL AND {where}
+          )
+         GROUP BY client_id
+    """
+    now = _now_iso()
+    if client_ids is None:
+        db.execute("DELETE FROM client_stats")
+        db.execute(select.format(where="1"), (now,))
+        return db.execute("SELECT COUNT(*) FROM client_stats").fetchone()[0]
+    ids = sorted({int(c) for c in client_ids if c})
+    n = 0
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        marks = ",".join("?" * len(chunk))
+        db.execute(f"DELETE FROM client_stats WHERE client_id IN ({marks})", chunk)
+        n += db.execute(select.format(where=f"o.client_id IN ({marks})"), [now] + chunk).rowcount
+    return n
+
+
+@app.cli.command("clientes-rfm")
+def _cli_clientes_rfm():
+    """Refaz a recência/frequência/valor por cliente (client_stats) a partir das OS."""
+    db = get_db()
+    n = refresh_client_stats(db)
+    db.commit()
+    print(f"RFM de clientes refeito: {n} clientes com OS")
+
+
+@app.route("/relatorio/clientes")
+@login_required
+def relatorio_clientes():
+    db = get_db()
+    today = datetime.date.today().isoformat()
+    ordem = request.args.get("ordem") if request.args.get("ordem") in REL_CLIENTES_ORDEM else "valor"
+    direcao = "asc" if request.args.get("dir") == "asc" else "desc"
+    q = (request.args.get("q") or "").strip()
+    try:
+        inativo = max(0, int(request.args.get("inativo") or 0))  # meses sem visita
+    except ValueError:
+        inativo = 0
+    try:
+        page = max(1, int(request.args.get("page") or 1))
+    except ValueError:
+        page = 1
+
+    where, params = [], []
+    if inativo:
+        where.append("s.last_visit < date(?, ?)")
+        params += [today, f"-{inativo} months"]
+    if q:
+        where.append("(c.name LIKE ? OR c.phone LIKE ?)")
+        params += [f"%{q}%", f"%{q}%"]
+    where_sql = ("WHERE " + " AND ".join(where)) if where else ""
+
+    # notas 1..5 de R/F/M sobre todos os clientes com OS (5 = mais recente / mais frequente / mais gasto)
+    sql = f"""
+        WITH scored AS (
+            SELECT client_stats.*,
+                   NTILE(5) OVER (ORDER BY last_visit) AS r_score,
+                   NTILE(5) OVER (ORDER BY visits) AS f_score,
+                   NTILE(5) OVER (ORDER BY monetary) AS m_score
+              FROM client_stats
+        )
+        SELECT s.*, c.name, c.phone,
+               CAST(julianday(?) - julianday(s.last_visit) AS INTEGER) AS recency_days
+          FROM scored s
+          JOIN clients c ON c.id = s.client_id
+          {where_sql}
+         ORDER BY {REL_CLIENTES_ORDEM[ordem]} {direcao}, s.client_id
+    """
+    if request.args.get("format") == "csv":
+        rows = db.execute(sql, [today] + params).fetchall()
+        return _csv_response(
+            f"clientes_rfm_{today}.csv",
+            ["cliente_id", "cliente", "telefone", "primeira_visita", "ultima_visita", "dias_sem_visita",
+             "visitas", "intervalo_medio_dias", "valor_total", "ticket_medio", "r", "f", "m"],
+            [(r["client_id"], r["name"], r["phone"] or "", r["first_visit"], r["last_visit"], r["recency_days"],
+              r["visits"], f"{r['avg_interval_days']:.0f}" if r["avg_interval_days"] is not None else "",
+              f"{r['monetary']:.2f}", f"{r['avg_ticket']:.2f}", r["r_score"], r["f_score"], r["m_score"])
+             for r in rows],
+        )
+
+    summary = db.execute(
+        f"""SELECT COUNT(*) AS clientes, COALESCE(SUM(s.monetary), 0) AS valor,
+                   COALESCE(SUM(s.visits), 0) AS visitas
+              FROM client_stats s JOIN clients c ON c.id = s.client_id {where_sql}""",
+        params,
+    ).fetchone()
+    rows = db.execute(
+        sql + " LIMIT ? OFFSET ?", [today] + params + [REL_CLIENTES_PAGINA, (page - 1) * REL_CLIENTES_PAGINA]
+    ).fetchall()
+    pages = max(1, -(-summary["clientes"] // REL_CLIENTES_PAGINA))
+    return render_template(
+        "relatorio_clientes.html", title="Relatório de Clientes", rows=rows, summary=summary,
+        ordem=ordem, direcao=direcao, q=q, inativo=inativo, page=page, pages=pages,
+    )
+
+
+# --------------------------
+# Cache colunar dos relatórios (colunar.py)
+# --------------------------
+_colunar_cache = None
+_colunar_lock = threading.Lock()
+
+
+def colunar_snapshot() -> colunar.Snapshot:
+    """Snapshot atualizado do cache colunar do processo (a 1ª chamada carrega tudo; depois só o que mudou)."""
+    global _colunar_cache
+    with _colunar_lock:
+        if _colunar_cache is None or _colunar_cache.db_path != DB_PATH:
+            _colunar_cache = colunar.ColumnarCache(DB_PATH)
+    return _colunar_cache.sync()
+
+
+# --------------------------
+# Peças e serviços mais vendidos / margem
+# --------------------------
+REL_ITENS_ORDEM = {"qtd": "qty", "receita": "revenue", "margem": "margin", "margem_pct": "margin_pct", "os": "os_count"}
+REL_ITENS_LIMITE = 100
+
+
+def top_items(snap: colunar.Snapshot, start: str, end: str, tipo: str = "todos", agrupar: str = "item") -> list[dict]:
+    """Ranking de itens vendidos nas OS (não canceladas) de [start, end], sobre o snapshot colunar.
+
+    agrupar="item": item do estoque; linha sem item do estoque agrupa pela descrição.
+    agrupar="descricao": tudo pela descrição (normalizada em maiúsculas).
+    Custo = qtd x inventory.cost_price atual; serviço digitado à mão tem custo 0; peça digitada à mão
+    não tem custo conhecido (margem None)."""
+    it, od, inv = snap.table("order_items"), snap.table("orders"), snap.table("inventory")
+    opos = snap.lookup("orders", "id", it["order_id"])
+    ok = opos >= 0
+    opos = np.where(ok, opos, 0)
+    d0 = (datetime.date.fromisoformat(start) - _EPOCH).days
+    d1 = (datetime.date.fromisoformat(end) - _EPOCH).days
+    day = od["day"][opos] if len(od["day"]) else np.zeros(len(opos), dtype=np.int64)
+    m = ok & (day >= d0) & (day <= d1)
+    if len(od["status"]):
+        m &= od["status"][opos] != snap.code("orders", "status", "Cancelada")
+    if tipo == "pecas":
+        m &= it["is_labor"] == 0
+    elif tipo == "servicos":
+        m &= it["is_labor"] == 1
+    if not m.any():
+        return []
+
+    inv_id, desc, qty, rev = it["inventory_id"][m], it["description"][m], it["qty"][m], it["total"][m]
+    order_id, is_labor = it["order_id"][m], it["is_labor"][m]
+    ipos = snap.lookup("inventory", "id", inv_id)
+    has_inv = ipos >= 0
+    ipos = np.where(has_inv, ipos, 0)
+    cost = np.where(has_inv, qty * inv["cost_price"][ipos], 0.0) if len(inv["id"]) else np.zeros(len(qty))
+    unknown = ~has_inv & (is_labor == 0)
+
+    if agrupar == "descricao":
+        key = desc.astype(np.int64)
+    else:
+        key = np.where(has_inv, inv_id, -(desc.astype(np.int64) + 1))
+    groups, g = np.unique(key, return_inverse=True)
+    ng = len(groups)
+    s_qty = np.bincount(g, weights=qty, minlength=ng)
+    s_rev = np.bincount(g, weights=rev, minlength=ng)
+    s_cost = np.bincount(g, weights=cost, minlength=ng)
+    n_unknown = np.bincount(g, weights=unknown, minlength=ng)
+    n_labor = np.bincount(g, weights=is_labor, minlength=ng)
+    lines = np.bincount(g, minlength=ng)
+    span = int(order_id.max()) + 1
+    os_count = np.bincount(np.unique(g.astype(np.int64) * span + order_id) // span, minlength=ng)
+
+    inv_names = snap.strings("inventory", "name")
+    descs = snap.strings("order_items", "description")
+    name_pos = snap.lookup("inventory", "id", np.maximum(groups, 0)) if agrupar != "descricao" else None
+    out = []
+    for i in range(ng):
+        k = int(groups[i])
+        if agrupar == "descricao":
+            name, inventory_id = descs[k], None
+        elif k >= 0:
+            p = int(name_pos[i])
+            name, inventory_id = (inv_names[inv["name"][p]] if p >= 0 else f"Item #{k}"), k
+        else:
+            name, inventory_id = descs[-k - 1], None
+        margin = None if n_unknown[i] else float(s_rev[i] - s_cost[i])
+        out.append({
+            "name": name or "(sem descrição)",
+            "inventory_id": inventory_id,
+            "is_labor": bool(n_labor[i] * 2 >= lines[i]),
+            "qty": float(s_qty[i]),
+            "revenue": float(s_rev[i]),
+            "cost": None if n_unknown[i] else float(s_cost[i]),
+            "margin": margin,
+            "margin_pct": (margin / float(s_rev[i]) * 100) if margin is not None and s_rev[i] else None,
+            "os_count": int(os_count[i]),
+            "lines": int(lines[i]),
+        })
+    return out
+
+
+@app.route("/relatorio/itens")
+@login_required
+def relatorio_itens():
+    ym = datetime.date.today().replace(day=1).isoformat()
+    start = _parse_date(request.args.get("start"), ym)
+    end = _parse_date(request.args.get("end"), _today_iso())
+    try:
+        datetime.date.fromisoformat(start)
+        datetime.date.fromisoformat(end)
+    except ValueError:
+        start, end = ym, _today_iso()
+    tipo = request.args.get("tipo") if request.args.get("tipo") in ("pecas", "servicos") else "todos"
+    agrupar = "descricao" if request.args.get("agrupar") == "descricao" else "item"
+    ordem = request.args.get("ordem") if request.args.get("ordem") in REL_ITENS_ORDEM else "receita"
+    q = (request.args.get("q") or "").strip()
+
+    # reordenar/buscar com o mesmo período reaproveita o ranking do snapshot (só recalcula se os dados mudaram)
+    try:
+        snap = colunar_snapshot()
+        rows = snap.memo(("top_items", start, end, tipo, agrupar), lambda: top_items(snap, start, end, tipo, agrupar))
+    except RuntimeError as e:
+        flash(str(e), "error")
+        rows = []
+    if q:
+        qu = q.upper()
+        rows = [r for r in rows if qu in r["name"].upper()]
+    key = REL_ITENS_ORDEM[ordem]
+    rows = sorted(rows, key=lambda r: (r[key] is None, -(r[key] or 0), r["name"]))
+    totals = {
+        "qty": sum(r["qty"] for r in rows),
+        "revenue": sum(r["revenue"] for r in rows),
+        "margin": sum(r["margin"] for r in rows if r["margin"] is not None),
+        "revenue_known": sum(r["revenue"] for r in rows if r["margin"] is not None),
+    }
+
+    if request.args.get("format") == "csv":
+        return _csv_response(
+            f"itens_{start}_{end}.csv",
+            ["item", "estoque_id", "tipo", "qtd", "receita", "custo", "margem", "margem_pct", "os"],
+            [(r["name"], r["inventory_id"] or "", "Serviço" if r["is_labor"] else "Peça", f"{r['qty']:g}",
+              f"{r['revenue']:.2f}", "" if r["cost"] is None else f"{r['cost']:.2f}",
+              "" if r["margin"] is None else f"{r['margin']:.2f}",
+              "" if r["margin_pct"] is None else f"{r['margin_pct']:.1f}", r["os_count"]) for r in rows],
+        )
+    return render_template(
+        "relatorio_itens.html", title="Peças e serviços mais vendidos", rows=rows[:REL_ITENS_LIMITE],
+        n_rows=len(rows), totals=totals, start=start, end=end, tipo=tipo, agrupar=agrupar, ordem=ordem, q=q,
+        limite=REL_ITENS_LIMITE,
+    )
+
+
+
+# --------------------------
+# Tabela dinâmica (pivot) sobre o cache colunar
+# --------------------------
+PIVOT_DIMS = {
+    "mes": "Mês", "mecanico": "Mecânico", "cliente": "Cliente",
+    "pagamento": "Forma de pagamento", "categoria": "Categoria", "item": "Item",
+}
+PIVOT_FONTES = {
+    "os": {"label": "Ordens de serviço", "dims": ("mes", "mecanico", "cliente", "pagamento"),
+           "campos": {"total": "Total da OS", "mao_obra": "Mão de obra", "itens": "Peças e serviços"}},
+    "itens": {"label": "Itens das OS", "dims": ("mes", "mecanico", "cliente", "pagamento", "item"),
+              "campos": {"total": "Valor", "qtd": "Quantidade"}},
+    "financeiro": {"label": "Lançamentos financeiros", "dims": ("mes", "pagamento", "categoria"),
+                   "campos": {"valor": "Valor"}},
+}
+PIVOT_MEDIDAS = {"count": "Contagem", "sum": "Soma", "avg": "Média"}
+PIVOT_SITUACAO = {"efetivado": ("EFETIVADO",), "pendente": ("PENDENTE",), "todos": ("EFETIVADO", "PENDENTE")}
+PIVOT_COLUNAS = 24   # colunas além disso viram "Outros"
+PIVOT_LIMITE = 200   # linhas na tela (JSON/CSV trazem todas)
+
+
+def _month_index(day):
+    """Dias desde 1970-01-01 -> meses desde 1970-01 (vetorizado)."""
+    return day.astype("datetime64[D]").astype("datetime64[M]").astype(np.int64)
+
+
+def _pivot_facts(snap: colunar.Snapshot, fonte: str, d0: int, d1: int, dims: list, campo: str,
+                 fluxo: str = "IN", situacao: str = "efetivado"):
+    """Chaves (int64) de cada dimensão pedida e o valor do campo, só das linhas do filtro."""
+    if fonte == "financeiro":
+        ft = snap.table("fin_transactions")
+        m = (ft["day"] >= d0) & (ft["day"] <= d1) & (ft["ttype"] == snap.code("fin_transactions", "ttype", fluxo))
+        m &= np.isin(ft["status"], [snap.code("fin_transactions", "status", s) for s in PIVOT_SITUACAO[situacao]])
+        cols = {"mes": lambda: _month_index(ft["day"][m]),
+                "pagamento": lambda: ft["payment_method_id"][m],
+                "categoria": lambda: ft["category_id"][m]}
+        return [cols[d]() for d in dims], ft["amount"][m]
+
+    od = snap.table("orders")
+    cancelada = snap.code("orders", "status", "Cancelada")
+    if fonte == "os":
+        m = (od["day"] >= d0) & (od["day"] <= d1) & (od["status"] != cancelada)
+        pos = np.flatnonzero(m)
+        if campo == "mao_obra":
+            values = od["labor"][pos]
+        else:
+            values = _pivot_order_items_total(snap)[pos]
+            if campo == "total":
+                values = values + od["labor"][pos]
+        item_keys = None
+    else:
+        it = snap.table("order_items")
+        opos = _pivot_item_orders(snap)
+        ok = opos >= 0
+        op = np.where(ok, opos, 0)
+        day = od["day"][op] if len(od["day"]) else np.zeros(len(op), dtype=np.int64)
+        sel = ok & (day >= d0) & (day <= d1)
+        if len(od["status"]):
+            sel &= od["status"][op] != cancelada
+        sel = np.flatnonzero(sel)
+        pos = op[sel]
+        values = (it["qty"] if campo == "qtd" else it["total"])[sel]
+        item_keys = lambda: np.where(it["inventory_id"][sel] > 0, it["inventory_id"][sel],
+                                     -(it["description"][sel].astype(np.int64) + 1))
+    cols = {"mes": lambda: _month_index(od["day"][pos]),
+            "mecanico": lambda: od["mechanic_id"][pos],
+            "cliente": lambda: od["client_id"][pos],
+            "pagamento": lambda: od["pay_method"][pos].astype(np.int64),
+            "item": item_keys}
+    return [cols[d]() for d in dims], values
+
+
+def _pivot_item_orders(snap: colunar.Snapshot):
+    """Posição (em orders) da OS de cada item; uma vez por snapshot."""
+    return snap.memo(("pivot", "item_orders"),
+                     lambda: snap.lookup("orders", "id", snap.table("order_items")["order_id"]))
+
+
+def _pivot_order_items_total(snap: colunar.Snapshot):
+    """Soma dos itens de cada OS (na ordem de orders); uma vez por snapshot."""
+    def calc():
+        opos = _pivot_item_orders(snap)
+        ok = opos >= 0
+        return np.bincount(opos[ok], weights=snap.table("order_items")["total"][ok],
+                           minlength=len(snap.table("orders")["id"]))
+    return snap.memo(("pivot", "order_items_total"), calc)
+
+
+def pivot(snap: colunar.Snapshot, fonte: str, linhas: str, colunas: str | None, medida: str, campo: str,
+          start: str, end: str, fluxo: str = "IN", situacao: str = "efetivado") -> dict:
+    """Agrega a fonte por linhas (x colunas) com count/sum/avg do campo, direto nos arrays do snapshot.
+
+    Devolve as chaves (ainda sem nome) de linhas e colunas, a matriz de células e os totais.
+    Colunas além de PIVOT_COLUNAS (as de menor peso) são somadas em "Outros" (chave None)."""
+    d0 = (datetime.date.fromisoformat(start) - _EPOCH).days
+    d1 = (datetime.date.fromisoformat(end) - _EPOCH).days
+    dims = [linhas] + ([colunas] if colunas else [])
+    keys, values = _pivot_facts(snap, fonte, d0, d1, dims, campo, fluxo, situacao)
+    values = values.astype(np.float64)
+
+    row_keys, ri = np.unique(keys[0], return_inverse=True)
+    nr = len(row_keys)
+    if colunas:
+        col_keys, ci = np.unique(keys[1], return_inverse=True)
+        peso = np.bincount(ci, weights=None if medida == "count" else np.abs(values), minlength=len(col_keys))
+        if len(col_keys) > PIVOT_COLUNAS:
+            top = np.sort(np.argsort(-peso, kind="stable")[:PIVOT_COLUNAS])
+            remap = np.full(len(col_keys), PIVOT_COLUNAS, dtype=np.int64)
+            remap[top] = np.arange(PIVOT_COLUNAS)
+            ci = remap[ci]
+            col_keys = [int(k) for k in col_keys[top]] + [None]
+        else:
+            col_keys = [int(k) for k in col_keys]
+    else:
+        col_keys, ci = [], np.zeros(len(ri), dtype=np.int64)
+    nc = max(len(col_keys), 1)
+
+    cell = ri.astype(np.int64) * nc + ci
+    cnt = np.bincount(cell, minlength=nr * nc).reshape(nr, nc)
+    tot = np.bincount(cell, weights=values, minlength=nr * nc).reshape(nr, nc)
+
+    def medir(n, s):  # célula sem registro: 0 na contagem, vazia (NaN -> None) na soma/média
+        if medida == "count":
+            return n.astype(np.float64)
+        return np.where(n > 0, s / np.maximum(n, 1) if medida == "avg" else s, np.nan)
+
+    cells = medir(cnt, tot)
+    row_total = medir(cnt.sum(axis=1), tot.sum(axis=1))
+    col_total = medir(cnt.sum(axis=0), tot.sum(axis=0))
+    grand = medir(np.array(cnt.sum()), np.array(tot.sum()))
+
+    if linhas == "mes":
+        order = np.arange(nr)
+    else:
+        order = np.argsort(-np.nan_to_num(row_total, nan=-np.inf), kind="stable")
+
+    def py(a):
+        a = np.round(a, 2)
+        return [None if x != x else x for x in a.tolist()]
+
+    return {
+        "row_keys": row_keys[order].tolist(),
+        "col_keys": col_keys,
+        "cells": [py(r) for r in cells[order]] if colunas else None,
+        "row_total": py(row_total[order]),
+        "col_total": py(col_total) if colunas else None,
+        "total": py(np.atleast_1d(grand))[0],
+        "linhas_n": int(len(values)),
+    }
+
+
+def _pivot_labels(db, snap: colunar.Snapshot, fonte: str, dim: str, keys: list) -> list[str]:
+    """Nome de cada chave da dimensão (None = "Outros")."""
+    def por_id(sql, vazio):
+        ids = [k for k in keys if k]
+        nomes = {}
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            nomes.update({r[0]: r[1] for r in db.execute(sql.format(",".join("?" * len(chunk))), chunk)})
+        return [None if k is None else nomes.get(k) or (f"#{k}" if k else vazio) for k in keys]
+
+    if dim == "mes":
+        out = [f"{1970 + k // 12}-{k % 12 + 1:02d}" if k is not None else None for k in keys]
+    elif dim == "mecanico":
+        out = por_id("SELECT id, name FROM mechanics WHERE id IN ({})", "Sem mecânico")
+    elif dim == "cliente":
+        out = por_id("SELECT id, name FROM clients WHERE id IN ({})", "Sem cliente")
+    elif dim == "categoria":
+        out = por_id("SELECT id, name FROM fin_categories WHERE id IN ({})", "Sem categoria")
+    elif dim == "pagamento" and fonte == "financeiro":
+        out = por_id("SELECT id, name FROM fin_payment_methods WHERE id IN ({})", "Não informado")
+    elif dim == "pagamento":
+        nomes = snap.strings("orders", "pay_method")
+        out = [(nomes[k] or "Não informado") if k is not None else None for k in keys]
+    else:  # item: id do estoque (> 0) ou -(código da descrição + 1)
+        inv, inv_names = snap.table("inventory"), snap.strings("inventory", "name")
+        descs = snap.strings("order_items", "description")
+        ipos = snap.lookup("inventory", "id", [k if k and k > 0 else 0 for k in keys])
+        out = []
+        for k, p in zip(keys, ipos):
+            if k is None:
+                out.append(None)
+            elif k > 0:
+                out.append(inv_names[inv["name"][p]] if p >= 0 else f"Item #{k}")
+            else:
+                out.append(descs[-k - 1] or "(sem descrição)")
+    return [x if x is not None else "Outros" for x in out]
+
+
+@app.route("/relatorio/pivot")
+@login_required
+def relatorio_pivot():
+    db = get_db()
+    args = request.args
+    fonte = args.get("fonte") if args.get("fonte") in PIVOT_FONTES else "os"
+    spec = PIVOT_FONTES[fonte]
+    linhas = args.get("linhas") if args.get("linhas") in spec["dims"] else "mes"
+    colunas = args.get("colunas") if args.get("colunas") in spec["dims"] and args.get("colunas") != linhas else ""
+    medida = args.get("medida") if args.get("medida") in PIVOT_MEDIDAS else "sum"
+    campo = args.get("campo") if args.get("campo") in spec["campos"] else next(iter(spec["campos"]))
+    fluxo = "OUT" if args.get("fluxo") == "OUT" else "IN"
+    situacao = args.get("situacao") if args.get("situacao") in PIVOT_SITUACAO else "efetivado"
+    ano = datetime.date.today().replace(month=1, day=1).isoformat()
+    start = _parse_date(args.get("start"), ano)
+    end = _parse_date(args.get("end"), _today_iso())
+    try:
+        datetime.date.fromisoformat(start)
+        datetime.date.fromisoformat(end)
+    except ValueError:
+        start, end = ano, _today_iso()
+
+    params = dict(fonte=fonte, linhas=linhas, colunas=colunas, medida=medida, campo=campo,
+                  start=start, end=end, fluxo=fluxo, situacao=situacao)
+    res = None
+    try:
+        snap = colunar_snapshot()
+        res = snap.memo(("pivot",) + tuple(sorted(params.items())),
+                        lambda: pivot(snap, fonte, linhas, colunas or None, medida, campo, start, end, fluxo, situacao))
+        row_labels = _pivot_labels(db, snap, fonte, linhas, res["row_keys"])
+        col_labels = _pivot_labels(db, snap, fonte, colunas, res["col_keys"]) if colunas else []
+    except RuntimeError as e:
+        flash(str(e), "error")
+
+    fmt = args.get("format")
+    if fmt == "json":
+        if res is None:
+            return jsonify({"error": "numpy não está instalado"}), 503
+        return jsonify(dict(params, linhas_n=res["linhas_n"], total=res["total"], colunas_labels=col_labels,
+                            colunas_total=res["col_total"],
+                            rows=[{"key": k, "label": lb, "total": t, "cells": res["cells"][i] if colunas else None}
+                                  for i, (k, lb, t) in enumerate(zip(res["row_keys"], row_labels, res["row_total"]))]))
+    if fmt == "csv" and res is not None:
+        fnum = (lambda v: "" if v is None else f"{v:g}") if medida == "count" else (lambda v: "" if v is None else f"{v:.2f}")
+        return _csv_response(
+            f"pivot_{fonte}_{linhas}{'_' + colunas if colunas else ''}_{start}_{end}.csv",
+            [PIVOT_DIMS[linhas]] + col_labels + ["Total"],
+            [[lb] + ([fnum(v) for v in res["cells"][i]] if colunas else []) + [fnum(res["row_total"][i])]
+             for i, lb in enumerate(row_labels)],
+        )
+
+    rows = []
+    if res is not None:
+        for i, lb in enumerate(row_labels[:PIVOT_LIMITE]):
+            rows.append({"label": lb, "cells": res["cells"][i] if colunas else [], "total": res["row_total"][i]})
+    return render_template(
+        "relatorio_pivot.html", title="Tabela dinâmica", res=res, rows=rows,
+        col_labels=col_labels if res is not None else [], n_rows=len(res["row_keys"]) if res else 0,
+        fontes=PIVOT_FONTES, dims=PIVOT_DIMS, medidas=PIVOT_MEDIDAS, spec=spec, **params,
+    )
+
+
+# --------------------------
+# Agenda: duração, conflito de horário e capacidade por mecânico
+# --------------------------
+AGENDA_DURACAO_PADRAO = 60                      # minutos
+AGENDA_DURACOES = (30, 60, 90, 120, 180, 240)   # opções do formulário
+AGENDA_DURACAO_MAX = 480                        # maior duração aceita (limita a busca de conflitos no índice)
+AGENDA_INICIO = "08:00"                         # expediente usado na grade e nos horários livres
+AGENDA_FIM = "18:00"
+AGENDA_SLOT = 60                                # minutos por coluna da grade / passo dos horários livres
+AGENDA_LIVRES_MAX_DIAS = 31
+
+
+def _hm_to_min(hm: str) -> int:
+    """'HH:MM' (ou 'HH:MM:SS') -> minutos desde 00:00; ValueError se inválido."""
+    h, m = (hm or "").split(":")[:2]
+    h, m = int(h), int(m)
+    if not (0 <= h < 24 and 0 <= m < 60):
+        raise ValueError(hm)
+    return h * 60 + m
+
+
+def _min_to_hm(minutos: int) -> str:
+    return f"{minutos // 60:02d}:{minutos % 60:02d}"
+
+
+def _agenda_duracao(raw) -> int:
+    try:
+        d = int(raw)
+    except (TypeError, ValueError):
+        return AGENDA_DURACAO_PADRAO
+    return max(15, min(d, AGENDA_DURACAO_MAX))
+
+
+def agenda_conflicts(db, mechanic_id: int, date: str, time_h: str, duration: int, ignore_id: int | None = None) -> list:
+    """Agendamentos do mecânico no dia que se sobrepõem a [time_h, time_h + duration).
+
+    Só olha o trecho do índice idx_agenda_mech_date que pode colidir: quem começa antes do fim
+    do novo horário e no máximo AGENDA_DURACAO_MAX minutos antes do início dele."""
+    ini = _hm_to_min(time_h)
+    fim = ini + duration
+    rows = db.execute(
+        """SELECT a.id, a.time, a.duration_min, c.name AS client_name
+             FROM agenda a JOIN clients c ON c.id = a.client_id
+            WHERE a.mechanic_id = ? AND a.date = ? AND a.time >= ? AND a.time < ?""",
+        (mechanic_id, date, _min_to_hm(max(0, ini - AGENDA_DURACAO_MAX)), _min_to_hm(fim) if fim < 1440 else "24:00"),
+    ).fetchall()
+    return [
+        r for r in rows
+        if r["id"] != ignore_id and _hm_to_min(r["time"]) + (r["duration_min"] or AGENDA_DURACAO_PADRAO) > ini
+    ]
+
+
+def _agenda_ocupacao(db, start: str, end: str, mechanic_id: int | None = None) -> dict:
+    """(mechanic_id, date) -> [(início, fim, agendamento)] em minutos, numa consulta por intervalo de datas."""
+    sql = """SELECT a.id, a.mechanic_id, a.date, a.time, a.duration_min, c.name AS client_name, v.plate
+               FROM agenda a
+               JOIN clients c ON c.id = a.client_id
+               LEFT JOIN vehicles v ON v.id = a.vehicle_id
+              WHERE a.date BETWEEN ? AND ? AND a.mechanic_id IS NOT NULL"""
+    params = [start, end]
+    if mechanic_id:
+        sql += " AND a.mechanic_id = ?"
+        params.append(mechanic_id)
+    out = {}
+    for r in db.execute(sql + " ORDER BY a.date, a.time", params):
+        try:
+            ini = _hm_to_min(r["time"])
+        except ValueError:
+            continue
+        out.setdefault((r["mechanic_id"], r["date"]), []).append(
+            (ini, ini + (r["duration_min"] or AGENDA_DURACAO_PADRAO), r))
+    return out
+
+
+def agenda_free_slots(db, mechanic_id: int, start: datetime.date, end: datetime.date,
+                      duration: int = AGENDA_DURACAO_PADRAO) -> list[dict]:
+    """Inícios (a cada AGENDA_SLOT min, dentro do expediente) em que cabem `duration` minutos livres,
+    por dia de [start, end]. Hoje só a partir de agora."""
+    ocup = _agenda_ocupacao(db, start.isoformat(), end.isoformat(), mechanic_id)
+    ini_exp, fim_exp = _hm_to_min(AGENDA_INICIO), _hm_to_min(AGENDA_FIM)
+    agora = datetime.datetime.now()
+    dias = []
+    d = start
+    while d <= end:
+        iso = d.isoformat()
+        busy = ocup.get((mechanic_id, iso), [])
+        primeiro = ini_exp
+        if d == agora.date():
+            primeiro = max(ini_exp, -(-(agora.hour * 60 + agora.minute - ini_exp) // AGENDA_SLOT) * AGENDA_SLOT + ini_exp)
+        livres = [
+            _min_to_hm(t) for t in range(primeiro, fim_exp - duration + 1, AGENDA_SLOT)
+            if all(t + duration <= b_ini or t >= b_fim for b_ini, b_fim, _ in busy)
+        ] if d >= agora.date() else []
+        dias.append({"date": iso, "free": livres})
+        d += datetime.timedelta(days=1)
+    return dias
+
+
 @login_required
 @app.route("/agenda", methods=["GET", "POST"])
 def agenda():
@@ -1479,17 +3386,45 @@ def agenda():
         date = request.form.get("date")
         time_h = request.form.get("time")
         notes = request.form.get("notes", "").strip()
+        duration = _agenda_duracao(request.form.get("duration_min"))
 
         if not client_id or not date or not time_h:
             flash("Selecione o cliente, data e horário!", "error")
             return redirect(url_for("agenda"))
+        try:
+            datetime.date.fromisoformat(date)
+            time_h = _min_to_hm(_hm_to_min(time_h))  # sempre HH:MM (o índice compara texto)
+        except ValueError:
+            flash("Data ou horário inválido.", "error")
+            return redirect(url_for("agenda"))
+        if _hm_to_min(time_h) + duration > 24 * 60:
+            flash("O agendamento não pode passar da meia-noite.", "error")
+            return redirect(url_for("agenda", view="dia", date=date))
+        if vehicle_id and not db.execute(
+            "SELECT 1 FROM vehicles WHERE id=? AND client_id=?", (vehicle_id, client_id)
+        ).fetchone():
+            flash("O veículo escolhido não é desse cliente.", "error")
+            return redirect(url_for("agenda"))
 
         created_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+        if mechanic_id:
+            # IMMEDIATE: checagem e INSERT sob o mesmo lock de escrita (dois cadastros simultâneos não
+            # pegam o mesmo horário)
+            if not db.in_transaction:
+                db.execute("BEGIN IMMEDIATE")
+            conflitos = agenda_conflicts(db, mechanic_id, date, time_h, duration)
+            if conflitos:
+                db.rollback()
+                c0 = conflitos[0]
+                fim = _min_to_hm(_hm_to_min(c0["time"]) + (c0["duration_min"] or AGENDA_DURACAO_PADRAO))
+                flash(f"Conflito: o mecânico já tem {c0['client_name']} das {c0['time']} às {fim} nesse dia.", "error")
+                return redirect(url_for("agenda_capacidade", date=date))
+
         db.execute(
-            """INSERT INTO agenda(client_id, vehicle_id, mechanic_id, date, time, notes, created_at)
-               VALUES (?,?,?,?,?,?,?)""",
-            (client_id, vehicle_id, mechanic_id, date, time_h, notes, created_at)
+            """INSERT INTO agenda(client_id, vehicle_id, mechanic_id, date, time, notes, created_at, duration_min)
+               VALUES (?,?,?,?,?,?,?,?)""",
+            (client_id, vehicle_id, mechanic_id, date, time_h, notes, created_at, duration)
         )
         db.commit()
         flash("Agendamento criado!", "ok")
@@ -1523,7 +3458,8 @@ def agenda():
     end_s = end.strftime("%Y-%m-%d")
 
     rows = db.execute(
-        """SELECT a.*, c.name AS client_name, v.plate, v.model, m.name AS mech
+        """SELECT a.*, c.name AS client_name, v.plate, v.model, m.name AS mech,
+                  substr(time(a.time, '+' || a.duration_min || ' minutes'), 1, 5) AS time_end
            FROM agenda a
            JOIN clients c ON c.id = a.client_id
            LEFT JOIN vehicles v ON v.id = a.vehicle_id
@@ -1533,13 +3469,7 @@ def agenda():
         (start_s, end_s)
     ).fetchall()
 
-    clients = db.execute("SELECT id, name FROM clients ORDER BY name").fetchall()
-    vehicles = db.execute(
-        """SELECT v.id, v.plate, v.model, c.name AS client_name
-           FROM vehicles v
-           JOIN clients c ON c.id = v.client_id
-           ORDER BY v.id DESC"""
-    ).fetchall()
+    # cliente/veículo do formulário vêm sob demanda de /api/clients_search e /api/vehicles_search
     mechs = db.execute("SELECT id, name FROM mechanics ORDER BY name").fetchall()
 
     # montar lista de dias (para o modo semana)
@@ -1556,9 +3486,9 @@ def agenda():
     return render_template(
         "agenda.html",
         rows=rows,
-        clients=clients,
-        vehicles=vehicles,
         mechs=mechs,
+        duracoes=AGENDA_DURACOES,
+        duracao_padrao=AGENDA_DURACAO_PADRAO,
         view=view,
         ref_date=ref_date,
         start=start,
@@ -1568,6 +3498,78 @@ def agenda():
     )
 
 
+@app.route("/agenda/capacidade")
+@login_required
+def agenda_capacidade():
+    """Grade mecânicos x dias da semana x faixas de horário, montada com uma consulta da semana."""
+    db = get_db()
+    try:
+        ref_date = datetime.date.fromisoformat(request.args.get("date") or _today_iso())
+    except ValueError:
+        ref_date = datetime.date.today()
+    start = ref_date - datetime.timedelta(days=ref_date.weekday())
+    days = [start + datetime.timedelta(days=i) for i in range(7)]
+    ocup = _agenda_ocupacao(db, days[0].isoformat(), days[-1].isoformat())
+    mechs = db.execute("SELECT id, name FROM mechanics ORDER BY name").fetchall()
+
+    ini_exp, fim_exp = _hm_to_min(AGENDA_INICIO), _hm_to_min(AGENDA_FIM)
+    slots = list(range(ini_exp, fim_exp, AGENDA_SLOT))
+    capacidade = fim_exp - ini_exp
+    grid = []
+    for m in mechs:
+        linha = {"mech": m, "days": []}
+        for d in days:
+            busy = ocup.get((m["id"], d.isoformat()), [])
+            cells = []
+            for s in slots:
+                e = s + AGENDA_SLOT
+                ags = [r for b_ini, b_fim, r in busy if b_ini < e and b_fim > s]
+                usado = sum(max(0, min(b_fim, e) - max(b_ini, s)) for b_ini, b_fim, _ in busy)
+                cells.append({
+                    "hm": _min_to_hm(s), "pct": round(usado * 100 / AGENDA_SLOT),
+                    "title": ", ".join(f"{r['time']} {r['client_name']}" + (f" ({r['plate']})" if r["plate"] else "") for r in ags),
+                })
+            ocupado = sum(min(b_fim, fim_exp) - max(b_ini, ini_exp) for b_ini, b_fim, _ in busy if b_fim > ini_exp and b_ini < fim_exp)
+            linha["days"].append({
+                "date": d.isoformat(), "cells": cells, "n": len(busy),
+                "horas": ocupado / 60, "pct": round(ocupado * 100 / capacidade) if capacidade else 0,
+            })
+        grid.append(linha)
+
+    return render_template(
+        "agenda_capacidade.html", title="Capacidade da agenda", grid=grid, days=days,
+        slots=[_min_to_hm(s) for s in slots], capacidade_h=capacidade / 60,
+        inicio=AGENDA_INICIO, fim=AGENDA_FIM, slot_min=AGENDA_SLOT,
+        prev=(start - datetime.timedelta(days=7)).isoformat(), next=(start + datetime.timedelta(days=7)).isoformat(),
+        today=_today_iso(),
+    )
+
+
+@app.route("/api/agenda/livres")
+@login_required
+def api_agenda_livres():
+    """Horários livres de um mecânico: ?mechanic_id=&start=&end=&duracao= (minutos)."""
+    db = get_db()
+    mechanic_id = request.args.get("mechanic_id", type=int)
+    if not mechanic_id or not db.execute("SELECT 1 FROM mechanics WHERE id=?", (mechanic_id,)).fetchone():
+        return jsonify({"ok": False, "error": "mecânico não encontrado"}), 400
+    try:
+        start = datetime.date.fromisoformat(request.args.get("start") or _today_iso())
+        end = datetime.date.fromisoformat(request.args.get("end") or start.isoformat())
+    except ValueError:
+        return jsonify({"ok": False, "error": "data inválida (use AAAA-MM-DD)"}), 400
+    if end < start or (end - start).days >= AGENDA_LIVRES_MAX_DIAS:
+        return jsonify({"ok": False, "error": f"intervalo de 1 a {AGENDA_LIVRES_MAX_DIAS} dias"}), 400
+    duration = _agenda_duracao(request.args.get("duracao"))
+    return jsonify({
+        "ok": True,
+        "mechanic_id": mechanic_id,
+        "duration_min": duration,
+        "expediente": [AGENDA_INICIO, AGENDA_FIM],
+        "days": agenda_free_slots(db, mechanic_id, start, end, duration),
+    })
+
+
 @login_required
 @app.route("/agenda/<int:aid>/whatsapp")
 def enviar_whatsapp_agenda(aid):
@@ -1616,6 +3618,241 @@ def enviar_whatsapp_agenda(aid):
     return redirect(wa_url)
 
 
+# --------------------------
+# Revisões previstas (serviços recorrentes por veículo)
+# --------------------------
+SERVICE_DUE_MIN_INTERVALO = 30    # dias; repetições mais próximas que isso não contam como recorrência
+SERVICE_DUE_MAX_INTERVALO = 730
+SERVICE_DUE_ATRASO_MAX = 60       # vencidas há mais que isso saem da lista (cliente provavelmente sumiu)
+SERVICE_DUE_HORA = "08:00"
+_EPOCH = datetime.date(1970, 1, 1)
+
+
+def mark_service_due(db, vehicle_ids) -> None:
+    """Marca veículos para recálculo das revisões previstas (barato, vai junto na escrita da OS)."""
+    db.executemany(
+        "INSERT OR IGNORE INTO service_due_dirty(vehicle_id) VALUES (?)",
+        [(int(v),) for v in {v for v in vehicle_ids if v}],
+    )
+
+
+def refresh_service_due(db, vehicle_ids=None) -> int:
+    """Recalcula service_due (sem commit). vehicle_ids=None refaz a frota toda.
+
+    Uma consulta traz (veículo, item, dia) de todas as OS não canceladas; o resto é vetorizado
+    com numpy sobre todos os veículos de uma vez: intervalos entre dias consecutivos do mesmo
+    (veículo, item), mediana por grupo (lexsort) e próxima data = último dia + mediana.
+    Só entram itens feitos em 2+ dias com mediana entre SERVICE_DUE_MIN_INTERVALO e _MAX_INTERVALO.
+    O agendamento já criado (agenda_id) é mantido enquanto o serviço não for refeito."""
+    if np is None:
+        raise RuntimeError("numpy não está instalado (pip install numpy).")
+    where, params = "", []
+    if vehicle_ids is not None:
+        ids = sorted({int(v) for v in vehicle_ids if v})
+        if not ids:
+            return 0
+        where = f"AND o.vehicle_id IN ({','.join('?' * len(ids))})"
+        params = ids
+    rows = db.execute(
+        f"""
+        SELECT o.vehicle_id,
+               COALESCE('I' || oi.inventory_id, 'D' || UPPER(TRIM(oi.description))) AS k,
+               MAX(COALESCE(inv.name, oi.description)) AS item,
+               CAST(julianday(substr(o.created_at, 1, 10)) - 2440587.5 AS INTEGER) AS d,
+               MAX(o.id) AS os_id
+          FROM orders o
+          JOIN order_items oi ON oi.order_id = o.id
+          LEFT JOIN inventory inv ON inv.id = oi.inventory_id
+         WHERE o.vehicle_id IS NOT NULL AND o.status <> 'Cancelada' AND o.created_at IS NOT NULL {where}
+         GROUP BY o.vehicle_id, k, d
+         ORDER BY o.vehicle_id, k, d
+        """,
+        params,
+    ).fetchall()
+
+    now = _now_iso()
+    out = []
+    if rows:
+        n = len(rows)
+        veh = np.fromiter((r["vehicle_id"] for r in rows), dtype=np.int64, count=n)
+        codes: dict[str, int] = {}
+        key = np.fromiter((codes.setdefault(r["k"], len(codes)) for r in rows), dtype=np.int64, count=n)
+        day = np.fromiter((r["d"] for r in rows), dtype=np.int64, count=n)
+
+        start = np.ones(n, dtype=bool)
+        start[1:] = (veh[1:] != veh[:-1]) | (key[1:] != key[:-1])
+        gid = np.cumsum(start) - 1
+        ng = int(gid[-1]) + 1
+        first = np.flatnonzero(start)
+        last = np.append(first[1:] - 1, n - 1)
+        count = last - first + 1
+
+        # intervalos dentro do grupo, ordenados por (grupo, intervalo) -> mediana por posição
+        same = ~start[1:]
+        dg = gid[1:][same]
+        dv = (day[1:] - day[:-1])[same]
+        order = np.lexsort((dv, dg))
+        dg, dv = dg[order], dv[order]
+        dcount = np.bincount(dg, minlength=ng)
+        dstart = np.concatenate(([0], np.cumsum(dcount)[:-1]))
+        median = np.zeros(ng, dtype=np.float64)
+        has = dcount > 0
+        lo = dstart[has] + (dcount[has] - 1) // 2
+        hi = dstart[has] + dcount[has] // 2
+        median[has] = (dv[lo] + dv[hi]) / 2.0
+
+        interval = np.rint(median).astype(np.int64)
+        keep = (count >= 2) & (interval >= SERVICE_DUE_MIN_INTERVALO) & (interval <= SERVICE_DUE_MAX_INTERVALO)
+        due = day[last] + interval
+        for grp in np.flatnonzero(keep).tolist():
+            r = rows[int(last[grp])]
+            out.append((
+                r["vehicle_id"], r["k"], r["item"], int(count[grp]),
+                (_EPOCH + datetime.timedelta(days=int(day[last[grp]]))).isoformat(), r["os_id"], int(interval[grp]),
+                (_EPOCH + datetime.timedelta(days=int(due[grp]))).isoformat(), now,
+            ))
+
+    # apaga e regrava os veículos recalculados: o que não saiu neste cálculo deixou de ser recorrente
+    # (ou a OS foi apagada/desvinculada); o agendamento só é mantido se o último dia não mudou
+    if vehicle_ids is None:
+        in_ids, id_params = "", []
+    else:
+        in_ids, id_params = f"WHERE vehicle_id IN ({','.join('?' * len(ids))})", ids
+    agendados = {
+        (r["vehicle_id"], r["item_key"], r["last_date"]): r["agenda_id"]
+        for r in db.execute(
+            f"SELECT vehicle_id, item_key, last_date, agenda_id FROM service_due {in_ids} "
+            f"{'AND' if in_ids else 'WHERE'} agenda_id IS NOT NULL",
+            id_params,
+        ).fetchall()
+    }
+    db.execute(f"DELETE FROM service_due {in_ids}", id_params)
+    db.execute(f"DELETE FROM service_due_dirty {in_ids}", id_params)
+    db.executemany(
+        """
+        INSERT INTO service_due(vehicle_id, item_key, item, occurrences, last_date, last_os_id,
+                                interval_days, due_date, updated_at, agenda_id)
+        VALUES (?,?,?,?,?,?,?,?,?,?)
+        """,
+        [o + (agendados.get((o[0], o[1], o[4])),) for o in out],
+    )
+    return len(out)
+
+
+def refresh_service_due_dirty(db) -> int:
+    """Recalcula só os veículos marcados por mark_service_due (uma passada para todos eles)."""
+    ids = [r[0] for r in db.execute("SELECT vehicle_id FROM service_due_dirty").fetchall()]
+    return refresh_service_due(db, ids) if ids else 0
+
+
+@app.cli.command("revisoes")
+def _cli_revisoes():
+    """Refaz as revisões previstas (service_due) da frota toda."""
+    db = get_db()
+    n = refresh_service_due(db)
+    db.commit()
+    print(f"Revisões previstas recalculadas: {n} serviços recorrentes")
+
+
+@app.route("/agenda/revisoes", methods=["GET", "POST"])
+@login_required
+def agenda_revisoes():
+    db = get_db()
+    if request.method == "POST":
+        vehicle_ids = [int(v) for v in request.form.getlist("vehicle_id") if v.isdigit()]
+        time_h = request.form.get("time") or SERVICE_DUE_HORA
+        try:
+            time_h = _min_to_hm(_hm_to_min(time_h))
+        except ValueError:
+            time_h = SERVICE_DUE_HORA
+        mechanic_id = request.form.get("mechanic_id", type=int)
+        duration = _agenda_duracao(request.form.get("duration_min"))
+        today = _today_iso()
+        # mesma janela da listagem: vencidas há mais de SERVICE_DUE_ATRASO_MAX dias não são agendadas
+        desde = (datetime.date.today() - datetime.timedelta(days=SERVICE_DUE_ATRASO_MAX)).isoformat()
+        created = sem_horario = 0
+        if mechanic_id and not db.in_transaction:
+            db.execute("BEGIN IMMEDIATE")  # horários livres lidos e ocupados sob o mesmo lock
+        for vid in vehicle_ids:
+            due = db.execute(
+                """SELECT sd.item_key, sd.item, sd.interval_days, sd.due_date, v.client_id
+                     FROM service_due sd JOIN vehicles v ON v.id = sd.vehicle_id
+                    WHERE sd.vehicle_id = ? AND sd.agenda_id IS NULL AND sd.due_date BETWEEN ? AND ?""",
+                (vid, desde, request.form.get("ate") or today),
+            ).fetchall()
+            if not due:
+                continue
+            notes = "Revisão prevista: " + ", ".join(f"{d['item']} (a cada ~{d['interval_days']} dias)" for d in due)
+            date = max(today, min(d["due_date"] for d in due))
+            slot = time_h
+            if mechanic_id and agenda_conflicts(db, mechanic_id, date, slot, duration):
+                # mesmo mecânico para vários veículos: vai para o próximo horário livre do dia
+                dia = datetime.date.fromisoformat(date)
+                livres = agenda_free_slots(db, mechanic_id, dia, dia, duration)[0]["free"]
+                slot = next((t for t in livres if t > time_h), None)
+                if slot is None:
+                    sem_horario += 1
+                    continue
+            cur = db.execute(
+                """INSERT INTO agenda(client_id, vehicle_id, mechanic_id, date, time, notes, created_at, duration_min)
+                   VALUES (?,?,?,?,?,?,?,?)""",
+                (due[0]["client_id"], vid, mechanic_id, date, slot, notes, _now_iso(), duration),
+            )
+            db.executemany(
+                "UPDATE service_due SET agenda_id = ? WHERE vehicle_id = ? AND item_key = ?",
+                [(cur.lastrowid, vid, d["item_key"]) for d in due],
+            )
+            created += 1
+        db.commit()
+        flash(f"{created} agendamento(s) criado(s).", "ok")
+        if sem_horario:
+            flash(f"{sem_horario} veículo(s) sem horário livre do mecânico no dia; agende à mão.", "error")
+        return redirect(url_for("agenda_revisoes", dias=request.form.get("dias")))
+
+    try:
+        dias = max(0, min(90, int(request.args.get("dias") or 7)))
+    except ValueError:
+        dias = 7
+    try:
+        refresh_service_due_dirty(db)
+        db.commit()
+    except RuntimeError as e:
+        flash(str(e), "error")
+    today = datetime.date.today()
+    ate = (today + datetime.timedelta(days=dias)).isoformat()
+    rows = db.execute(
+        """
+        SELECT sd.*, v.plate, v.model, v.client_id, c.name AS client_name, c.phone,
+               a.date AS agenda_date, a.time AS agenda_time
+          FROM service_due sd
+          JOIN vehicles v ON v.id = sd.vehicle_id
+          JOIN clients c ON c.id = v.client_id
+          LEFT JOIN agenda a ON a.id = sd.agenda_id
+         WHERE sd.due_date BETWEEN ? AND ?
+         ORDER BY sd.due_date, sd.vehicle_id
+        """,
+        ((today - datetime.timedelta(days=SERVICE_DUE_ATRASO_MAX)).isoformat(), ate),
+    ).fetchall()
+    # uma linha por veículo (vários serviços podem vencer juntos)
+    vehicles: dict[int, dict] = {}
+    for r in rows:
+        v = vehicles.setdefault(r["vehicle_id"], {
+            "vehicle_id": r["vehicle_id"], "plate": r["plate"], "model": r["model"], "client_id": r["client_id"],
+            "client_name": r["client_name"], "phone": r["phone"], "due_date": r["due_date"], "items": [],
+            "pending": 0,
+        })
+        v["items"].append(r)
+        v["pending"] += r["agenda_id"] is None
+    if request.args.get("format") == "json":
+        return jsonify([{**v, "items": [dict(i) for i in v["items"]]} for v in vehicles.values()])
+    mechs = db.execute("SELECT id, name FROM mechanics ORDER BY name").fetchall()
+    return render_template(
+        "agenda_revisoes.html", rows=list(vehicles.values()), mechs=mechs, dias=dias, ate=ate,
+        duracoes=AGENDA_DURACOES, duracao_padrao=AGENDA_DURACAO_PADRAO,
+        today=today.isoformat(), hora=SERVICE_DUE_HORA, title="Revisões previstas",
+    )
+
+
 
 @login_required
 @app.route("/os/<int:os_id>/editar", methods=["GET","POST"])
@@ -1787,19 +4024,27 @@ def os_edit(os_id):
                 ],
             )
 
-        # --- sync financeiro (OS -> lançamento + detalhamento)
-        try:
-            sync_os_to_finance(db, os_id, o.get("client_name"), status, pay_method, pay_status, base_labor, items)
-        except Exception:
-            pass
+        # --- financeiro: evento no outbox (mesma transação); o worker gera o lançamento + detalhamento
+        enqueue_os_finance(db, os_id)
 
-        
-        # aplica (ou desfaz) estoque conforme status (FECHADA baixa; caso contrário devolve)
+        # aplica (ou desfaz) estoque conforme status (FECHADA baixa; caso contrário devolve).
+        # Se a baixa falhar, desfaz a edição inteira: liberar a reserva sem baixar deixaria a OS sem as peças
         try:
-            reconcile_os_stock(db, os_id, status, items)
-        except Exception:
-            pass
+            ok, faltas = reconcile_os_stock(db, os_id, status, items)
+        except Exception as e:
+            ok, faltas = False, [{"name": str(e)}]
+        if not ok:
+            db.rollback()
+            flash("Não foi possível atualizar o estoque da OS; nada foi salvo. "
+                  + "; ".join(f["name"] for f in faltas), "error")
+            return redirect(url_for("os_edit", os_id=os_id))
+        reconcile_os_reservations(db, os_id, status, items)
+        refresh_mechanic_daily_stats(db, [o["created_at"]])
+        invalidate_commissions(db, [o["created_at"]])
+        refresh_client_stats(db, [o["client_id"]])
+        mark_service_due(db, [o["vehicle_id"], vehicle_id])
         db.commit()
+        notify_fin_outbox()
         flash("OS atualizada com sucesso!", "ok")
         return redirect(url_for("os_view", os_id=os_id))
 
@@ -1834,12 +4079,20 @@ def os_delete(os_id):
         "SELECT inventory_id, qty FROM os_stock_applied WHERE os_id=?",
         (os_id,),
     ).fetchall()
-    for it in applied:
-        db.execute("UPDATE inventory SET stock = stock + ? WHERE id=?", (it["qty"], it["inventory_id"]))
+    ledger.record_movements(
+        db, [(it["inventory_id"], float(it["qty"] or 0)) for it in applied], ledger.OS_EXCLUIDA, "OS", os_id
+    )
     db.execute("DELETE FROM os_stock_applied WHERE os_id=?", (os_id,))
+    reconcile_os_reservations(db, os_id, "Cancelada", [])
 
+    created = db.execute("SELECT created_at, client_id, vehicle_id FROM orders WHERE id=?", (os_id,)).fetchone()
     db.execute("DELETE FROM order_items WHERE order_id=?", (os_id,))
     db.execute("DELETE FROM orders WHERE id=?", (os_id,))
+    if created:
+        refresh_mechanic_daily_stats(db, [created["created_at"]])
+        invalidate_commissions(db, [created["created_at"]])
+        refresh_client_stats(db, [created["client_id"]])
+        mark_service_due(db, [created["vehicle_id"]])
     db.commit()
     flash(f"OS #{os_id} excluída.", "ok")
     next_url = request.form.get("next") or url_for("os_list")
@@ -1896,8 +4149,8 @@ def _get_method_id(db, name: str) -> int|None:
     row = db.execute("SELECT id FROM fin_payment_methods WHERE name = ?", (name,)).fetchone()
     if row:
         return int(row["id"])
+    # sem commit aqui: quem chama fecha a transação (OS, compra, worker do outbox)
     db.execute("INSERT OR IGNORE INTO fin_payment_methods(name) VALUES (?)", (name,))
-    db.commit()
     row = db.execute("SELECT id FROM fin_payment_methods WHERE name = ?", (name,)).fetchone()
     return int(row["id"]) if row else None
 
@@ -1908,17 +4161,19 @@ def _get_category_id(db, name: str) -> int|None:
     if row:
         return int(row["id"])
     db.execute("INSERT OR IGNORE INTO fin_categories(name, kind) VALUES (?, 'both')", (name,))
-    db.commit()
     row = db.execute("SELECT id FROM fin_categories WHERE name = ?", (name,)).fetchone()
     return int(row["id"]) if row else None
 
+_PAY_EFETIVADO = ("efetivado", "pago", "paga", "feito", "recebido", "recebida")
+_PAY_CANCELADO = ("cancelado", "cancelada")
+
 def _tx_status_from_pay(pay_status: str, os_status: str|None=None) -> str:
     s = (pay_status or "").strip().lower()
     if os_status and os_status.strip().lower() == "cancelada":
         return "CANCELADO"
-    if s in ["efetivado", "pago", "paga", "feito", "recebido", "recebida"]:
+    if s in _PAY_EFETIVADO:
         return "EFETIVADO"
-    if s in ["cancelado", "cancelada"]:
+    if s in _PAY_CANCELADO:
         return "CANCELADO"
     return "PENDENTE"
 
@@ -2015,16 +4270,75 @@ def reconcile_os_stock(db, os_id: int, os_status: str, items: list) -> tuple[boo
     if faltas:
         return False, faltas
 
-    # aplica deltas (pode ser negativo = devolver)
-    for inv_id in keys:
-        d = float(desired.get(inv_id, 0.0) - applied.get(inv_id, 0.0))
-        if d > 0:
-            db.execute("UPDATE inventory SET stock = stock - ? WHERE id = ?", (d, inv_id))
-        elif d < 0:
-            db.execute("UPDATE inventory SET stock = stock + ? WHERE id = ?", (-d, inv_id))
+    # aplica deltas (positivo = baixa, negativo = devolver)
+    ledger.record_movements(
+        db,
+        [(inv_id, -float(desired.get(inv_id, 0.0) - applied.get(inv_id, 0.0))) for inv_id in keys],
+        ledger.OS, "OS", os_id,
+    )
 
     _set_os_applied_parts(db, os_id, desired)
     return True, []
+
+
+# --- reservas de peças (OS aberta segura a peça até fechar/cancelar) ---
+# inventory.reserved guarda o total reservado por item e é mantido aqui a cada escrita,
+# então "disponível = stock - reserved" é uma leitura só, sem somar as OS abertas.
+
+def _is_os_reserving(status: str | None) -> bool:
+    s = (status or "").strip().lower()
+    return not _is_os_closed(status) and s not in ("cancelada", "cancelado")
+
+def reconcile_os_reservations(db, os_id: int, os_status: str, items: list) -> None:
+    """Ajusta a reserva da OS: aberta reserva as peças dos itens; fechada/cancelada libera tudo."""
+    desired = _desired_parts_from_items(items) if _is_os_reserving(os_status) else {}
+    current = {
+        int(r["inventory_id"]): float(r["qty"] or 0)
+        for r in db.execute("SELECT inventory_id, qty FROM os_stock_reserved WHERE os_id = ?", (os_id,)).fetchall()
+    }
+    deltas = [
+        (float(desired.get(inv_id, 0.0) - current.get(inv_id, 0.0)), inv_id)
+        for inv_id in set(desired) | set(current)
+    ]
+    deltas = [(d, inv_id) for d, inv_id in deltas if abs(d) > 1e-9]
+    if not deltas:
+        return
+    db.executemany("UPDATE inventory SET reserved = MAX(reserved + ?, 0) WHERE id = ?", deltas)
+    db.execute("DELETE FROM os_stock_reserved WHERE os_id = ?", (os_id,))
+    now = _now_iso()
+    db.executemany(
+        "INSERT INTO os_stock_reserved(os_id, inventory_id, qty, updated_at) VALUES (?,?,?,?)",
+        [(os_id, inv_id, qty, now) for inv_id, qty in desired.items() if qty > 0],
+    )
+
+def rebuild_os_reservations(db) -> int:
+    """Refaz todas as reservas a partir das OS abertas (migração / correção). Não faz commit."""
+    db.execute("DELETE FROM os_stock_reserved")
+    rows = db.execute(
+        """
+        SELECT o.id, o.status, oi.inventory_id, SUM(oi.qty) AS qty
+          FROM orders o
+          JOIN order_items oi ON oi.order_id = o.id
+         WHERE oi.inventory_id IS NOT NULL AND COALESCE(oi.is_labor, 0) = 0
+         GROUP BY o.id, oi.inventory_id
+        """
+    ).fetchall()
+    now = _now_iso()
+    db.executemany(
+        "INSERT INTO os_stock_reserved(os_id, inventory_id, qty, updated_at) VALUES (?,?,?,?)",
+        [
+            (r["id"], r["inventory_id"], float(r["qty"]), now)
+            for r in rows
+            if _is_os_reserving(r["status"]) and float(r["qty"] or 0) > 0
+        ],
+    )
+    db.execute(
+        """
+        UPDATE inventory
+           SET reserved = COALESCE((SELECT SUM(qty) FROM os_stock_reserved r WHERE r.inventory_id = inventory.id), 0)
+        """
+    )
+    return db.execute("SELECT COUNT(*) FROM os_stock_reserved").fetchone()[0]
 def sync_os_to_finance(
     db,
     os_id: int,
@@ -2065,7 +4379,8 @@ def sync_os_to_finance(
         db.execute(
             """
             UPDATE fin_transactions
-               SET description=?,
+               SET ttype='IN',
+                   description=?,
                    amount=?,
                    date=?,
                    due_date=?,
@@ -2116,6 +4431,434 @@ def sync_os_to_finance(
         pass
 
 
+# --------------------------
+# Outbox OS -> Financeiro
+# --------------------------
+FIN_OUTBOX_BATCH = 200
+FIN_OUTBOX_MAX_ATTEMPTS = 8
+FIN_OUTBOX_INTERVAL = 5.0  # segundos entre varreduras do worker
+
+_fin_outbox_wakeup = threading.Event()
+_fin_outbox_lock = threading.Lock()
+_fin_outbox_thread = None
+
+
+def enqueue_os_finance(db, os_id: int) -> None:
+    """Registra o evento "OS alterada" na transação atual (o commit é de quem chama)."""
+    db.execute("INSERT INTO fin_outbox(os_id, created_at) VALUES (?,?)", (int(os_id), _now_iso()))
+
+
+def _sync_os_to_finance_from_db(db, os_id: int) -> bool:
+    """Relê a OS já gravada e sincroniza o financeiro. Retorna False se a OS não existe mais."""
+    o = db.execute(
+        """
+        SELECT o.status, o.pay_method, o.pay_status, o.labor, c.name AS client_name
+          FROM orders o
+          LEFT JOIN clients c ON c.id = o.client_id
+         WHERE o.id = ?
+        """,
+        (os_id,),
+    ).fetchone()
+    if not o:
+        return False
+    items = [
+        dict(r) for r in db.execute(
+            "SELECT inventory_id, description, qty, unit_price, total, is_labor FROM order_items WHERE order_id=? ORDER BY id",
+            (os_id,),
+        ).fetchall()
+    ]
+    sync_os_to_finance(
+        db, os_id, o["client_name"], o["status"] or "Aberta",
+        o["pay_method"] or "Dinheiro", o["pay_status"] or "Pendente",
+        float(o["labor"] or 0), items,
+    )
+    return True
+
+
+def process_fin_outbox(db, batch_size: int = FIN_OUTBOX_BATCH) -> dict:
+    """Processa um lote do outbox.
+    Várias edições da mesma OS viram uma sincronização só (estado atual da OS).
+    Falhas ficam registradas (attempts/last_error) e voltam com backoff.
+    """
+    now = _now_iso()
+    pend = db.execute(
+        """
+        SELECT os_id, MAX(id) AS last_id, MAX(attempts) AS attempts
+          FROM fin_outbox
+         WHERE processed_at IS NULL
+           AND attempts < ?
+           AND (next_try_at IS NULL OR next_try_at <= ?)
+         GROUP BY os_id
+         ORDER BY MIN(id)
+         LIMIT ?
+        """,
+        (FIN_OUTBOX_MAX_ATTEMPTS, now, batch_size),
+    ).fetchall()
+
+    done = 0
+    failed = 0
+    if pend and not db.in_transaction:
+        # IMMEDIATE: pega o lock de escrita já no início (evita "database is locked" no meio do lote);
+        # um commit por lote e cada OS isolada num savepoint
+        db.execute("BEGIN IMMEDIATE")
+    for r in pend:
+        os_id, last_id = int(r["os_id"]), int(r["last_id"])
+        db.execute("SAVEPOINT fin_outbox_os")
+        try:
+            _sync_os_to_finance_from_db(db, os_id)
+            db.execute(
+                "UPDATE fin_outbox SET processed_at=?, last_error=NULL WHERE os_id=? AND id<=? AND processed_at IS NULL",
+                (now, os_id, last_id),
+            )
+            db.execute("RELEASE fin_outbox_os")
+            done += 1
+        except Exception as e:
+            db.execute("ROLLBACK TO fin_outbox_os")
+            db.execute("RELEASE fin_outbox_os")
+            attempts = int(r["attempts"] or 0) + 1
+            retry = datetime.datetime.now() + datetime.timedelta(seconds=min(2 ** attempts, 3600))
+            db.execute(
+                """
+                UPDATE fin_outbox
+                   SET attempts=?, last_error=?, next_try_at=?
+                 WHERE os_id=? AND id<=? AND processed_at IS NULL
+                """,
+                (attempts, f"{type(e).__name__}: {e}", retry.isoformat(timespec="seconds"), os_id, last_id),
+            )
+            failed += 1
+    db.commit()
+    return {"processed": done, "failed": failed, "batch": len(pend)}
+
+
+def drain_fin_outbox(db) -> dict:
+    """Processa lotes até não sobrar evento elegível."""
+    total = {"processed": 0, "failed": 0}
+    while True:
+        res = process_fin_outbox(db)
+        total["processed"] += res["processed"]
+        total["failed"] += res["failed"]
+        if res["batch"] < FIN_OUTBOX_BATCH:
+            return total
+
+
+def fin_outbox_status(db) -> dict:
+    r = db.execute(
+        """
+        SELECT COALESCE(SUM(CASE WHEN attempts < ? THEN 1 ELSE 0 END), 0) AS pending,
+               COALESCE(SUM(CASE WHEN attempts >= ? THEN 1 ELSE 0 END), 0) AS dead,
+               COALESCE(SUM(CASE WHEN last_error IS NOT NULL THEN 1 ELSE 0 END), 0) AS with_error
+          FROM fin_outbox
+         WHERE processed_at IS NULL
+        """,
+        (FIN_OUTBOX_MAX_ATTEMPTS, FIN_OUTBOX_MAX_ATTEMPTS),
+    ).fetchone()
+    return {"pending": int(r["pending"]), "dead": int(r["dead"]), "with_error": int(r["with_error"])}
+
+
+def _fin_outbox_loop():
+    while True:
+        _fin_outbox_wakeup.wait(FIN_OUTBOX_INTERVAL)
+        _fin_outbox_wakeup.clear()
+        try:
+            con = sqlite3.connect(DB_PATH, timeout=30)
+            con.row_factory = sqlite3.Row
+            try:
+                drain_fin_outbox(con)
+            finally:
+                con.close()
+        except Exception as e:
+            print("ERRO fin_outbox worker:", e)
+
+
+def start_fin_outbox_worker() -> None:
+    """Sobe (uma vez por processo) a thread que esvazia o outbox."""
+    global _fin_outbox_thread
+    with _fin_outbox_lock:
+        if _fin_outbox_thread is not None and _fin_outbox_thread.is_alive():
+            return
+        _fin_outbox_thread = threading.Thread(target=_fin_outbox_loop, name="fin-outbox", daemon=True)
+        _fin_outbox_thread.start()
+
+
+def notify_fin_outbox() -> None:
+    """Acorda o worker depois do commit (e garante que ele esteja rodando)."""
+    start_fin_outbox_worker()
+    _fin_outbox_wakeup.set()
+
+
+@app.cli.command("fin-resumo-mensal")
+def _cli_fin_resumo_mensal():
+    """Refaz o resumo mensal do financeiro (fin_monthly_summary) a partir dos lançamentos."""
+    db = get_db()
+    n = rebuild_fin_monthly_summary(db)
+    db.commit()
+    print(f"Resumo mensal refeito: {n} linhas")
+
+
+@app.cli.command("fin-outbox")
+def _cli_fin_outbox():
+    """Processa agora todos os eventos pendentes do outbox financeiro."""
+    db = get_db()
+    res = drain_fin_outbox(db)
+    st = fin_outbox_status(db)
+    print(f"Outbox: processadas {res['processed']} OS | falhas {res['failed']} | "
+          f"pendentes {st['pending']} | esgotadas {st['dead']}")
+
+
+@app.route("/financeiro/sincronizacao", methods=["GET", "POST"])
+@login_required
+def financeiro_sincronizacao():
+    """Eventos do outbox que ainda não viraram lançamento (com o último erro) e,
+    com ?verificar=1, a verificação de consistência OS/compras x lançamentos."""
+    db = get_db()
+    if request.method == "POST" and request.form.get("acao") == "corrigir":
+        res = fin_consistency_fix(db, fin_consistency_check(db))
+        flash(f"Corrigidos {res['updated']} lançamentos de compra; {res['os_enqueued']} OS enviadas para sincronizar; "
+              f"{res['purchases_recreated']} compras recriadas.", "ok")
+        return redirect(url_for("financeiro_sincronizacao", verificar=1))
+    if request.method == "POST":
+        # reprocessar: zera tentativas/backoff dos eventos pendentes
+        db.execute("UPDATE fin_outbox SET attempts=0, next_try_at=NULL WHERE processed_at IS NULL")
+        db.commit()
+        notify_fin_outbox()
+        flash("Eventos reenviados para sincronização.", "ok")
+        return redirect(url_for("financeiro_sincronizacao"))
+
+    rows = db.execute(
+        """
+        SELECT f.os_id, COUNT(*) AS events, MIN(f.created_at) AS first_at, MAX(f.created_at) AS last_at,
+               MAX(f.attempts) AS attempts, MAX(f.next_try_at) AS next_try_at,
+               (SELECT x.last_error FROM fin_outbox x
+                 WHERE x.os_id = f.os_id AND x.processed_at IS NULL AND x.last_error IS NOT NULL
+                 ORDER BY x.id DESC LIMIT 1) AS last_error
+          FROM fin_outbox f
+         WHERE f.processed_at IS NULL
+         GROUP BY f.os_id
+         ORDER BY MIN(f.id)
+         LIMIT 500
+        """
+    ).fetchall()
+    issues = fin_consistency_check(db) if request.args.get("verificar") else None
+    return render_template(
+        "financeiro_sincronizacao.html",
+        title="Sincronização OS → Financeiro",
+        rows=rows,
+        status=fin_outbox_status(db),
+        max_attempts=FIN_OUTBOX_MAX_ATTEMPTS,
+        issues=issues[:300] if issues is not None else None,
+        issues_summary=_fin_check_summary(issues) if issues is not None else None,
+        issues_total=len(issues) if issues is not None else 0,
+    )
+
+
+# --------------------------
+# Verificação de consistência OS/Compras x Financeiro
+# --------------------------
+FIN_CHECK_BATCH = 500
+
+
+def _fin_expected_status_sql() -> str:
+    """_tx_status_from_pay em SQL (mesmas listas), para comparar todas as OS de uma vez."""
+    ef = ",".join(f"'{v}'" for v in _PAY_EFETIVADO)
+    ca = ",".join(f"'{v}'" for v in _PAY_CANCELADO)
+    return f"""CASE WHEN lower(trim(COALESCE(o.status, ''))) = 'cancelada' THEN 'CANCELADO'
+                    WHEN lower(trim(COALESCE(o.pay_status, ''))) IN ({ef}) THEN 'EFETIVADO'
+                    WHEN lower(trim(COALESCE(o.pay_status, ''))) IN ({ca}) THEN 'CANCELADO'
+                    ELSE 'PENDENTE' END"""
+
+
+def fin_consistency_check(db) -> list[dict]:
+    """Recalcula o valor/status esperado de todas as OS e compras e compara com fin_transactions.
+    Tudo em poucas consultas agrupadas (itens somados por OS num scan só, lançamento achado
+    pelo idx_fin_tx_ref). Tipos: SEM_LANCAMENTO, DIVERGENTE, DUPLICADO, ORFAO.
+    OS com evento ainda não processado no fin_outbox ficam de fora: o worker vai sincronizá-las
+    (relatar e corrigir agora concorreria com ele)."""
+    dups = {
+        (r["ref_type"], r["ref_id"])
+        for r in db.execute(
+            """SELECT ref_type, ref_id FROM fin_transactions
+                WHERE ref_type IN ('OS', 'PURCHASE') GROUP BY ref_type, ref_id HAVING COUNT(*) > 1"""
+        ).fetchall()
+    }
+    rows = db.execute(
+        f"""
+        WITH expected AS (
+            SELECT 'OS' AS ref_type, o.id AS ref_id, 'IN' AS ttype,
+                   ROUND(COALESCE(o.labor, 0) + COALESCE(it.total, 0), 2) AS amount,
+                   {_fin_expected_status_sql()} AS status
+              FROM orders o
+              LEFT JOIN (SELECT order_id, SUM(total) AS total FROM order_items GROUP BY order_id) it
+                     ON it.order_id = o.id
+            UNION ALL
+            SELECT 'PURCHASE', p.id, 'OUT', ROUND(COALESCE(p.total, 0), 2),
+                   UPPER(TRIM(COALESCE(p.status, 'PENDENTE')))
+              FROM purchase_orders p
+        )
+        SELECT CASE WHEN t.id IS NULL THEN 'SEM_LANCAMENTO' ELSE 'DIVERGENTE' END AS kind,
+               e.ref_type, e.ref_id, t.id AS tx_id,
+               e.ttype AS expected_ttype, t.ttype,
+               e.amount AS expected_amount, t.amount,
+               e.status AS expected_status, t.status
+          FROM expected e
+          LEFT JOIN fin_transactions t INDEXED BY idx_fin_tx_ref
+                 ON t.ref_type = e.ref_type AND t.ref_id = e.ref_id
+         WHERE t.id IS NULL
+            OR t.ttype <> e.ttype
+            OR ABS(t.amount - e.amount) > 0.005
+            OR t.status <> e.status
+        UNION ALL
+        SELECT 'ORFAO', t.ref_type, t.ref_id, t.id, NULL, t.ttype, NULL, t.amount, NULL, t.status
+          FROM fin_transactions t INDEXED BY idx_fin_tx_ref
+          LEFT JOIN orders o ON t.ref_type = 'OS' AND o.id = t.ref_id
+          LEFT JOIN purchase_orders p ON t.ref_type = 'PURCHASE' AND p.id = t.ref_id
+         WHERE t.ref_type IN ('OS', 'PURCHASE') AND o.id IS NULL AND p.id IS NULL
+        """
+    ).fetchall()
+    pending = {
+        r["os_id"] for r in db.execute(
+            "SELECT DISTINCT os_id FROM fin_outbox INDEXED BY idx_fin_outbox_pending WHERE processed_at IS NULL"
+        ).fetchall()
+    }
+    out = []
+    for r in rows:
+        d = dict(r)
+        if d["ref_type"] == "OS" and d["ref_id"] in pending:
+            continue
+        if d["kind"] == "DIVERGENTE" and (d["ref_type"], d["ref_id"]) in dups:
+            d["kind"] = "DUPLICADO"
+        out.append(d)
+    # duplicados que batem no valor também aparecem (só um dos lançamentos é o certo)
+    seen = {(d["ref_type"], d["ref_id"]) for d in out if d["kind"] == "DUPLICADO"}
+    for ref_type, ref_id in sorted(dups - seen):
+        if ref_type == "OS" and ref_id in pending:
+            continue
+        for t in db.execute(
+            "SELECT id, ttype, amount, status FROM fin_transactions WHERE ref_type=? AND ref_id=?", (ref_type, ref_id)
+        ).fetchall():
+            out.append({"kind": "DUPLICADO", "ref_type": ref_type, "ref_id": ref_id, "tx_id": t["id"],
+                        "expected_ttype": None, "ttype": t["ttype"], "expected_amount": None,
+                        "amount": t["amount"], "expected_status": None, "status": t["status"]})
+    return out
+
+
+def fin_consistency_fix(db, issues: list[dict], batch_size: int = FIN_CHECK_BATCH) -> dict:
+    """Corrige o que dá para corrigir sem decisão humana, com commit a cada lote:
+    - OS DIVERGENTE ou SEM_LANCAMENTO: vai para o outbox (a sincronização normal refaz
+      lançamento e itens juntos, então o total continua batendo com o detalhamento);
+    - compra DIVERGENTE: valor/tipo/status do lançamento voltam a ser os da compra;
+    - compra SEM_LANCAMENTO: recria o lançamento pela compra gravada.
+    DUPLICADO e ORFAO ficam só no relatório."""
+    now = _now_iso()
+    upd = [
+        (i["expected_amount"], i["expected_ttype"], i["expected_status"], now, i["tx_id"])
+        for i in issues if i["kind"] == "DIVERGENTE" and i["ref_type"] == "PURCHASE"
+    ]
+    for k in range(0, len(upd), batch_size):
+        db.executemany("UPDATE fin_transactions SET amount=?, ttype=?, status=?, updated_at=? WHERE id=?",
+                       upd[k:k + batch_size])
+        db.commit()
+
+    os_ids = [i["ref_id"] for i in issues if i["kind"] in ("SEM_LANCAMENTO", "DIVERGENTE") and i["ref_type"] == "OS"]
+    for k in range(0, len(os_ids), batch_size):
+        db.executemany("INSERT INTO fin_outbox(os_id, created_at) VALUES (?,?)",
+                       [(os_id, now) for os_id in os_ids[k:k + batch_size]])
+        db.commit()
+    if os_ids:
+        notify_fin_outbox()
+
+    pur_ids = [i["ref_id"] for i in issues if i["kind"] == "SEM_LANCAMENTO" and i["ref_type"] == "PURCHASE"]
+    for k in range(0, len(pur_ids), batch_size):
+        for pid in pur_ids[k:k + batch_size]:
+            p = db.execute("SELECT * FROM purchase_orders WHERE id=?", (pid,)).fetchone()
+            items = [dict(r) for r in db.execute(
+                "SELECT inventory_id, qty, unit_cost, total FROM purchase_items WHERE purchase_id=?", (pid,)
+            ).fetchall()]
+            tx_id = _upsert_purchase_fin_tx(db, pid, p["supplier"], float(p["total"] or 0), p["date"],
+                                            p["due_date"], p["status"], p["payment_method_id"], items)
+            db.execute("UPDATE purchase_orders SET fin_tx_id=? WHERE id=?", (tx_id, pid))
+        db.commit()
+    return {"updated": len(upd), "os_enqueued": len(os_ids), "purchases_recreated": len(pur_ids)}
+
+
+def _fin_check_summary(issues: list[dict]) -> dict:
+    out = {}
+    for i in issues:
+        key = f"{i['ref_type']} {i['kind']}"
+        out[key] = out.get(key, 0) + 1
+    return out
+
+
+@app.cli.command("fin-consistencia")
+@click.option("--corrigir", is_flag=True, help="Corrige as divergências em lotes (senão só relata).")
+@click.option("--lote", default=FIN_CHECK_BATCH, show_default=True, help="Lançamentos por transação na correção.")
+def _cli_fin_consistencia(corrigir, lote):
+    """Compara OS/compras com os lançamentos do financeiro (agendar de madrugada)."""
+    db = get_db()
+    issues = fin_consistency_check(db)
+    for key, n in sorted(_fin_check_summary(issues).items()):
+        print(f"{key}: {n}")
+    for i in issues[:50]:
+        print(f"  {i['kind']} {i['ref_type']} #{i['ref_id']} tx={i['tx_id']} "
+              f"valor {i['amount']} (esperado {i['expected_amount']}) status {i['status']} (esperado {i['expected_status']})")
+    if not issues:
+        print("Financeiro consistente com OS e compras.")
+    elif corrigir:
+        res = fin_consistency_fix(db, issues, lote)
+        drain_fin_outbox(db)
+        print(f"Corrigidos: {res['updated']} lançamentos de compra | {res['os_enqueued']} OS sincronizadas | "
+              f"{res['purchases_recreated']} compras recriadas")
+
+
+def rebuild_fin_monthly_summary(db) -> int:
+    """Refaz fin_monthly_summary do zero a partir de fin_transactions (sem commit)."""
+    db.execute("DELETE FROM fin_monthly_summary")
+    db.execute(
+        """
+        INSERT INTO fin_monthly_summary(month, ttype, status, payment_method_id, category_id, total, cnt)
+        SELECT substr(date, 1, 7), ttype, status, COALESCE(payment_method_id, 0), COALESCE(category_id, 0),
+               SUM(amount), COUNT(*)
+          FROM fin_transactions
+         GROUP BY 1, 2, 3, 4, 5
+        """
+    )
+    return db.execute("SELECT COUNT(*) FROM fin_monthly_summary").fetchone()[0]
+
+
+def _fin_rollup_source(start: str, end: str) -> tuple[str, list]:
+    """Subconsulta (month, ttype, status, payment_method_id, total, cnt) do período [start, end].
+    Meses inteiros vêm de fin_monthly_summary; só as pontas de mês quebrado leem
+    fin_transactions (pelo índice de data). Assim o custo não cresce com o volume de lançamentos.
+    """
+    # INDEXED BY: o filtro de status de fora desce até aqui e, sem estatísticas, o SQLite
+    # preferiria idx_fin_tx_due (status=?) e leria todos os pendentes em vez do trecho de datas
+    raw = ("SELECT substr(date, 1, 7) AS month, ttype, status, COALESCE(payment_method_id, 0) AS payment_method_id,"
+           " amount AS total, 1 AS cnt FROM fin_transactions INDEXED BY idx_fin_tx_dash WHERE date BETWEEN ? AND ?")
+    try:
+        d0 = datetime.date.fromisoformat(start)
+        d1 = datetime.date.fromisoformat(end)
+    except ValueError:
+        return raw, [start, end]
+    if d1 < d0:
+        return raw, [start, end]
+
+    first_full = d0 if d0.day == 1 else (d0.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    next_after_end = (d1.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    last_full = d1.replace(day=1) if d1 == next_after_end - datetime.timedelta(days=1) else (d1.replace(day=1) - datetime.timedelta(days=1)).replace(day=1)
+    if first_full > last_full:
+        return raw, [start, end]
+
+    parts = ["SELECT month, ttype, status, payment_method_id, total, cnt FROM fin_monthly_summary WHERE month BETWEEN ? AND ?"]
+    params = [first_full.strftime("%Y-%m"), last_full.strftime("%Y-%m")]
+    if d0 < first_full:
+        parts.append(raw)
+        params += [start, (first_full - datetime.timedelta(days=1)).isoformat()]
+    after_full = (last_full.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    if after_full <= d1:
+        parts.append(raw)
+        params += [after_full.isoformat(), end]
+    return " UNION ALL ".join(parts), params
+
+
 @login_required
 @app.route("/financeiro")
 def financeiro_dashboard():
@@ -2125,30 +4868,30 @@ def financeiro_dashboard():
     start = _parse_date(request.args.get("start"), ym)
     end = _parse_date(request.args.get("end"), today)
 
-    def _sum(where_sql, params):
-        r = db.execute(f"SELECT COALESCE(SUM(amount),0) s FROM fin_transactions WHERE {where_sql}", params).fetchone()
-        return float(r["s"] or 0)
-
-    receitas = _sum("ttype='IN' AND status='EFETIVADO' AND date BETWEEN ? AND ?", (start, end))
-    despesas = _sum("ttype='OUT' AND status='EFETIVADO' AND date BETWEEN ? AND ?", (start, end))
+    # KPIs + recebido por forma de pagamento: resumo mensal + pontas do período (idx_fin_tx_dash)
+    src, src_params = _fin_rollup_source(start, end)
+    rows_k = db.execute(
+        f"""
+        SELECT payment_method_id,
+               COALESCE(SUM(CASE WHEN ttype='IN'  AND status='EFETIVADO' THEN total END),0) AS receitas,
+               COALESCE(SUM(CASE WHEN ttype='OUT' AND status='EFETIVADO' THEN total END),0) AS despesas,
+               COALESCE(SUM(CASE WHEN ttype='IN'  AND status='PENDENTE'  THEN total END),0) AS pend_receber,
+               COALESCE(SUM(CASE WHEN ttype='OUT' AND status='PENDENTE'  THEN total END),0) AS pend_pagar
+          FROM ({src})
+         WHERE status IN ('EFETIVADO','PENDENTE')
+         GROUP BY payment_method_id
+        """,
+        src_params,
+    ).fetchall()
+    receitas = sum(float(r["receitas"]) for r in rows_k)
+    despesas = sum(float(r["despesas"]) for r in rows_k)
     saldo = receitas - despesas
-    pend_receber = _sum("ttype='IN' AND status='PENDENTE' AND date BETWEEN ? AND ?", (start, end))
-    pend_pagar = _sum("ttype='OUT' AND status='PENDENTE' AND date BETWEEN ? AND ?", (start, end))
+    pend_receber = sum(float(r["pend_receber"]) for r in rows_k)
+    pend_pagar = sum(float(r["pend_pagar"]) for r in rows_k)
 
+    recebido = {r["payment_method_id"]: float(r["receitas"]) for r in rows_k}
     methods = db.execute("SELECT id, name FROM fin_payment_methods ORDER BY name").fetchall()
-    by_method = {}
-    for m in methods:
-        r = db.execute(
-            """
-            SELECT COALESCE(SUM(amount),0) s
-              FROM fin_transactions
-             WHERE ttype='IN' AND status='EFETIVADO'
-               AND payment_method_id=?
-               AND date BETWEEN ? AND ?
-            """,
-            (m["id"], start, end),
-        ).fetchone()
-        by_method[m["name"]] = float(r["s"] or 0)
+    by_method = {m["name"]: recebido.get(m["id"], 0.0) for m in methods}
     # Gráfico: Receitas x Despesas por mês
     # Por padrão, mostra os últimos 12 meses (ancorado no "Fim" do filtro).
     try:
@@ -2175,18 +4918,18 @@ def financeiro_dashboard():
     chart_start_iso = chart_start.isoformat()
     chart_end_iso = chart_end.isoformat()
 
+    src, src_params = _fin_rollup_source(chart_start_iso, chart_end_iso)
     rows_m = db.execute(
-        """
-        SELECT strftime('%Y-%m', date) ym,
-               COALESCE(SUM(CASE WHEN ttype='IN'  THEN amount ELSE 0 END),0) receitas,
-               COALESCE(SUM(CASE WHEN ttype='OUT' THEN amount ELSE 0 END),0) despesas
-          FROM fin_transactions
+        f"""
+        SELECT month ym,
+               COALESCE(SUM(CASE WHEN ttype='IN'  THEN total ELSE 0 END),0) receitas,
+               COALESCE(SUM(CASE WHEN ttype='OUT' THEN total ELSE 0 END),0) despesas
+          FROM ({src})
          WHERE status='EFETIVADO'
-           AND date BETWEEN ? AND ?
          GROUP BY ym
          ORDER BY ym
         """,
-        (chart_start_iso, chart_end_iso),
+        src_params,
     ).fetchall()
 
     mdata = {r["ym"]: (float(r["receitas"] or 0), float(r["despesas"] or 0)) for r in rows_m}
@@ -2241,6 +4984,7 @@ def financeiro_dashboard():
         monthly_receitas=monthly_receitas,
         monthly_despesas=monthly_despesas,
         last=last,
+        outbox=fin_outbox_status(db),
     )
 
 
@@ -2268,22 +5012,80 @@ def financeiro_lancamentos():
         where.append("(description LIKE ?)")
         params.append(f"%{q}%")
 
+    where_sql = " AND ".join(where)
+    # valor com sinal para o saldo (cancelado não conta)
+    signed = "CASE WHEN status='CANCELADO' THEN 0 WHEN ttype='IN' THEN amount ELSE -amount END"
+
+    # Totais do filtro inteiro: uma agregação separada da listagem.
+    # Índices fixados: com filtro de status o SQLite escolheria idx_fin_tx_due (status=?)
+    # e leria todos os lançamentos daquele status em vez do trecho de datas.
+    tot = db.execute(
+        f"""
+        SELECT COUNT(*) AS n,
+               COALESCE(SUM(CASE WHEN ttype='IN'  AND status<>'CANCELADO' THEN amount END), 0) AS total_in,
+               COALESCE(SUM(CASE WHEN ttype='OUT' AND status<>'CANCELADO' THEN amount END), 0) AS total_out
+          FROM fin_transactions INDEXED BY idx_fin_tx_dash
+         WHERE {where_sql}
+        """,
+        params,
+    ).fetchone()
+
+    # Página por cursor (data, id), mais novos primeiro. O saldo acumulado é uma janela
+    # sobre as linhas da página somada ao saldo de tudo que vem antes da linha mais antiga
+    # dela, então continua certo de uma página para a outra.
+    per_page = 100
+    cursor = (request.args.get("after") or "").strip()
+    page_where = ""
+    page_params = list(params)
+    try:
+        c_date, c_id = cursor.split("|")
+        page_where = "AND (date, id) < (?, ?)"
+        page_params.extend([c_date, int(c_id)])
+    except ValueError:
+        cursor = ""
     rows = db.execute(
         f"""
-        SELECT t.*, pm.name AS pm_name, c.name AS cat_name
-          FROM fin_transactions t
+        WITH page AS (
+            SELECT * FROM fin_transactions INDEXED BY idx_fin_tx_date
+             WHERE {where_sql} {page_where}
+             ORDER BY date DESC, id DESC
+             LIMIT ?
+        ),
+        base AS (
+            SELECT COALESCE(SUM({signed}), 0) AS b
+              FROM fin_transactions INDEXED BY idx_fin_tx_dash
+             WHERE {where_sql}
+               AND (date, id) < (SELECT date, id FROM page ORDER BY date, id LIMIT 1)
+        )
+        SELECT t.*, pm.name AS pm_name, c.name AS cat_name,
+               base.b + SUM({signed}) OVER (ORDER BY t.date, t.id ROWS UNBOUNDED PRECEDING) AS running
+          FROM page t
+          CROSS JOIN base
           LEFT JOIN fin_payment_methods pm ON pm.id=t.payment_method_id
           LEFT JOIN fin_categories c ON c.id=t.category_id
-         WHERE {' AND '.join(where)}
          ORDER BY t.date DESC, t.id DESC
         """,
-        params,
+        page_params + [per_page + 1] + params,
     ).fetchall()
+    next_cursor = None
+    if len(rows) > per_page:
+        last = rows[per_page - 1]
+        next_cursor = f"{last['date']}|{last['id']}"
+        rows = rows[:per_page]
+    page_in = sum(float(r["amount"] or 0) for r in rows if r["ttype"] == "IN" and r["status"] != "CANCELADO")
+    page_out = sum(float(r["amount"] or 0) for r in rows if r["ttype"] == "OUT" and r["status"] != "CANCELADO")
 
     return render_template(
         "financeiro_lancamentos.html",
         title="Lançamentos",
         rows=rows,
+        total_rows=int(tot["n"] or 0),
+        total_in=float(tot["total_in"] or 0),
+        total_out=float(tot["total_out"] or 0),
+        page_in=page_in,
+        page_out=page_out,
+        cursor=cursor,
+        next_cursor=next_cursor,
         start=start,
         end=end,
         ttype=ttype,
@@ -2295,6 +5097,300 @@ def financeiro_lancamentos():
 
 
 
+# faixas do relatório de vencimentos: (chave, rótulo, dias a partir de hoje [de, até])
+FIN_AGING_BUCKETS = (
+    ("vencido_90", "Vencidos há mais de 90 dias", None, -91),
+    ("vencido_61_90", "Vencidos 61–90 dias", -90, -61),
+    ("vencido_31_60", "Vencidos 31–60 dias", -60, -31),
+    ("vencido_1_30", "Vencidos 1–30 dias", -30, -1),
+    ("a_vencer_0_7", "Hoje até 7 dias", 0, 7),
+    ("a_vencer_8_30", "8–30 dias", 8, 30),
+    ("a_vencer_31_60", "31–60 dias", 31, 60),
+    ("a_vencer_61_90", "61–90 dias", 61, 90),
+    ("a_vencer_90", "Mais de 90 dias", 91, None),
+)
+
+
+def fin_aging(db, today: datetime.date | None = None) -> dict:
+    """Contas a receber/pagar pendentes por faixa de vencimento, numa varredura só
+    (status='PENDENTE' pelo idx_fin_tx_due). As faixas viram comparações de texto em
+    due_date com as datas-limite calculadas aqui, sem função sobre a coluna.
+    """
+    today = today or datetime.date.today()
+    cases, params = [], []
+    for key, _label, d_from, d_to in FIN_AGING_BUCKETS:
+        cond = []
+        if d_from is not None:
+            cond.append("due_date >= ?")
+            params.append((today + datetime.timedelta(days=d_from)).isoformat())
+        if d_to is not None:
+            cond.append("due_date <= ?")
+            params.append((today + datetime.timedelta(days=d_to)).isoformat())
+        cases.append(f"WHEN {' AND '.join(cond)} THEN '{key}'")
+    rows = db.execute(
+        f"""
+        SELECT CASE WHEN due_date IS NULL OR due_date = '' THEN 'sem_vencimento' {' '.join(cases)} END AS bucket,
+               COALESCE(SUM(CASE WHEN ttype='IN'  THEN amount END), 0) AS a_receber,
+               COALESCE(SUM(CASE WHEN ttype='OUT' THEN amount END), 0) AS a_pagar,
+               COUNT(*) AS n
+          FROM fin_transactions
+         WHERE status = 'PENDENTE'
+         GROUP BY bucket
+        """,
+        params,
+    ).fetchall()
+    got = {r["bucket"]: r for r in rows}
+
+    buckets = []
+    for key, label, d_from, d_to in FIN_AGING_BUCKETS + (("sem_vencimento", "Sem vencimento", None, None),):
+        r = got.get(key)
+        rin = float(r["a_receber"]) if r else 0.0
+        rout = float(r["a_pagar"]) if r else 0.0
+        buckets.append({
+            "key": key, "label": label, "from_days": d_from, "to_days": d_to,
+            "a_receber": rin, "a_pagar": rout, "liquido": rin - rout, "qtd": int(r["n"]) if r else 0,
+        })
+
+    # saldo efetivado até hoje (resumo mensal) + previsão acumulada dos próximos 7/30/60/90 dias
+    src, src_params = _fin_rollup_source("0001-01-01", today.isoformat())
+    bal = db.execute(
+        f"SELECT COALESCE(SUM(CASE WHEN ttype='IN' THEN total ELSE -total END), 0) FROM ({src}) WHERE status='EFETIVADO'",
+        src_params,
+    ).fetchone()[0]
+    saldo = float(bal or 0)
+    vencidos = sum(b["liquido"] for b in buckets if b["key"].startswith("vencido"))
+    forecast = []
+    acc = 0.0
+    for b in buckets:
+        if not b["key"].startswith("a_vencer") or b["to_days"] is None:
+            continue
+        acc += b["liquido"]
+        forecast.append({"dias": b["to_days"], "liquido": acc, "saldo_previsto": saldo + vencidos + acc})
+    return {"today": today.isoformat(), "buckets": buckets, "saldo_atual": saldo,
+            "vencidos_liquido": vencidos, "previsao": forecast}
+
+
+@app.route("/financeiro/vencimentos")
+@login_required
+def financeiro_vencimentos():
+    db = get_db()
+    data = fin_aging(db)
+    if request.args.get("format") == "json":
+        return jsonify(data)
+    return render_template("financeiro_vencimentos.html", title="Vencimentos e fluxo de caixa", **data)
+
+
+# --------------------------
+# Conciliação de extratos (banco / maquininha)
+# --------------------------
+FIN_STATEMENT_BATCH = 1000
+FIN_MATCH_MAX_ROUNDS = 5
+
+
+def import_fin_statement(db, stream, filename: str, payment_method_id=None, window_days: int = 3) -> tuple[int, list]:
+    """Grava o extrato e suas linhas (em lotes, INSERT OR IGNORE pelo line_hash) e já roda o casamento.
+    Retorna (statement_id, erros por linha)."""
+    errors = []
+    source, entries = extrato.iter_statement(stream, filename, errors)
+    cur = db.execute(
+        "INSERT INTO fin_statements(filename, source, payment_method_id, window_days, created_at) VALUES (?,?,?,?,?)",
+        (filename, source, payment_method_id, window_days, _now_iso()),
+    )
+    st_id = cur.lastrowid
+    total = inserted = 0
+    batch = []
+
+    def flush():
+        nonlocal inserted
+        before = db.total_changes
+        db.executemany(
+            """INSERT OR IGNORE INTO fin_statement_lines(statement_id, date, ttype, amount_cents, description, fitid, line_hash)
+               VALUES (?,?,?,?,?,?,?)""",
+            batch,
+        )
+        inserted += db.total_changes - before
+        batch.clear()
+
+    for e in entries:
+        total += 1
+        batch.append((st_id, e["date"], e["ttype"], e["amount_cents"], e["description"], e["fitid"], e["line_hash"]))
+        if len(batch) >= FIN_STATEMENT_BATCH:
+            flush()
+    if batch:
+        flush()
+    db.execute("UPDATE fin_statements SET lines=?, duplicates=? WHERE id=?", (inserted, total - inserted, st_id))
+    match_fin_statement(db, st_id)
+    return st_id, errors
+
+
+def match_fin_statement(db, statement_id: int) -> int:
+    """Sugere um lançamento PENDENTE para cada linha ABERTA do extrato, tudo em SQL:
+    um único join linha x lançamento pelo idx_fin_tx_match (mesmo tipo, mesmo valor em centavos,
+    vencimento dentro de ±window_days e, se o extrato tiver forma de pagamento, a mesma forma).
+    O par vence quando é o melhor candidato dos dois lados (menor distância de datas, depois id);
+    quem perdeu a disputa tenta de novo na rodada seguinte. Retorna quantas linhas foram sugeridas."""
+    st = db.execute("SELECT window_days, payment_method_id FROM fin_statements WHERE id=?", (statement_id,)).fetchone()
+    if not st:
+        return 0
+    win = int(st["window_days"] or 0)
+    total = 0
+    for _ in range(FIN_MATCH_MAX_ROUNDS):
+        pairs = db.execute(
+            """
+            WITH cand AS (
+                SELECT l.id AS line_id, t.id AS tx_id,
+                       CAST(ABS(julianday(COALESCE(t.due_date, t.date)) - julianday(l.date)) AS INTEGER) AS dd
+                  FROM fin_statement_lines l
+                  JOIN fin_transactions t INDEXED BY idx_fin_tx_match
+                    ON t.status = 'PENDENTE'
+                   AND t.ttype = l.ttype
+                   AND CAST(ROUND(t.amount * 100) AS INTEGER) = l.amount_cents
+                   AND COALESCE(t.due_date, t.date) BETWEEN date(l.date, ?) AND date(l.date, ?)
+                 WHERE l.statement_id = ? AND l.status = 'ABERTO'
+                   AND (? IS NULL OR t.payment_method_id = ?)
+                   AND NOT EXISTS (SELECT 1 FROM fin_statement_lines u WHERE u.tx_id = t.id)
+            ),
+            ranked AS (
+                SELECT line_id, tx_id, dd,
+                       ROW_NUMBER() OVER (PARTITION BY line_id ORDER BY dd, tx_id) AS rl,
+                       ROW_NUMBER() OVER (PARTITION BY tx_id ORDER BY dd, line_id) AS rt
+                  FROM cand
+            )
+            SELECT tx_id, dd, line_id FROM ranked WHERE rl = 1 AND rt = 1
+            """,
+            (f"-{win} days", f"+{win} days", statement_id, st["payment_method_id"], st["payment_method_id"]),
+        ).fetchall()
+        if not pairs:
+            break
+        db.executemany(
+            "UPDATE fin_statement_lines SET status='SUGERIDO', tx_id=?, match_days=? WHERE id=?",
+            [tuple(p) for p in pairs],
+        )
+        total += len(pairs)
+    return total
+
+
+def confirm_fin_statement(db, statement_id: int, line_ids: list[int] | None = None) -> int:
+    """Efetiva de uma vez os lançamentos sugeridos (todos ou só as linhas marcadas).
+    Para lançamentos de OS também marca a OS como paga, senão a próxima sincronização da OS
+    (_tx_status_from_pay) voltaria o lançamento para PENDENTE."""
+    sel = """SELECT tx_id FROM fin_statement_lines
+              WHERE statement_id = ? AND status = 'SUGERIDO'
+                AND (? IS NULL OR id IN (SELECT value FROM json_each(?)))"""
+    ids_json = json.dumps([int(i) for i in line_ids]) if line_ids is not None else None
+    params = (statement_id, ids_json, ids_json)
+    db.execute(
+        f"""UPDATE orders SET pay_status = 'Efetivado'
+             WHERE id IN (SELECT ref_id FROM fin_transactions
+                           WHERE ref_type = 'OS' AND status = 'PENDENTE' AND id IN ({sel}))""",
+        params,
+    )
+    cur = db.execute(
+        f"UPDATE fin_transactions SET status = 'EFETIVADO', updated_at = ? WHERE status = 'PENDENTE' AND id IN ({sel})",
+        (_now_iso(),) + params,
+    )
+    db.execute(
+        """UPDATE fin_statement_lines SET status = 'CONCILIADO'
+            WHERE statement_id = ? AND status = 'SUGERIDO'
+              AND (? IS NULL OR id IN (SELECT value FROM json_each(?)))""",
+        params,
+    )
+    return cur.rowcount
+
+
+@app.route("/financeiro/extratos", methods=["GET", "POST"])
+@login_required
+def financeiro_extratos():
+    db = get_db()
+    if request.method == "POST":
+        f = request.files.get("arquivo")
+        if not f or not f.filename:
+            flash("Escolha um arquivo CSV ou OFX.", "error")
+            return redirect(url_for("financeiro_extratos"))
+        pm_id = request.form.get("payment_method_id") or None
+        try:
+            window = max(0, min(30, int(request.form.get("window_days") or 3)))
+        except ValueError:
+            window = 3
+        st_id, errors = import_fin_statement(db, f.stream, f.filename, pm_id, window)
+        db.commit()
+        if errors:
+            flash(f"{len(errors)} linha(s) do extrato ignoradas (data ou valor inválido).", "error")
+        return redirect(url_for("financeiro_extrato", statement_id=st_id))
+
+    statements = db.execute(
+        """
+        SELECT s.*, pm.name AS method_name,
+               (SELECT COUNT(*) FROM fin_statement_lines l WHERE l.statement_id = s.id AND l.status = 'SUGERIDO') AS sugeridas,
+               (SELECT COUNT(*) FROM fin_statement_lines l WHERE l.statement_id = s.id AND l.status = 'CONCILIADO') AS conciliadas
+          FROM fin_statements s
+          LEFT JOIN fin_payment_methods pm ON pm.id = s.payment_method_id
+         ORDER BY s.id DESC LIMIT 30
+        """
+    ).fetchall()
+    methods = db.execute("SELECT id, name FROM fin_payment_methods ORDER BY name").fetchall()
+    return render_template("financeiro_extratos.html", title="Conciliação de extratos",
+                           statements=statements, methods=methods, st=None)
+
+
+@app.route("/financeiro/extratos/<int:statement_id>")
+@login_required
+def financeiro_extrato(statement_id):
+    db = get_db()
+    st = db.execute(
+        """SELECT s.*, pm.name AS method_name FROM fin_statements s
+            LEFT JOIN fin_payment_methods pm ON pm.id = s.payment_method_id WHERE s.id=?""",
+        (statement_id,),
+    ).fetchone()
+    if not st:
+        flash("Extrato não encontrado.", "error")
+        return redirect(url_for("financeiro_extratos"))
+    status = (request.args.get("status") or "SUGERIDO").upper()
+    counts = {r["status"]: r["n"] for r in db.execute(
+        "SELECT status, COUNT(*) AS n FROM fin_statement_lines WHERE statement_id=? GROUP BY status", (statement_id,))}
+    lines = db.execute(
+        """
+        SELECT l.*, l.amount_cents / 100.0 AS amount,
+               t.description AS tx_description, t.due_date AS tx_due_date, t.date AS tx_date,
+               t.status AS tx_status, t.ref_type, t.ref_id
+          FROM fin_statement_lines l
+          LEFT JOIN fin_transactions t ON t.id = l.tx_id
+         WHERE l.statement_id = ? AND l.status = ?
+         ORDER BY l.id
+         LIMIT 500
+        """,
+        (statement_id, status),
+    ).fetchall()
+    return render_template("financeiro_extratos.html", title=f"Extrato #{statement_id}",
+                           st=st, lines=lines, counts=counts, status=status)
+
+
+@app.route("/financeiro/extratos/<int:statement_id>/conciliar", methods=["POST"])
+@login_required
+def financeiro_extrato_conciliar(statement_id):
+    db = get_db()
+    ids = None if request.form.get("todas") else [int(i) for i in request.form.getlist("line_id") if i.isdigit()]
+    n = confirm_fin_statement(db, statement_id, ids)
+    db.commit()
+    flash(f"{n} lançamento(s) efetivado(s) pela conciliação.", "ok")
+    return redirect(url_for("financeiro_extrato", statement_id=statement_id))
+
+
+@app.route("/financeiro/extratos/<int:statement_id>/sugerir", methods=["POST"])
+@login_required
+def financeiro_extrato_sugerir(statement_id):
+    """Descarta as sugestões não confirmadas e casa de novo (ex.: depois de lançar o que faltava)."""
+    db = get_db()
+    db.execute(
+        "UPDATE fin_statement_lines SET status='ABERTO', tx_id=NULL, match_days=NULL WHERE statement_id=? AND status='SUGERIDO'",
+        (statement_id,),
+    )
+    n = match_fin_statement(db, statement_id)
+    db.commit()
+    flash(f"{n} linha(s) com lançamento sugerido.", "ok")
+    return redirect(url_for("financeiro_extrato", statement_id=statement_id))
+
+
 @login_required
 @app.route("/financeiro/estoque")
 def financeiro_estoque():
@@ -2309,144 +5405,189 @@ def financeiro_estoque():
     item_id = (request.args.get("item_id") or "").strip()
     q = (request.args.get("q") or "").strip()
 
-    where = ["ft.date BETWEEN ? AND ?", "it.flow='stock'"]
-    params = [start, end]
+    # lê o livro de movimentos (stock_movements): por item usa idx_stock_mov_item, senão idx_stock_mov_time
+    where = ["sm.created_at BETWEEN ? AND ?"]
+    params = [start, end + "T23:59:59"]
 
-    if direction in ("IN", "OUT"):
-        where.append("it.direction=?")
-        params.append(direction)
-    if ref_type in ("OS", "PURCHASE", "ADHOC"):
-        where.append("ft.ref_type=?")
+    if direction == "IN":
+        where.append("sm.qty_delta > 0")
+    elif direction == "OUT":
+        where.append("sm.qty_delta < 0")
+    if ref_type in ("OS", "PURCHASE"):
+        where.append("sm.ref_type=?")
         params.append(ref_type)
+    elif ref_type == "ADHOC":
+        where.append("sm.ref_type IS NULL")
     if item_id.isdigit():
-        where.append("it.inventory_id=?")
+        where.append("sm.inventory_id=?")
         params.append(int(item_id))
     if q:
-        where.append("(COALESCE(inv.name,'') LIKE ? OR COALESCE(it.description,'') LIKE ?)")
-        params.extend([f"%{q}%", f"%{q}%"])
+        where.append("COALESCE(inv.name,'') LIKE ?")
+        params.append(f"%{q}%")
+
+    base_from = f"""
+        FROM stock_movements sm
+        LEFT JOIN inventory inv ON inv.id=sm.inventory_id
+        WHERE {' AND '.join(where)}
+    """
+    # custo unitário do movimento: camada da compra, custo baixado na OS (cost_issues) ou custo atual do item
+    unit_cost = """
+        COALESCE(
+            CASE WHEN sm.ref_type='PURCHASE' THEN
+                (SELECT l.unit_cost FROM cost_layers l
+                  WHERE l.ref_type='PURCHASE' AND l.ref_id=sm.ref_id AND l.inventory_id=sm.inventory_id)
+            END,
+            CASE WHEN sm.ref_type IS NOT NULL THEN
+                (SELECT SUM(ci.cost_total) / NULLIF(SUM(ci.qty), 0) FROM cost_issues ci
+                  WHERE ci.ref_type=sm.ref_type AND ci.ref_id=sm.ref_id AND ci.inventory_id=sm.inventory_id)
+            END,
+            inv.cost_price, 0)
+    """
+    ref_key = "COALESCE(sm.ref_type, sm.reason)"  # movimento sem documento agrupa pelo motivo
+
+    # Totais do período (uma agregação no SQLite)
+    tot = db.execute(
+        f"""
+        SELECT COUNT(*) AS n,
+               COALESCE(SUM(CASE WHEN sm.qty_delta > 0 THEN sm.qty_delta END), 0) AS qty_in,
+               COALESCE(SUM(CASE WHEN sm.qty_delta < 0 THEN -sm.qty_delta END), 0) AS qty_out,
+               COALESCE(SUM(CASE WHEN sm.qty_delta > 0 THEN sm.qty_delta * {unit_cost} END), 0) AS val_in,
+               COALESCE(SUM(CASE WHEN sm.qty_delta < 0 THEN -sm.qty_delta * {unit_cost} END), 0) AS val_out
+        {base_from}
+        """,
+        params,
+    ).fetchone()
 
+    # Detalhado: paginação por cursor (momento, movimento) — só as linhas exibidas
+    per_page = 100
+    cursor = (request.args.get("after") or "").strip()
+    page_where = ""
+    page_params = list(params)
+    try:
+        c_at, c_id = cursor.split("|")
+        page_where = "AND (sm.created_at, sm.id) < (?, ?)"
+        page_params.extend([c_at, int(c_id)])
+    except ValueError:
+        cursor = ""
     rows = db.execute(
         f"""
         SELECT
-            it.id AS item_row_id,
-            it.tx_id,
-            it.direction,
-            it.inventory_id,
-            it.description AS item_desc,
-            it.qty,
-            it.unit_value,
-            it.total,
-            ft.date,
-            ft.status,
-            ft.ref_type,
-            ft.ref_id,
-            ft.description AS tx_desc,
+            sm.id,
+            sm.created_at,
+            substr(sm.created_at, 1, 10) AS date,
+            CASE WHEN sm.qty_delta > 0 THEN 'IN' ELSE 'OUT' END AS direction,
+            sm.inventory_id,
+            ABS(sm.qty_delta) AS qty,
+            {unit_cost} AS unit_value,
+            ABS(sm.qty_delta) * {unit_cost} AS total,
+            sm.reason,
+            sm.ref_type,
+            sm.ref_id,
             inv.name AS inv_name,
-            inv.sku AS inv_sku,
-            inv.stock AS inv_stock
-        FROM fin_transaction_items it
-        JOIN fin_transactions ft ON ft.id=it.tx_id
-        LEFT JOIN inventory inv ON inv.id=it.inventory_id
-        WHERE {' AND '.join(where)}
-        ORDER BY ft.date DESC, ft.id DESC, it.id DESC
+            inv.sku AS inv_sku
+        {base_from} {page_where}
+        ORDER BY sm.created_at DESC, sm.id DESC
+        LIMIT ?
         """,
-        params,
+        page_params + [per_page + 1],
+    ).fetchall()
+    next_cursor = None
+    if len(rows) > per_page:
+        last = rows[per_page - 1]
+        next_cursor = f"{last['created_at']}|{last['id']}"
+        rows = rows[:per_page]
+
+    # Agrupado por peça (GROUP BY no SQLite): as 100 mais movimentadas
+    group_limit = 100
+    by_item_rows = db.execute(
+        f"""
+        SELECT sm.inventory_id,
+               COALESCE(MAX(inv.name), 'Item #' || sm.inventory_id) AS name,
+               MAX(inv.sku) AS sku,
+               COALESCE(SUM(CASE WHEN sm.qty_delta > 0 THEN sm.qty_delta END), 0) AS in_qty,
+               COALESCE(SUM(CASE WHEN sm.qty_delta < 0 THEN -sm.qty_delta END), 0) AS out_qty,
+               COALESCE(MAX(inv.stock), 0) AS current_stock,
+               COUNT(*) OVER () AS n_items
+        {base_from}
+        GROUP BY sm.inventory_id
+        ORDER BY (in_qty + out_qty) DESC, name
+        LIMIT ?
+        """,
+        params + [group_limit],
     ).fetchall()
 
-    def fnum(x):
-        try:
-            return float(x or 0)
-        except Exception:
-            return 0.0
-
-    qty_in = sum(fnum(r["qty"]) for r in rows if (r["direction"] or "").upper() == "IN")
-    qty_out = sum(fnum(r["qty"]) for r in rows if (r["direction"] or "").upper() == "OUT")
-    val_in = sum(fnum(r["total"]) for r in rows if (r["direction"] or "").upper() == "IN")
-    val_out = sum(fnum(r["total"]) for r in rows if (r["direction"] or "").upper() == "OUT")
-
-    # Agrupado por peça
-    by_item = {}
-    for r in rows:
-        inv_id = r["inventory_id"]
-        name = r["inv_name"] or r["item_desc"] or (f"Item #{inv_id}" if inv_id else "Item")
-        if inv_id not in by_item:
-            by_item[inv_id] = {
-                "inventory_id": inv_id,
-                "name": name,
-                "sku": r["inv_sku"],
-                "in_qty": 0.0,
-                "out_qty": 0.0,
-                "in_val": 0.0,
-                "out_val": 0.0,
-                "current_stock": fnum(r["inv_stock"]),
-            }
-        d = (r["direction"] or "").upper()
-        if d == "IN":
-            by_item[inv_id]["in_qty"] += fnum(r["qty"])
-            by_item[inv_id]["in_val"] += fnum(r["total"])
-        else:
-            by_item[inv_id]["out_qty"] += fnum(r["qty"])
-            by_item[inv_id]["out_val"] += fnum(r["total"])
-
-    by_item_rows = list(by_item.values())
-    by_item_rows.sort(key=lambda x: (-(x["in_qty"] + x["out_qty"]), (x["name"] or "")))
-
-    # Agrupado por documento (OS/Compra)
-    by_ref = {}
-    for r in rows:
-        key = (r["ref_type"] or "", int(r["ref_id"] or 0))
-        if key not in by_ref:
-            by_ref[key] = {
-                "ref_type": r["ref_type"],
-                "ref_id": r["ref_id"],
-                "date": r["date"],
-                "in_qty": 0.0,
-                "out_qty": 0.0,
-                "items": [],
-            }
-        d = (r["direction"] or "").upper()
-        if d == "IN":
-            by_ref[key]["in_qty"] += fnum(r["qty"])
-        else:
-            by_ref[key]["out_qty"] += fnum(r["qty"])
-        nm = r["inv_name"] or r["item_desc"]
-        if nm:
-            by_ref[key]["items"].append(str(nm))
-
-    by_ref_rows = list(by_ref.values())
-    for rr in by_ref_rows:
-        # reduz lista (mantém únicas na ordem)
-        seen=set()
-        uniq=[]
-        for itn in rr["items"]:
-            if itn not in seen:
-                seen.add(itn)
-                uniq.append(itn)
-        rr["items_preview"] = ", ".join(uniq[:6]) + ("…" if len(uniq) > 6 else "")
-        rr["items_count"] = len(uniq)
-    by_ref_rows.sort(key=lambda x: (x["date"] or "", x["ref_type"] or "", int(x["ref_id"] or 0)), reverse=True)
-
-    inventory_options = db.execute(
-        "SELECT id, name, sku FROM inventory ORDER BY name"
+    # Agrupado por documento (OS/Compra/motivo): os 100 mais recentes, nomes únicos por documento via ROW_NUMBER()
+    by_ref_rows = db.execute(
+        f"""
+        WITH mv AS (
+            SELECT {ref_key} AS ref_type, sm.ref_id, sm.created_at, sm.id, sm.qty_delta,
+                   COALESCE(inv.name, 'Item #' || sm.inventory_id) AS nm
+            {base_from}
+        ),
+        refs AS (
+            SELECT ref_type, ref_id, MAX(substr(created_at, 1, 10)) AS date,
+                   COALESCE(SUM(CASE WHEN qty_delta > 0 THEN qty_delta END), 0) AS in_qty,
+                   COALESCE(SUM(CASE WHEN qty_delta < 0 THEN -qty_delta END), 0) AS out_qty,
+                   COUNT(*) OVER () AS n_refs
+              FROM mv
+             GROUP BY ref_type, ref_id
+             ORDER BY date DESC, ref_type DESC, ref_id DESC
+             LIMIT ?
+        ),
+        names AS (
+            SELECT mv.ref_type, mv.ref_id, mv.nm,
+                   ROW_NUMBER() OVER (PARTITION BY mv.ref_type, mv.ref_id
+                                      ORDER BY MAX(mv.created_at) DESC, MAX(mv.id) DESC) AS rn
+              FROM mv
+              JOIN refs r ON r.ref_type IS mv.ref_type AND r.ref_id IS mv.ref_id
+             GROUP BY mv.ref_type, mv.ref_id, mv.nm
+        ),
+        prev AS (
+            SELECT ref_type, ref_id,
+                   GROUP_CONCAT(CASE WHEN rn <= 6 THEN nm END, ', ') AS items_preview,
+                   COUNT(*) AS items_count
+              FROM (SELECT * FROM names ORDER BY ref_type, ref_id, rn)
+             GROUP BY ref_type, ref_id
+        )
+        SELECT r.ref_type, r.ref_id, r.date, r.in_qty, r.out_qty, r.n_refs,
+               COALESCE(p.items_preview, '') || CASE WHEN COALESCE(p.items_count, 0) > 6 THEN '…' ELSE '' END AS items_preview,
+               COALESCE(p.items_count, 0) AS items_count
+          FROM refs r
+          LEFT JOIN prev p ON p.ref_type IS r.ref_type AND p.ref_id IS r.ref_id
+         ORDER BY r.date DESC, r.ref_type DESC, r.ref_id DESC
+        """,
+        params + [group_limit],
     ).fetchall()
 
+    # seletor de peça é carregado sob demanda (/api/inventory_search); aqui só o item já escolhido
+    item_label = ""
+    if item_id.isdigit():
+        sel = db.execute("SELECT name, sku FROM inventory WHERE id=?", (int(item_id),)).fetchone()
+        if sel:
+            item_label = sel["name"] + (f" ({sel['sku']})" if sel["sku"] else "")
+
     return render_template(
         "financeiro_estoque.html",
         title="Extrato de Estoque",
         rows=rows,
+        total_rows=int(tot["n"] or 0),
+        next_cursor=next_cursor,
+        cursor=cursor,
         start=start,
         end=end,
         direction=direction,
         ref_type=ref_type,
         item_id=item_id,
+        item_label=item_label,
         q=q,
-        qty_in=qty_in,
-        qty_out=qty_out,
-        val_in=val_in,
-        val_out=val_out,
+        qty_in=float(tot["qty_in"] or 0),
+        qty_out=float(tot["qty_out"] or 0),
+        val_in=float(tot["val_in"] or 0),
+        val_out=float(tot["val_out"] or 0),
         by_item_rows=by_item_rows,
         by_ref_rows=by_ref_rows,
-        inventory_options=inventory_options,
+        n_items=by_item_rows[0]["n_items"] if by_item_rows else 0,
+        n_refs=by_ref_rows[0]["n_refs"] if by_ref_rows else 0,
     )
 
 
@@ -2630,39 +5771,27 @@ def servico_avulso():
 # --------------------------
 # Compras de estoque
 # --------------------------
-def _purchase_stock_adjust(db, old_items, new_items, old_eff: bool, new_eff: bool):
-    """Ajusta estoque por delta considerando status antigo/novo (Efetivado aplica)."""
+def _purchase_stock_adjust(db, old_items, new_items, old_eff: bool, new_eff: bool, purchase_id: int | None = None):
+    """Ajusta estoque por delta considerando status antigo/novo (Efetivado aplica)
+    e deixa as camadas de custo da compra iguais aos itens efetivados (custo_estoque)."""
     def agg(items):
-        d={}
+        # {inv_id: (qtd, custo unitário médio ponderado)} numa passada só
+        d = {}
         for it in items:
-            inv=int(it["inventory_id"])
-            d[inv]=d.get(inv,0.0)+float(it["qty"])
-        return d
+            inv = int(it["inventory_id"])
+            q, v = d.get(inv, (0.0, 0.0))
+            d[inv] = (q + float(it["qty"] or 0), v + float(it["qty"] or 0) * float(it["unit_cost"] or 0))
+        return {inv: (q, (v / q) if q else 0.0) for inv, (q, v) in d.items()}
 
     old_map = agg(old_items) if old_eff else {}
     new_map = agg(new_items) if new_eff else {}
-    all_ids = set(old_map.keys()) | set(new_map.keys())
-
-    for inv_id in all_ids:
-        delta = float(new_map.get(inv_id,0.0) - old_map.get(inv_id,0.0))
-        if abs(delta) < 1e-9:
-            continue
-        if delta > 0:
-            row = db.execute("SELECT stock, cost_price FROM inventory WHERE id=?", (inv_id,)).fetchone()
-            if row:
-                cur_stock = float(row["stock"] or 0)
-                cur_cost = float(row["cost_price"] or 0)
-                unit_cost = None
-                for it in new_items:
-                    if int(it["inventory_id"]) == inv_id:
-                        unit_cost = float(it["unit_cost"] or 0)
-                        break
-                if unit_cost is None:
-                    unit_cost = cur_cost
-                if cur_stock + delta > 0:
-                    new_cost = ((cur_stock*cur_cost) + (delta*unit_cost)) / (cur_stock + delta)
-                    db.execute("UPDATE inventory SET cost_price=? WHERE id=?", (new_cost, inv_id))
-        db.execute("UPDATE inventory SET stock = stock + ? WHERE id=?", (delta, inv_id))
+    ledger.record_movements(
+        db,
+        [(inv_id, new_map.get(inv_id, (0.0, 0.0))[0] - old_map.get(inv_id, (0.0, 0.0))[0]) for inv_id in set(old_map) | set(new_map)],
+        ledger.COMPRA, "PURCHASE", purchase_id,
+    )
+    if purchase_id is not None:
+        custo.apply_purchase(db, purchase_id, new_map)
 
 
 def _upsert_purchase_fin_tx(db, purchase_id: int, supplier: str, total: float, date: str, due_date: str|None, status: str, payment_method_id, items: list):
@@ -2767,6 +5896,16 @@ def _compras_form(purchase_id: int|None):
             """,
             (purchase_id,),
         ).fetchall()
+    elif request.method == "GET" and request.args.get("sugestao"):
+        # nova compra pré-preenchida com a sugestão de reposição (até 60 linhas do formulário)
+        lead, cover = _reorder_params()
+        try:
+            items = [
+                {"inventory_id": s["inventory_id"], "qty": s["suggested_qty"], "unit_cost": s["unit_cost"]}
+                for s in reorder_suggestions(db, lead, cover)[:60]
+            ]
+        except RuntimeError as e:
+            flash(str(e), "error")
 
     if request.method == "POST":
         supplier = (request.form.get("supplier") or "").strip()
@@ -2835,7 +5974,7 @@ def _compras_form(purchase_id: int|None):
 
             old_eff = (old_status == "EFETIVADO") if old_status is not None else False
             new_eff = (status == "EFETIVADO")
-            _purchase_stock_adjust(db, old_items, new_items, old_eff, new_eff)
+            _purchase_stock_adjust(db, old_items, new_items, old_eff, new_eff, purchase_id)
 
             fin_tx_id = _upsert_purchase_fin_tx(db, purchase_id, supplier, total, date, due_date, status, pm_id, new_items)
             try:
@@ -2861,6 +6000,7 @@ if __name__ == "__main__":
     first_time = not os.path.exists(DB_PATH)
     with app.app_context():
         init_db()
+    start_fin_outbox_worker()
     if first_time:
         print("Banco criado em", DB_PATH)
     print(f"================== {APP_TITLE} ==================")
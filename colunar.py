@@ -0,0 +1,276 @@
+"""Cache colunar em memória (numpy) das tabelas grandes do FCAR, para relatórios.
+
+Cada tabela de TABLES vira um conjunto de colunas numpy na ordem em que as linhas
+foram lidas; texto vira código inteiro (dicionário por coluna, só cresce). Os
+relatórios filtram/agrupam/ordenam direto nos arrays, sem varrer o SQLite.
+
+Sincronização incremental (sync), numa transação de leitura curta (não segura o escritor no WAL):
+- linhas novas: rowid > marca d'água da tabela
+- alteradas/apagadas: triggers gravam (tabela, rowid) em colunar_changes; a posição
+  antiga vira "morta" e a linha atual, se ainda existe, é relida e acrescentada
+- inseridas com id explícito abaixo do maior (ex.: OS antigas do import_migracao_pdfs.py)
+  também vão para colunar_changes, já que a marca d'água não as alcança
+- muitas linhas mortas -> a tabela é compactada; log podado -> recarga completa
+
+Cada sync devolve um Snapshot imutável (arrays nunca são alterados no lugar), então
+leitores em outras threads continuam vendo um estado consistente.
+Não depende do Flask; ensure_schema é chamado pelo init_db do app.py.
+"""
+
+import sqlite3
+import threading
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+CHANGES_KEEP = 50_000  # entradas mantidas em colunar_changes (processos atrasados além disso recarregam tudo)
+COMPACT_RATIO = 0.2
+
+# tipos de coluna: "i" inteiro (NULL -> 0), "f" real (NULL -> 0), "s" texto codificado
+# "day" é dias desde 1970-01-01 (julianday - 2440587.5)
+TABLES = {
+    "orders": {
+        "select": """SELECT rowid AS rid, id,
+                            CAST(julianday(substr(created_at, 1, 10)) - 2440587.5 AS INTEGER) AS day,
+                            client_id, mechanic_id, status, labor, pay_method
+                       FROM orders""",
+        "columns": {"id": "i", "day": "i", "client_id": "i", "mechanic_id": "i",
+                    "status": "s", "labor": "f", "pay_method": "s"},
+        "watch": "created_at, client_id, mechanic_id, status, labor, pay_method",
+    },
+    "order_items": {
+        "select": """SELECT rowid AS rid, order_id, inventory_id, UPPER(TRIM(description)) AS description,
+                            qty, total, is_labor
+                       FROM order_items""",
+        "columns": {"order_id": "i", "inventory_id": "i", "description": "s",
+                    "qty": "f", "total": "f", "is_labor": "i"},
+        "watch": "order_id, inventory_id, description, qty, total, is_labor",
+    },
+    "inventory": {
+        "select": "SELECT rowid AS rid, id, name, cost_price, price, is_labor FROM inventory",
+        "columns": {"id": "i", "name": "s", "cost_price": "f", "price": "f", "is_labor": "i"},
+        "watch": "name, cost_price, price, is_labor",
+    },
+    "fin_transactions": {
+        "select": """SELECT rowid AS rid, id, ttype, amount,
+                            CAST(julianday(date) - 2440587.5 AS INTEGER) AS day,
+                            status, payment_method_id, category_id
+                       FROM fin_transactions""",
+        "columns": {"id": "i", "ttype": "s", "amount": "f", "day": "i",
+                    "status": "s", "payment_method_id": "i", "category_id": "i"},
+        "watch": "ttype, amount, date, status, payment_method_id, category_id",
+    },
+}
+
+
+def schema_sql(tables=None) -> str:
+    tables = tables or TABLES
+    sql = [
+        """CREATE TABLE IF NOT EXISTS colunar_changes(
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tbl TEXT NOT NULL,
+    rid INTEGER NOT NULL
+);"""
+    ]
+    for t, spec in tables.items():
+        sql.append(
+            f"""CREATE TRIGGER IF NOT EXISTS trg_colunar_{t}_upd AFTER UPDATE OF {spec['watch']} ON {t}
+BEGIN
+    INSERT INTO colunar_changes(tbl, rid) VALUES ('{t}', OLD.rowid);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_colunar_{t}_ins AFTER INSERT ON {t}
+WHEN NEW.rowid < (SELECT MAX(rowid) FROM {t})
+BEGIN
+    INSERT INTO colunar_changes(tbl, rid) VALUES ('{t}', NEW.rowid);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_colunar_{t}_del AFTER DELETE ON {t}
+BEGIN
+    INSERT INTO colunar_changes(tbl, rid) VALUES ('{t}', OLD.rowid);
+END;"""
+        )
+    return "\n".join(sql)
+
+
+def ensure_schema(con, tables=None) -> None:
+    con.executescript(schema_sql(tables))
+    con.commit()
+
+
+class Snapshot:
+    """Estado do cache num instante. table(t) devolve só as linhas vivas (memorizado)."""
+
+    def __init__(self, raw: dict, strings: dict, codes: dict, version: int):
+        self._raw = raw          # t -> {"rid", "alive", colunas...}
+        self._strings = strings  # (t, col) -> lista de valores (código = índice)
+        self._codes = codes      # (t, col) -> {valor: código}
+        self.version = version
+        self._views = {}
+        self._indexes = {}
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def table(self, t: str) -> dict:
+        with self._lock:
+            v = self._views.get(t)
+            if v is None:
+                raw = self._raw[t]
+                alive = raw["alive"]
+                v = {k: a[alive] for k, a in raw.items() if k not in ("alive",)}
+                self._views[t] = v
+            return v
+
+    def memo(self, key, fn):
+        """Resultado de fn() guardado neste snapshot (um snapshot novo, com dados novos, recalcula)."""
+        with self._lock:
+            if key in self._memo:
+                return self._memo[key]
+        val = fn()
+        with self._lock:
+            return self._memo.setdefault(key, val)
+
+    def strings(self, t: str, col: str) -> list:
+        return self._strings[(t, col)]
+
+    def code(self, t: str, col: str, value: str) -> int:
+        """Código de um texto na coluna (-1 se nunca apareceu)."""
+        return self._codes[(t, col)].get(value, -1)
+
+    def lookup(self, t: str, key: str, values):
+        """Posição (em table(t)) de cada valor da coluna-chave; -1 onde não existe."""
+        with self._lock:
+            idx = self._indexes.get((t, key))
+        if idx is None:
+            col = self.table(t)[key]
+            order = np.argsort(col, kind="stable")
+            idx = (col[order], order)
+            with self._lock:
+                self._indexes[(t, key)] = idx
+        sorted_keys, order = idx
+        values = np.asarray(values, dtype=np.int64)
+        if not len(sorted_keys):
+            return np.full(len(values), -1, dtype=np.int64)
+        pos = np.searchsorted(sorted_keys, values)
+        pos_c = np.minimum(pos, len(sorted_keys) - 1)
+        found = sorted_keys[pos_c] == values
+        return np.where(found, order[pos_c], -1)
+
+
+class ColumnarCache:
+    def __init__(self, db_path: str, tables=None):
+        if np is None:
+            raise RuntimeError("numpy não está instalado (pip install numpy).")
+        self.db_path = db_path
+        self.tables = tables or TABLES
+        self._lock = threading.Lock()
+        self._raw = None
+        self._strings = {(t, c): [] for t, spec in self.tables.items() for c, k in spec["columns"].items() if k == "s"}
+        self._codes = {key: {} for key in self._strings}
+        self._max_rid = {}
+        self._seq = 0
+        self._version = 0
+        self._snapshot = None
+
+    # -- leitura das linhas do SQLite para colunas
+    def _columns(self, t: str, rows: list) -> dict:
+        spec = self.tables[t]["columns"]
+        n = len(rows)
+        out = {"rid": np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)}
+        for j, (c, kind) in enumerate(spec.items(), start=1):
+            if kind == "i":
+                out[c] = np.fromiter((r[j] or 0 for r in rows), dtype=np.int64, count=n)
+            elif kind == "f":
+                out[c] = np.fromiter((r[j] or 0.0 for r in rows), dtype=np.float64, count=n)
+            else:
+                codes, values = self._codes[(t, c)], self._strings[(t, c)]
+
+                def enc(v):
+                    v = v if v is not None else ""
+                    k = codes.get(v)
+                    if k is None:
+                        k = codes[v] = len(values)
+                        values.append(v)
+                    return k
+
+                out[c] = np.fromiter((enc(r[j]) for r in rows), dtype=np.int32, count=n)
+        out["alive"] = np.ones(n, dtype=bool)
+        return out
+
+    def _read(self, con, t: str, where: str = "", params=()) -> dict:
+        rows = con.execute(f"SELECT * FROM ({self.tables[t]['select']}) {where} ORDER BY rid", params).fetchall()
+        return self._columns(t, rows)
+
+    @staticmethod
+    def _concat(a: dict, b: dict) -> dict:
+        return {k: np.concatenate((a[k], b[k])) for k in a}
+
+    def _full_load(self, con, seq_now: int) -> None:
+        self._raw = {}
+        for t in self.tables:
+            self._raw[t] = self._read(con, t)
+            rid = self._raw[t]["rid"]
+            self._max_rid[t] = int(rid.max()) if len(rid) else 0
+        self._seq = seq_now
+
+    def _apply(self, con, seq_now: int) -> bool:
+        changed = {}
+        for tbl, rid in con.execute(
+            "SELECT DISTINCT tbl, rid FROM colunar_changes WHERE seq > ? AND seq <= ?", (self._seq, seq_now)
+        ):
+            changed.setdefault(tbl, []).append(rid)
+        touched = False
+        for t in self.tables:
+            raw = self._raw[t]
+            new = self._read(con, t, "WHERE rid > ?", (self._max_rid[t],))
+            rids = [r for r in changed.get(t, []) if r <= self._max_rid[t]]
+            if rids:
+                dead = np.isin(raw["rid"], np.asarray(rids, dtype=np.int64)) & raw["alive"]
+                if dead.any():
+                    raw = dict(raw, alive=raw["alive"] & ~dead)
+                reread = self._read(con, t, "WHERE rid IN (SELECT value FROM json_each(?))",
+                                    ("[" + ",".join(map(str, rids)) + "]",))
+                new = self._concat(reread, new) if len(new["rid"]) else reread
+            if len(new["rid"]):
+                raw = self._concat(raw, new)
+                self._max_rid[t] = max(self._max_rid[t], int(new["rid"].max()))
+            if raw is not self._raw[t]:
+                n_dead = len(raw["alive"]) - int(raw["alive"].sum())
+                if n_dead > 1000 and n_dead > COMPACT_RATIO * len(raw["alive"]):
+                    raw = {k: a[raw["alive"]] for k, a in raw.items()}
+                self._raw[t] = raw
+                touched = True
+        self._seq = seq_now
+        return touched
+
+    def sync(self) -> Snapshot:
+        """Traz as mudanças desde a última chamada e devolve o snapshot atual."""
+        with self._lock:
+            con = sqlite3.connect(self.db_path, timeout=30)
+            try:
+                con.execute("BEGIN")  # uma leitura consistente (WAL: não bloqueia quem grava)
+                seq_now, seq_min = con.execute("SELECT COALESCE(MAX(seq), 0), MIN(seq) FROM colunar_changes").fetchone()
+                if self._raw is None or (seq_min is not None and self._seq < seq_min - 1):
+                    self._full_load(con, seq_now)
+                    touched = True
+                else:
+                    touched = seq_now != self._seq or self._has_new_rows(con)
+                    if touched:
+                        touched = self._apply(con, seq_now)
+                con.execute("COMMIT")
+                if seq_min is not None and seq_now - seq_min > 2 * CHANGES_KEEP:
+                    con.execute("DELETE FROM colunar_changes WHERE seq <= ?", (seq_now - CHANGES_KEEP,))
+                    con.commit()
+            finally:
+                con.close()
+            if touched or self._snapshot is None:
+                self._version += 1
+                self._snapshot = Snapshot(dict(self._raw), self._strings, self._codes, self._version)
+            return self._snapshot
+
+    def _has_new_rows(self, con) -> bool:
+        for t in self.tables:
+            r = con.execute(f"SELECT 1 FROM {t} WHERE rowid > ? LIMIT 1", (self._max_rid[t],)).fetchone()
+            if r:
+                return True
+        return False
@@ -0,0 +1,273 @@
+"""Custo do estoque do FCAR por camadas (custo médio ou PEPS/FIFO).
+
+Cada entrada vira uma camada (item, qtd, custo unitário, saldo da camada); cada
+saída consome camadas e grava o custo exato em cost_issues (base das margens).
+inventory.cost_price é recalculado a partir das camadas dos itens mexidos:
+- MEDIO: média ponderada do saldo das camadas (a saída baixa as camadas na proporção)
+- FIFO:  custo da camada mais antiga com saldo (a saída consome das mais antigas)
+
+O método vem de FCAR_COST_METHOD (MEDIO | FIFO, padrão MEDIO).
+Chamado pelo movimentos_estoque.record_movements e pelas compras do app.py;
+não depende do Flask e nada aqui faz commit (exceto ensure_schema).
+"""
+
+import datetime
+import json
+import os
+
+MEDIO = "MEDIO"
+FIFO = "FIFO"
+
+EPS = 1e-9
+
+SCHEMA_SQL = r"""
+CREATE TABLE IF NOT EXISTS cost_layers(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    inventory_id INTEGER NOT NULL,
+    ref_type TEXT NOT NULL,              -- PURCHASE/ABERTURA/AJUSTE/OS/...
+    ref_id INTEGER,
+    qty_in REAL NOT NULL,
+    qty_left REAL NOT NULL,
+    unit_cost REAL NOT NULL,
+    created_at TEXT NOT NULL,
+    UNIQUE(ref_type, ref_id, inventory_id)
+);
+CREATE INDEX IF NOT EXISTS idx_cost_layers_item ON cost_layers(inventory_id, id);
+
+CREATE TABLE IF NOT EXISTS cost_issues(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    inventory_id INTEGER NOT NULL,
+    ref_type TEXT,                       -- OS/PURCHASE/AJUSTE/...
+    ref_id INTEGER,
+    qty REAL NOT NULL,                   -- positivo = saída; negativo = devolução
+    cost_total REAL NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cost_issues_ref ON cost_issues(ref_type, ref_id, inventory_id);
+"""
+
+# pedidos [(inventory_id, qty)] entram como um único parâmetro JSON
+_REQ_CTE = """
+req(inventory_id, q) AS (
+    SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]') FROM json_each(?)
+)
+"""
+
+
+def method() -> str:
+    m = (os.environ.get("FCAR_COST_METHOD") or MEDIO).strip().upper()
+    return FIFO if m in ("FIFO", "PEPS") else MEDIO
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def ensure_schema(con) -> None:
+    """Cria as tabelas e, na primeira vez, abre uma camada com o saldo/custo atual de cada item."""
+    con.executescript(SCHEMA_SQL)
+    if con.execute("SELECT 1 FROM cost_layers LIMIT 1").fetchone() is None:
+        con.execute(
+            """
+            INSERT INTO cost_layers(inventory_id, ref_type, ref_id, qty_in, qty_left, unit_cost, created_at)
+            SELECT id, 'ABERTURA', NULL, stock, stock, cost_price, ? FROM inventory WHERE stock > 0
+            """,
+            (_now(),),
+        )
+    con.commit()
+
+
+def refresh_cost_price(con, inv_ids) -> None:
+    """Recalcula inventory.cost_price dos itens a partir das camadas com saldo (um UPDATE só)."""
+    ids = sorted({int(i) for i in inv_ids})
+    if not ids:
+        return
+    if method() == FIFO:
+        expr = "(SELECT l.unit_cost FROM cost_layers l WHERE l.inventory_id = inventory.id AND l.qty_left > 1e-9 ORDER BY l.id LIMIT 1)"
+    else:
+        expr = "(SELECT SUM(l.qty_left * l.unit_cost) / SUM(l.qty_left) FROM cost_layers l WHERE l.inventory_id = inventory.id AND l.qty_left > 1e-9)"
+    con.execute(
+        f"""
+        UPDATE inventory SET cost_price = {expr}
+         WHERE id IN (SELECT value FROM json_each(?))
+           AND EXISTS (SELECT 1 FROM cost_layers l WHERE l.inventory_id = inventory.id AND l.qty_left > 1e-9)
+        """,
+        (json.dumps(ids),),
+    )
+
+
+def _consume(con, req: dict, ref_type, ref_id, now: str) -> None:
+    """Baixa das camadas as quantidades de req {inventory_id: qty>0} e grava o custo em cost_issues."""
+    payload = json.dumps([[i, q] for i, q in req.items()])
+    if method() == FIFO:
+        take_cte = f"""
+        WITH {_REQ_CTE},
+        lay AS (
+            SELECT l.id, l.inventory_id, l.qty_left, l.unit_cost, r.q,
+                   COALESCE(SUM(l.qty_left) OVER (PARTITION BY l.inventory_id ORDER BY l.id
+                                                  ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) AS before
+              FROM cost_layers l JOIN req r ON r.inventory_id = l.inventory_id
+             WHERE l.qty_left > 1e-9
+        ),
+        take AS (SELECT id, inventory_id, unit_cost, MIN(qty_left, MAX(q - before, 0)) AS qty FROM lay)
+        """
+    else:
+        take_cte = f"""
+        WITH {_REQ_CTE},
+        tot AS (
+            SELECT l.inventory_id, SUM(l.qty_left) AS left_total, r.q
+              FROM cost_layers l JOIN req r ON r.inventory_id = l.inventory_id
+             WHERE l.qty_left > 1e-9
+             GROUP BY l.inventory_id
+        ),
+        take AS (
+            SELECT l.id, l.inventory_id, l.unit_cost, l.qty_left * MIN(t.q / t.left_total, 1.0) AS qty
+              FROM cost_layers l JOIN tot t ON t.inventory_id = l.inventory_id
+             WHERE l.qty_left > 1e-9
+        )
+        """
+    got = {
+        int(r[0]): (float(r[1] or 0), float(r[2] or 0))
+        for r in con.execute(
+            take_cte + "SELECT inventory_id, SUM(qty), SUM(qty * unit_cost) FROM take GROUP BY inventory_id",
+            (payload,),
+        ).fetchall()
+    }
+    con.execute(
+        take_cte
+        + """
+        UPDATE cost_layers
+           SET qty_left = CASE WHEN cost_layers.qty_left - take.qty > 1e-9 THEN cost_layers.qty_left - take.qty ELSE 0 END
+          FROM take
+         WHERE take.id = cost_layers.id AND take.qty > 0
+        """,
+        (payload,),
+    )
+    # o que passar do saldo em camadas (estoque negativo) sai pelo custo atual do item
+    short = {i: q - got.get(i, (0.0, 0.0))[0] for i, q in req.items() if q - got.get(i, (0.0, 0.0))[0] > EPS}
+    cost_now = {}
+    if short:
+        cost_now = {
+            int(r[0]): float(r[1] or 0)
+            for r in con.execute(
+                "SELECT id, cost_price FROM inventory WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(short)),),
+            ).fetchall()
+        }
+    con.executemany(
+        "INSERT INTO cost_issues(inventory_id, ref_type, ref_id, qty, cost_total, created_at) VALUES (?,?,?,?,?,?)",
+        [
+            (i, ref_type, ref_id, q, got.get(i, (0.0, 0.0))[1] + short.get(i, 0.0) * cost_now.get(i, 0.0), now)
+            for i, q in req.items()
+        ],
+    )
+
+
+def _receive(con, req: dict, ref_type, ref_id, now: str) -> None:
+    """Entradas sem custo informado (ajuste, cadastro, devolução de OS) viram camada.
+    Devolução de um documento (ref_id) volta pelo custo médio do que ele tirou; o resto, pelo custo atual.
+    """
+    payload = json.dumps([[i, q] for i, q in req.items()])
+    rows = con.execute(
+        f"""
+        WITH {_REQ_CTE}
+        SELECT r.inventory_id, r.q,
+               COALESCE(
+                   (SELECT SUM(ci.cost_total) / NULLIF(SUM(ci.qty), 0) FROM cost_issues ci
+                     WHERE ci.ref_type = ? AND ci.ref_id = ? AND ci.inventory_id = r.inventory_id),
+                   i.cost_price, 0)
+          FROM req r LEFT JOIN inventory i ON i.id = r.inventory_id
+        """,
+        (payload, ref_type, ref_id),
+    ).fetchall()
+    unit = {int(r[0]): float(r[2] or 0) for r in rows}
+    if ref_id is not None:
+        con.executemany(
+            "INSERT INTO cost_issues(inventory_id, ref_type, ref_id, qty, cost_total, created_at) VALUES (?,?,?,?,?,?)",
+            [(i, ref_type, ref_id, -q, -q * unit[i], now) for i, q in req.items()],
+        )
+    con.executemany(
+        """
+        INSERT INTO cost_layers(inventory_id, ref_type, ref_id, qty_in, qty_left, unit_cost, created_at)
+        VALUES (?,?,?,?,?,?,?)
+        ON CONFLICT(ref_type, ref_id, inventory_id) DO UPDATE SET
+            unit_cost = (cost_layers.qty_left * cost_layers.unit_cost + excluded.qty_in * excluded.unit_cost)
+                        / (cost_layers.qty_left + excluded.qty_in),
+            qty_in = cost_layers.qty_in + excluded.qty_in,
+            qty_left = cost_layers.qty_left + excluded.qty_in
+        """,
+        [(i, ref_type or "ENTRADA", ref_id, q, q, unit[i], now) for i, q in req.items()],
+    )
+
+
+def apply_deltas(con, rows, reason: str, ref_type=None, ref_id=None) -> None:
+    """Custeia deltas de estoque [(inventory_id, delta)] que não são compra.
+    Saídas consomem camadas; entradas abrem camada. Sem commit.
+    """
+    out, inn = {}, {}
+    for inv_id, delta in rows:
+        if delta < 0:
+            out[int(inv_id)] = out.get(int(inv_id), 0.0) - float(delta)
+        elif delta > 0:
+            inn[int(inv_id)] = inn.get(int(inv_id), 0.0) + float(delta)
+    if not out and not inn:
+        return
+    now = _now()
+    ref_type = ref_type or reason
+    if out:
+        _consume(con, out, ref_type, ref_id, now)
+    if inn:
+        _receive(con, inn, ref_type, ref_id, now)
+    refresh_cost_price(con, set(out) | set(inn))
+
+
+def apply_purchase(con, purchase_id: int, items: dict) -> None:
+    """Deixa as camadas da compra iguais a items {inventory_id: (qty, unit_cost)}
+    ({} quando a compra não está efetivada). Edição preserva o que já saiu de cada camada;
+    se a compra diminuir abaixo do que já foi consumido, a diferença sai das outras camadas.
+    """
+    old = {
+        int(r[0]): (float(r[1]), float(r[2]))
+        for r in con.execute(
+            "SELECT inventory_id, qty_in, qty_left FROM cost_layers WHERE ref_type = 'PURCHASE' AND ref_id = ?",
+            (purchase_id,),
+        ).fetchall()
+    }
+    short = {}
+    for inv_id, (qty_in, qty_left) in old.items():
+        consumed = qty_in - qty_left
+        new_qty = items.get(inv_id, (0.0, 0.0))[0]
+        if consumed - new_qty > EPS:
+            short[inv_id] = consumed - new_qty
+
+    now = _now()
+    con.execute(
+        "DELETE FROM cost_layers WHERE ref_type = 'PURCHASE' AND ref_id = ? AND inventory_id NOT IN (SELECT value FROM json_each(?))",
+        (purchase_id, json.dumps(list(items))),
+    )
+    con.execute(
+        """
+        WITH req(inventory_id, q, c) AS (
+            SELECT json_extract(value, '$[0]'), json_extract(value, '$[1]'), json_extract(value, '$[2]') FROM json_each(?)
+        )
+        INSERT INTO cost_layers(inventory_id, ref_type, ref_id, qty_in, qty_left, unit_cost, created_at)
+        SELECT inventory_id, 'PURCHASE', ?, q, q, c, ? FROM req WHERE true
+        ON CONFLICT(ref_type, ref_id, inventory_id) DO UPDATE SET
+            qty_left = MAX(excluded.qty_in - (cost_layers.qty_in - cost_layers.qty_left), 0),
+            qty_in = excluded.qty_in,
+            unit_cost = excluded.unit_cost
+        """,
+        (json.dumps([[i, q, c] for i, (q, c) in items.items()]), purchase_id, now),
+    )
+    if short:
+        _consume(con, short, "PURCHASE", purchase_id, now)
+    refresh_cost_price(con, set(old) | set(items))
+
+
+def issued_cost(con, ref_type: str, ref_id: int) -> float:
+    """Custo das peças que saíram por um documento (ex.: CMV de uma OS)."""
+    r = con.execute(
+        "SELECT COALESCE(SUM(cost_total), 0) FROM cost_issues WHERE ref_type = ? AND ref_id = ?",
+        (ref_type, ref_id),
+    ).fetchone()
+    return float(r[0] or 0)
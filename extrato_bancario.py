@@ -0,0 +1,177 @@
+"""Leitura de extratos bancários / de maquininha (CSV e OFX) para a conciliação do FCAR.
+
+Tudo local, linha a linha: cada lançamento do extrato vira um dict normalizado
+    {date: 'YYYY-MM-DD', ttype: 'IN'|'OUT', amount_cents: int (>0), description, fitid, line_hash}
+que o app.py grava em fin_statement_lines e casa com fin_transactions.
+Não depende do Flask.
+"""
+
+import csv
+import datetime
+import hashlib
+import io
+import re
+
+_DATE_FORMATS = ("%d/%m/%Y", "%Y-%m-%d", "%d/%m/%y", "%d-%m-%Y", "%Y%m%d")
+
+
+def parse_date(v: str) -> str | None:
+    v = (v or "").strip()[:10]
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(v, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_cents(v: str, decimal: str = ",") -> int | None:
+    """Valor em centavos, aceitando '1.234,56', '-1234.56', 'R$ 10,00', '(10,00)'.
+    Sem vírgula, ponto seguido de exatamente 3 dígitos ('1.234', '12.345.678') é sempre milhar,
+    a não ser com decimal="." (OFX, onde o ponto é o separador decimal do padrão)."""
+    v = (v or "").strip().replace("R$", "").replace(" ", "")
+    if not v:
+        return None
+    neg = v.startswith("-") or (v.startswith("(") and v.endswith(")")) or v.upper().endswith("D")
+    v = v.strip("()+-").rstrip("DdCc")
+    if "," in v:
+        v = v.replace(".", "").replace(",", ".")
+    elif decimal == "," and re.fullmatch(r"[1-9]\d{0,2}(\.\d{3})+", v):
+        v = v.replace(".", "")
+    try:
+        cents = int(round(float(v) * 100))
+    except ValueError:
+        return None
+    return -cents if neg else cents
+
+
+def _entry(date: str, cents: int, description: str, fitid: str | None, seen: dict) -> dict:
+    # sem FITID, duas linhas idênticas no mesmo arquivo são lançamentos diferentes (n-ésima ocorrência)
+    key = fitid or f"{date}|{cents}|{description.strip().upper()}"
+    seen[key] = seen.get(key, 0) + 1
+    raw = f"{key}#{seen[key]}" if not fitid else f"FITID|{fitid}"
+    return {
+        "date": date,
+        "ttype": "IN" if cents > 0 else "OUT",
+        "amount_cents": abs(cents),
+        "description": description.strip()[:200],
+        "fitid": fitid,
+        "line_hash": hashlib.sha1(raw.encode("utf-8")).hexdigest(),
+    }
+
+
+def _get(row: dict, *keys):
+    lower = {str(k).strip().lower(): v for k, v in row.items() if k is not None}
+    for k in keys:
+        v = lower.get(k)
+        if v not in (None, ""):
+            return v
+    return ""
+
+
+def iter_csv(f, errors: list):
+    """Linhas de um extrato CSV (; ou ,). Colunas aceitas: data, descrição/histórico, valor
+    (ou crédito/débito separados), id/documento opcional."""
+    sample = f.read(2048)
+    f.seek(0)
+    delim = ";" if sample.count(";") >= sample.count(",") else ","
+    reader = csv.DictReader(f, delimiter=delim)
+    seen = {}
+    for line_no, row in enumerate(reader, start=2):
+        date = parse_date(_get(row, "data", "date", "dt", "data lançamento", "data lancamento", "data da venda"))
+        desc = str(_get(row, "descrição", "descricao", "histórico", "historico", "description", "memo", "lançamento", "lancamento"))
+        cents = parse_cents(_get(row, "valor", "amount", "value", "valor líquido", "valor liquido"))
+        if cents is None:
+            cred = parse_cents(_get(row, "crédito", "credito", "entrada"))
+            deb = parse_cents(_get(row, "débito", "debito", "saída", "saida"))
+            if cred or deb:
+                cents = abs(cred or 0) - abs(deb or 0)
+        if not date or not cents:
+            if any((v or "").strip() for v in row.values() if isinstance(v, str)):
+                errors.append((line_no, "data ou valor inválido"))
+            continue
+        fitid = str(_get(row, "id", "fitid", "documento", "nsu", "autorização", "autorizacao")).strip() or None
+        yield _entry(date, cents, desc, fitid, seen)
+
+
+_OFX_TOKEN = re.compile(r"<(/?)(\w+)>([^<]*)")
+_OFX_BLOCK = 64 * 1024
+
+
+def _ofx_entry(cur: dict, seen: dict, errors: list) -> dict | None:
+    date = parse_date((cur.get("DTPOSTED") or "")[:8])
+    cents = parse_cents(cur.get("TRNAMT"), decimal=".")
+    if date and cents:
+        return _entry(date, cents, cur.get("MEMO") or cur.get("NAME") or "", cur.get("FITID") or None, seen)
+    errors.append((cur.get("FITID") or "?", "lançamento OFX sem data ou valor"))
+    return None
+
+
+def iter_ofx(f, errors: list):
+    """Lançamentos <STMTTRN> de um OFX (SGML ou XML), lido em blocos e separado por tag, não por
+    linha: muito banco manda o XML inteiro numa linha só.
+
+    >>> import io
+    >>> ofx = ("<OFX><BANKTRANLIST><STMTTRN><TRNTYPE>DEBIT</TRNTYPE><DTPOSTED>20260105</DTPOSTED>"
+    ...        "<TRNAMT>-1.234</TRNAMT><FITID>A1</FITID><MEMO>Tarifa</MEMO></STMTTRN><STMTTRN>"
+    ...        "<TRNTYPE>CREDIT</TRNTYPE><DTPOSTED>20260106</DTPOSTED><TRNAMT>1234,50</TRNAMT>"
+    ...        "<FITID>A2</FITID><MEMO>Pix recebido</MEMO></STMTTRN></BANKTRANLIST></OFX>")
+    >>> [(e["date"], e["ttype"], e["amount_cents"], e["fitid"]) for e in iter_ofx(io.StringIO(ofx), [])]
+    [('2026-01-05', 'OUT', 123, 'A1'), ('2026-01-06', 'IN', 123450, 'A2')]
+    """
+    seen = {}
+    cur = None
+    buf = ""
+    while True:
+        block = f.read(_OFX_BLOCK)
+        buf += block
+        # o último token pode estar cortado no fim do bloco: fica para a próxima volta
+        cut = buf.rfind("<") if block else len(buf)
+        for close, tag, val in _OFX_TOKEN.findall(buf[:max(cut, 0)]):
+            tag = tag.upper()
+            if tag == "STMTTRN":
+                if cur is not None:  # SGML sem </STMTTRN>: o próximo lançamento fecha o anterior
+                    e = _ofx_entry(cur, seen, errors)
+                    if e:
+                        yield e
+                cur = None if close else {}
+            elif tag == "BANKTRANLIST" and close and cur is not None:
+                e = _ofx_entry(cur, seen, errors)
+                if e:
+                    yield e
+                cur = None
+            elif cur is not None and not close:
+                cur[tag] = val.strip()
+        buf = buf[max(cut, 0):]
+        if not block:
+            break
+    if cur is not None:
+        e = _ofx_entry(cur, seen, errors)
+        if e:
+            yield e
+
+
+def open_text(stream) -> io.TextIOWrapper:
+    """Abre o upload como texto; extrato de banco brasileiro costuma vir em CP1252 (com ou sem aviso)."""
+    head = stream.read(4096)
+    stream.seek(0)
+    enc = "utf-8-sig"
+    if b"CHARSET:1252" in head.upper() or b"WINDOWS-1252" in head.upper():
+        enc = "cp1252"
+    else:
+        try:
+            head.decode("utf-8")
+        except UnicodeDecodeError as e:
+            if e.start < len(head) - 3:  # erro no meio, não só um caractere cortado no fim do bloco
+                enc = "cp1252"
+    return io.TextIOWrapper(stream, encoding=enc, errors="replace", newline="")
+
+
+def iter_statement(stream, filename: str, errors: list):
+    """Escolhe o leitor pelo conteúdo/extensão e devolve (origem, gerador de lançamentos)."""
+    f = open_text(stream)
+    head = f.read(512)
+    f.seek(0)
+    if filename.lower().endswith(".ofx") or "OFXHEADER" in head.upper() or "<OFX>" in head.upper():
+        return "OFX", iter_ofx(f, errors)
+    return "CSV", iter_csv(f, errors)
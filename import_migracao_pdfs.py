@@ -21,6 +21,8 @@ from typing import Optional, List, Dict, Tuple
 
 import fitz  # PyMuPDF
 
+import movimentos_estoque as ledger
+
 RE_OS_FILE = re.compile(r"OS\s*#\s*(\d+)\.pdf$", re.IGNORECASE)
 RE_BRL = re.compile(r"[-+]?\d+(?:\.\d+)?(?:,\d+)?")
 
@@ -474,15 +476,17 @@ def find_inventory_id_by_name(db: sqlite3.Connection, desc: str) -> Optional[int
 
 def upsert_inventory(db: sqlite3.Connection, row: InventoryRow):
     sku = row.sku.strip().upper()
-    # sku é UNIQUE
+    # sku é UNIQUE; o saldo entra pelo livro de movimentos (item novo nasce com 0)
     db.execute(
         "INSERT OR IGNORE INTO inventory(name, sku, stock, min_stock, price, is_labor, cost_price, repasse_value) VALUES (?,?,?,?,?,?,?,?)",
-        (row.name, sku, int(row.stock), int(row.min_stock), float(row.price), 0, 0.0, 0.0),
+        (row.name, sku, 0, int(row.min_stock), float(row.price), 0, 0.0, 0.0),
     )
     db.execute(
-        "UPDATE inventory SET name=?, stock=?, min_stock=?, price=? WHERE sku=?",
-        (row.name, int(row.stock), int(row.min_stock), float(row.price), sku),
+        "UPDATE inventory SET name=?, min_stock=?, price=? WHERE sku=?",
+        (row.name, int(row.min_stock), float(row.price), sku),
     )
+    inv_id = db.execute("SELECT id FROM inventory WHERE sku=?", (sku,)).fetchone()[0]
+    ledger.set_stock(db, inv_id, int(row.stock), ledger.MIGRACAO)
 
 def ensure_fin_seed(db: sqlite3.Connection):
     # métodos
@@ -582,8 +586,8 @@ def upsert_fin_from_os(db: sqlite3.Connection, osr: OSRow, client_name: str):
         pass
 
 def upsert_os(db: sqlite3.Connection, osr: OSRow, client_id: int, vehicle_id: Optional[int], mech_id: Optional[int]):
-    # inserir/atualizar OS com id fixo
-    row = db.execute("SELECT id FROM orders WHERE id=? LIMIT 1", (osr.os_id,)).fetchone()
+    # inserir/atualizar OS com id fixo; devolve (created_at, client_id, vehicle_id) anteriores, se já existia
+    row = db.execute("SELECT id, created_at, client_id, vehicle_id FROM orders WHERE id=? LIMIT 1", (osr.os_id,)).fetchone()
     if row:
         db.execute(
             "UPDATE orders SET client_id=?, vehicle_id=?, created_at=?, status=?, notes=?, labor=?, mechanic_id=?, pay_method=?, pay_status=? WHERE id=?",
@@ -602,6 +606,16 @@ def upsert_os(db: sqlite3.Connection, osr: OSRow, client_id: int, vehicle_id: Op
             "INSERT INTO order_items(order_id, inventory_id, description, qty, unit_price, total, is_labor) VALUES (?,?,?,?,?,?,?)",
             (osr.os_id, it.inventory_id, it.description, float(it.qty), float(it.unit_price), float(it.total), int(it.is_labor)),
         )
+    return tuple(row[1:]) if row else None
+
+def refresh_derived(db: sqlite3.Connection, days, client_ids, vehicle_ids):
+    # o app mantém estas tabelas a cada gravação de OS; aqui as OS entram direto no banco
+    import app as fcar  # só os helpers (puxa o Flask, mas não sobe servidor)
+    fcar.refresh_mechanic_daily_stats(db, days)
+    fcar.invalidate_commissions(db, days)
+    fcar.refresh_client_stats(db, client_ids)
+    fcar.mark_service_due(db, vehicle_ids)  # recalculadas na próxima abertura de /agenda/revisoes
+    fcar.rebuild_os_reservations(db)
 
 def set_os_stock_applied(db: sqlite3.Connection, os_id: int, items: List[OSItem], status: str):
     if not is_consuming_status(status):
@@ -629,8 +643,10 @@ def main():
         raise SystemExit(f"Banco não encontrado: {db_path}")
 
     con = sqlite3.connect(db_path)
+    con.row_factory = sqlite3.Row
     con.execute("PRAGMA foreign_keys=ON")
     ensure_schema(con)
+    ledger.ensure_schema(con)
 
     # inventário
     inv_pdf = os.path.join(pdfdir, "Estoque.pdf")
@@ -665,6 +681,7 @@ def main():
     os_files.sort(key=lambda x: x[0])
 
     imported = 0
+    days, client_ids, vehicle_ids = set(), set(), set()
     for os_num, path in os_files:
         try:
             osr = parse_os_pdf(path)
@@ -682,7 +699,14 @@ def main():
             if it.is_labor == 0:
                 it.inventory_id = find_inventory_id_by_name(con, it.description)
 
-        upsert_os(con, osr, cid, vid, mid)
+        old = upsert_os(con, osr, cid, vid, mid)
+        days.add(osr.created_at)
+        client_ids.add(cid)
+        vehicle_ids.add(vid)
+        if old:
+            days.add(old[0])
+            client_ids.add(old[1])
+            vehicle_ids.add(old[2])
         set_os_stock_applied(con, osr.os_id, osr.items, osr.status)
 
         # financeiro por OS
@@ -692,6 +716,8 @@ def main():
 
         imported += 1
 
+    if imported:
+        refresh_derived(con, days, client_ids, vehicle_ids)
     con.commit()
     con.close()
     print(f"[OK] OS importadas/atualizadas: {imported}")
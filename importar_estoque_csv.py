@@ -16,23 +16,35 @@ Formato do CSV:
 - Colunas esperadas (mínimo): sku, name, stock, cost_price, price
 - Opcional: min_stock
 
-Obs: Se o SKU já existir, o script cria um SKU alternativo (ex: ABC-2).
+Obs: Se o SKU já existir, o item é atualizado; linha sem SKU ganha um SKU livre (ex: SKU-2).
+A gravação é em lote (SKUs carregados de uma vez, INSERT ... ON CONFLICT(sku) em blocos
+de CHUNK_SIZE linhas, uma transação só) e no fim sai o resumo com linhas/s.
+Cada SKU guarda o hash do que foi importado; na reimportação só as linhas que mudaram
+são gravadas (is_labor/repasse_value ficam como estão). Para só ver o que mudaria:
+    python importar_estoque_csv.py meu_estoque.csv --dry-run
 """
 
 import csv
+import datetime
+import hashlib
 import os
 import re
 import sqlite3
 import sys
+import time
 from glob import glob
 
+import movimentos_estoque as ledger
+
 BASE_DIR = os.path.dirname(__file__)
 DB_PATH = os.path.join(BASE_DIR, "oficina.db")
 DEFAULT_CSV = os.path.join(BASE_DIR, "estoque.csv")
 MODEL_CSV = os.path.join(BASE_DIR, "estoque_modelo.csv")
+CHUNK_SIZE = 1000  # linhas por executemany
 
 
 def to_float(v: str) -> float:
+    """Número em formato BR ("R$ 1.234,50"); vazio = 0, sem número nenhum = ValueError."""
     if v is None:
         return 0.0
     v = str(v).strip()
@@ -48,10 +60,13 @@ def to_float(v: str) -> float:
     except ValueError:
         # pega primeiro número que aparecer
         m = re.search(r"-?\d+(?:\.\d+)?", v)
-        return float(m.group(0)) if m else 0.0
+        if not m:
+            raise ValueError(v)
+        return float(m.group(0))
 
 
 def to_int(v: str) -> int:
+    """Inteiro (ignora separador de milhar); vazio = 0, sem número nenhum = ValueError."""
     if v is None:
         return 0
     v = str(v).strip()
@@ -59,7 +74,9 @@ def to_int(v: str) -> int:
         return 0
     v = v.replace(".", "")
     m = re.search(r"-?\d+", v)
-    return int(m.group(0)) if m else 0
+    if not m:
+        raise ValueError(v)
+    return int(m.group(0))
 
 
 def detect_delimiter(sample: str) -> str:
@@ -78,21 +95,22 @@ def ensure_db_exists():
     )
 
 
-def unique_sku(cur, sku: str) -> str:
+def unique_sku(taken: set, sku: str) -> str:
+    """SKU livre calculado em memória (taken = SKUs já usados; o escolhido entra no set)."""
     base = (sku or "").strip() or "SKU"
     n = 2
-    while True:
-        cur.execute("SELECT 1 FROM inventory WHERE sku = ?", (base,))
-        if not cur.fetchone():
-            return base
+    while base in taken:
         base = f"{base.split('-')[0]}-{n}"
         n += 1
+    taken.add(base)
+    return base
 
 
-def pick_csv_path() -> str:
+def pick_csv_path(args: list | None = None) -> str:
+    args = sys.argv[1:] if args is None else args
     # 1) argumento
-    if len(sys.argv) >= 2 and sys.argv[1].strip():
-        p = sys.argv[1].strip().strip('"').strip("'")
+    if args and args[0].strip():
+        p = args[0].strip().strip('"').strip("'")
         if not os.path.isabs(p):
             p = os.path.join(BASE_DIR, p)
         if os.path.exists(p) and p.lower().endswith(".csv"):
@@ -151,9 +169,189 @@ def get(row: dict, *keys):
     return ""
 
 
+def parse_row(row: dict) -> dict | None:
+    """Converte uma linha do CSV (aceita os vários nomes de coluna) no item a gravar.
+    Retorna None para linha sem SKU e sem nome; ValueError se quantidade/preço/custo não for número.
+    """
+    sku = str(get(row, 'sku', 'código', 'codigo', 'cod', 'ref')).strip()
+    name = str(get(row, 'name', 'descrição', 'descricao', 'produto', 'descrição do produto')).strip()
+    if not sku and not name:
+        return None
+
+    def num(conv, label, *keys):
+        v = get(row, *keys)
+        try:
+            return conv(v)
+        except ValueError:
+            raise ValueError(f"{label} inválido: {str(v).strip()!r}") from None
+
+    stock = num(to_int, "estoque", 'stock', 'qtd', 'quantidade')
+    cost_price = num(to_float, "custo", 'cost_price', 'custo', 'unit.(r$)', 'unit', 'unitario', 'unitário')
+    price = num(to_float, "preço", 'price', 'preço', 'preco', 'valor', 'vl. item(r$)', 'vl item')
+
+    min_stock = num(to_int, "estoque mínimo", 'min_stock', 'estoque mínimo', 'estoque minimo', 'minimo', 'mínimo')
+
+    if price == 0 and cost_price != 0:
+        price = cost_price
+
+    if not name:
+        name = f"Item {sku}" if sku else "Item"
+
+    return {"sku": sku, "name": name, "stock": stock, "min_stock": min_stock, "price": price, "cost_price": cost_price}
+
+
+IMPORT_SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS inventory_import_hashes(
+    sku TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,                  -- hash dos campos importados na última vez
+    imported_at TEXT NOT NULL
+);
+"""
+
+FIELDS = ("name", "stock", "min_stock", "price", "cost_price")
+
+
+def content_hash(it: dict) -> str:
+    """Hash dos campos que a importação grava (mesmo valor => linha não mudou)."""
+    raw = "\x1f".join([it["name"].strip(), str(int(it["stock"])), str(int(it["min_stock"])),
+                        f"{float(it['price']):.4f}", f"{float(it['cost_price']):.4f}"])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def field_diff(cur: dict, it: dict) -> dict:
+    """{campo: (atual, novo)} só dos campos que mudaram."""
+    out = {}
+    for f in FIELDS:
+        if f == "name":
+            same = str(cur[f]).strip() == str(it[f]).strip()
+        else:
+            same = abs(float(cur[f]) - float(it[f])) < 1e-9
+        if not same:
+            out[f] = (cur[f], it[f])
+    return out
+
+
+def load_sku_map(con) -> dict:
+    """{sku: {id, campos atuais, hash}} do estoque inteiro, numa consulta só.
+    Sem hash guardado (1ª importação com esta versão), usa o hash dos campos atuais.
+    """
+    out = {}
+    for r in con.execute(
+        """SELECT i.sku, i.id, i.name, i.stock, i.min_stock, i.price, i.cost_price, h.hash
+             FROM inventory i LEFT JOIN inventory_import_hashes h ON h.sku = i.sku
+            WHERE i.sku IS NOT NULL"""
+    ):
+        cur = {"id": int(r[1]), "name": r[2] or "", "stock": float(r[3] or 0), "min_stock": float(r[4] or 0),
+               "price": float(r[5] or 0), "cost_price": float(r[6] or 0)}
+        cur["hash"] = r[7] or content_hash(cur)
+        out[r[0]] = cur
+    return out
+
+
+def write_chunk(con, items: list, sku_map: dict, stats: dict, dry_run: bool = False) -> None:
+    """Grava um lote de itens já convertidos (sem commit), só o que mudou.
+    Cadastro via INSERT ... ON CONFLICT(sku) DO UPDATE (não mexe em is_labor/repasse_value);
+    o estoque vai pelo livro (delta por item). Em dry_run só conta e guarda exemplos.
+    """
+    # dentro do lote a última linha de cada SKU vale
+    by_sku = {}
+    for it in items:
+        sku = it["sku"] or unique_sku(stats["taken"], "")
+        if sku in by_sku:
+            stats["repeated"] += 1
+        stats["taken"].add(sku)
+        by_sku[sku] = dict(it, sku=sku, hash=content_hash(it))
+
+    new_skus, changed = [], []
+    for sku, it in by_sku.items():
+        cur = sku_map.get(sku)
+        if cur is None:
+            new_skus.append(sku)
+        elif cur["hash"] != it["hash"]:
+            changed.append(sku)
+            if len(stats["changes"]) < 50:
+                stats["changes"].append((sku, field_diff(cur, it)))
+        else:
+            stats["unchanged"] += 1
+    stats["inserted"] += len(new_skus)
+    stats["updated"] += len(changed)
+    todo = new_skus + changed
+    if dry_run:
+        for sku in todo:
+            sku_map[sku] = dict(by_sku[sku], id=sku_map.get(sku, {}).get("id"))
+        return
+    if not todo:
+        return
+
+    con.executemany(
+        """INSERT INTO inventory(name, sku, stock, min_stock, price, is_labor, cost_price, repasse_value)
+           VALUES(?,?,0,?,?,0,?,0)
+           ON CONFLICT(sku) DO UPDATE SET
+               name = excluded.name, min_stock = excluded.min_stock, price = excluded.price,
+               cost_price = excluded.cost_price""",
+        [(by_sku[sku]["name"], sku, by_sku[sku]["min_stock"], by_sku[sku]["price"], by_sku[sku]["cost_price"]) for sku in todo],
+    )
+    if new_skus:
+        qmarks = ",".join("?" * len(new_skus))
+        for r in con.execute(f"SELECT sku, id FROM inventory WHERE sku IN ({qmarks})", new_skus):
+            sku_map[r[0]] = {"id": int(r[1]), "stock": 0.0}
+
+    moves = []
+    for sku in todo:
+        it = by_sku[sku]
+        cur = sku_map[sku]
+        moves.append((cur["id"], float(it["stock"]) - cur["stock"]))
+        sku_map[sku] = dict(it, id=cur["id"], stock=float(it["stock"]))
+    ledger.record_movements(con, moves, ledger.IMPORTACAO)
+
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    con.executemany(
+        """INSERT INTO inventory_import_hashes(sku, hash, imported_at) VALUES (?,?,?)
+           ON CONFLICT(sku) DO UPDATE SET hash = excluded.hash, imported_at = excluded.imported_at""",
+        [(sku, by_sku[sku]["hash"], now) for sku in todo],
+    )
+
+
+def import_rows(con, rows, chunk_size: int = CHUNK_SIZE, progress=None, dry_run: bool = False) -> dict:
+    """Importa linhas do CSV (dicts do DictReader) em lotes, numa transação só (sem commit).
+    Linhas iguais à última importação (mesmo hash) não são regravadas.
+    progress(stats) é chamado a cada lote. Retorna inserted/updated/unchanged/skipped/rows/errors/changes.
+    """
+    con.executescript(IMPORT_SCHEMA_SQL)
+    sku_map = load_sku_map(con)
+    stats = {"rows": 0, "inserted": 0, "updated": 0, "unchanged": 0, "repeated": 0, "skipped": 0,
+             "errors": [], "changes": [], "taken": set(sku_map)}
+    chunk = []
+    for line_no, row in enumerate(rows, start=2):  # linha 1 = cabeçalho
+        stats["rows"] += 1
+        try:
+            it = parse_row(row)
+        except Exception as e:
+            stats["skipped"] += 1
+            stats["errors"].append((line_no, str(e)))
+            continue
+        if it is None:
+            stats["skipped"] += 1
+            continue
+        chunk.append(it)
+        if len(chunk) >= chunk_size:
+            write_chunk(con, chunk, sku_map, stats, dry_run)
+            chunk = []
+            if progress:
+                progress(stats)
+    if chunk:
+        write_chunk(con, chunk, sku_map, stats, dry_run)
+    if progress:
+        progress(stats)
+    stats.pop("taken", None)
+    return stats
+
+
 def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    dry_run = "--dry-run" in sys.argv[1:]
     ensure_db_exists()
-    csv_path = pick_csv_path()
+    csv_path = pick_csv_path(args)
 
     # lê um pedacinho para detectar separador
     with open(csv_path, 'r', encoding='utf-8-sig', errors='ignore') as f:
@@ -161,57 +359,38 @@ def main():
         delim = detect_delimiter(sample)
 
     con = sqlite3.connect(DB_PATH)
-    con.row_factory = sqlite3.Row
-    cur = con.cursor()
-
-    inserted = 0
-    updated = 0
+    ledger.ensure_schema(con)
 
+    t0 = time.perf_counter()
     with open(csv_path, 'r', encoding='utf-8-sig', errors='ignore', newline='') as f:
         reader = csv.DictReader(f, delimiter=delim)
 
         if not reader.fieldnames:
             raise SystemExit("❌ CSV sem cabeçalho. Use o estoque_modelo.csv como base.")
 
-        for row in reader:
-            sku = str(get(row, 'sku', 'código', 'codigo', 'cod', 'ref')).strip()
-            name = str(get(row, 'name', 'descrição', 'descricao', 'produto', 'descrição do produto')).strip()
-            stock = to_int(get(row, 'stock', 'qtd', 'quantidade'))
-            cost_price = to_float(get(row, 'cost_price', 'custo', 'unit.(r$)', 'unit', 'unitario', 'unitário'))
-            price = to_float(get(row, 'price', 'preço', 'preco', 'valor', 'vl. item(r$)', 'vl item'))
-
-            min_stock = to_int(get(row, 'min_stock', 'estoque mínimo', 'estoque minimo', 'minimo', 'mínimo'))
-
-            if price == 0 and cost_price != 0:
-                price = cost_price
-
-            if not name:
-                name = f"Item {sku}" if sku else "Item"
-
-            cur.execute("SELECT id FROM inventory WHERE sku = ?", ((sku or '').strip(),))
-            existing = cur.fetchone()
-
-            if existing:
-                cur.execute(
-                    """UPDATE inventory
-                       SET name = ?, stock = ?, min_stock = ?, price = ?, cost_price = ?, is_labor = 0, repasse_value = 0
-                       WHERE id = ?""",
-                    (name.strip(), stock, min_stock, price, cost_price, existing['id'])
-                )
-                updated += 1
-            else:
-                sku_final = unique_sku(cur, sku)
-                cur.execute(
-                    """INSERT INTO inventory(name, sku, stock, min_stock, price, is_labor, cost_price, repasse_value)
-                       VALUES(?,?,?,?,?,0,?,0)""",
-                    (name.strip(), sku_final, stock, min_stock, price, cost_price)
-                )
-                inserted += 1
-
-    con.commit()
-    con.close()
+        stats = import_rows(con, reader, dry_run=dry_run)
 
-    print(f"✅ Importação concluída! Inseridos: {inserted} | Atualizados: {updated}")
+    if dry_run:
+        con.rollback()
+    else:
+        con.commit()
+    con.close()
+    secs = max(time.perf_counter() - t0, 1e-6)
+
+    if dry_run:
+        print("🔎 Simulação (--dry-run): nada foi gravado.")
+        for sku, diff in stats["changes"]:
+            print(f"  ~ {sku}: " + ", ".join(f"{k} {old} -> {new}" for k, (old, new) in diff.items()))
+        if stats["updated"] > len(stats["changes"]):
+            print(f"  ... e mais {stats['updated'] - len(stats['changes'])} alterados")
+    print(
+        f"{'🔎' if dry_run else '✅'} Importação {'simulada' if dry_run else 'concluída'}! "
+        f"Novos: {stats['inserted']} | Alterados: {stats['updated']} | Sem mudança: {stats['unchanged']}"
+        f" | Ignorados: {stats['skipped']} | SKU repetido: {stats['repeated']}"
+    )
+    print(f"Linhas: {stats['rows']} em {secs:.2f}s ({stats['rows'] / secs:.0f} linhas/s)")
+    for line_no, msg in stats["errors"][:20]:
+        print(f"⚠️ Linha {line_no}: {msg}")
     print("Arquivo usado:", os.path.basename(csv_path))
 
 
@@ -0,0 +1,157 @@
+"""Livro de movimentos de estoque do FCAR (somente inserção).
+
+Toda mudança em inventory.stock passa por aqui e vira uma linha em
+stock_movements (item, delta, motivo, documento). O saldo atual continua em
+inventory.stock (leitura O(1)); o saldo numa data passada é o último
+checkpoint do item + a soma dos poucos movimentos depois dele.
+
+Usado pelo app.py e pelos scripts (importar_estoque_csv.py, zerar_estoque.py,
+import_migracao_pdfs.py), por isso não depende do Flask. O custo de cada movimento fica em custo_estoque.py.
+"""
+
+import datetime
+
+import custo_estoque as custo
+
+# motivos
+ABERTURA = "ABERTURA"        # saldo que já existia quando o livro foi criado
+CADASTRO = "CADASTRO"        # item novo com estoque inicial
+AJUSTE = "AJUSTE"            # edição manual do estoque
+OS = "OS"                    # baixa/devolução por OS fechada/reaberta
+OS_EXCLUIDA = "OS_EXCLUIDA"  # devolução ao excluir OS
+COMPRA = "COMPRA"            # entrada/estorno de compra
+IMPORTACAO = "IMPORTACAO"    # importação de CSV
+ZERAR = "ZERAR"              # zerar_estoque.py
+MIGRACAO = "MIGRACAO"        # import_migracao_pdfs.py (Estoque.pdf)
+
+SCHEMA_SQL = r"""
+CREATE TABLE IF NOT EXISTS stock_movements(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    inventory_id INTEGER NOT NULL,
+    qty_delta REAL NOT NULL,
+    reason TEXT NOT NULL,
+    ref_type TEXT,                       -- OS/PURCHASE/...
+    ref_id INTEGER,
+    created_at TEXT NOT NULL             -- YYYY-MM-DDTHH:MM:SS
+);
+CREATE INDEX IF NOT EXISTS idx_stock_mov_item ON stock_movements(inventory_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_stock_mov_ref ON stock_movements(ref_type, ref_id);
+-- extrato do período (financeiro_estoque): cobre as colunas lidas, sem ir à tabela a cada linha
+CREATE INDEX IF NOT EXISTS idx_stock_mov_time
+    ON stock_movements(created_at, inventory_id, qty_delta, ref_type, ref_id, reason);
+
+CREATE TABLE IF NOT EXISTS stock_checkpoints(
+    inventory_id INTEGER NOT NULL,
+    movement_id INTEGER NOT NULL,        -- último movimento incluído no saldo
+    at TEXT NOT NULL,
+    balance REAL NOT NULL,
+    PRIMARY KEY(inventory_id, movement_id)
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_stock_movements_no_update
+BEFORE UPDATE ON stock_movements
+BEGIN
+    SELECT RAISE(ABORT, 'stock_movements é somente inserção');
+END;
+CREATE TRIGGER IF NOT EXISTS trg_stock_movements_no_delete
+BEFORE DELETE ON stock_movements
+BEGIN
+    SELECT RAISE(ABORT, 'stock_movements é somente inserção');
+END;
+"""
+
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+def ensure_schema(con) -> None:
+    """Cria as tabelas do livro e, na primeira vez, lança o saldo de abertura de cada item."""
+    con.executescript(SCHEMA_SQL)
+    if con.execute("SELECT 1 FROM stock_movements LIMIT 1").fetchone() is None:
+        now = _now()
+        con.execute(
+            """
+            INSERT INTO stock_movements(inventory_id, qty_delta, reason, ref_type, ref_id, created_at)
+            SELECT id, stock, ?, NULL, NULL, ? FROM inventory WHERE stock <> 0
+            """,
+            (ABERTURA, now),
+        )
+        take_checkpoints(con, now)
+    con.commit()
+    custo.ensure_schema(con)
+
+
+def record_movements(con, moves, reason: str, ref_type=None, ref_id=None) -> None:
+    """Aplica vários deltas de uma vez: moves = [(inventory_id, delta), ...].
+    Atualiza inventory.stock, grava o movimento e custeia (camadas) na mesma transação (sem commit).
+    Compras são custeadas à parte por custo.apply_purchase, que conhece o custo unitário.
+    """
+    rows = [(int(inv_id), float(delta)) for inv_id, delta in moves if abs(float(delta)) > 1e-9]
+    if not rows:
+        return
+    now = _now()
+    con.executemany("UPDATE inventory SET stock = stock + ? WHERE id = ?", [(d, i) for i, d in rows])
+    con.executemany(
+        """
+        INSERT INTO stock_movements(inventory_id, qty_delta, reason, ref_type, ref_id, created_at)
+        VALUES (?,?,?,?,?,?)
+        """,
+        [(i, d, reason, ref_type, ref_id, now) for i, d in rows],
+    )
+    if reason != COMPRA:
+        custo.apply_deltas(con, rows, reason, ref_type, ref_id)
+
+
+def record_movement(con, inventory_id: int, delta: float, reason: str, ref_type=None, ref_id=None) -> None:
+    record_movements(con, [(inventory_id, delta)], reason, ref_type, ref_id)
+
+
+def set_stock(con, inventory_id: int, new_stock: float, reason: str, ref_type=None, ref_id=None) -> float:
+    """Leva o estoque a um valor absoluto (edição manual/importação) gravando o delta."""
+    row = con.execute("SELECT stock FROM inventory WHERE id = ?", (inventory_id,)).fetchone()
+    if row is None:
+        return 0.0
+    delta = float(new_stock or 0) - float(row[0] or 0)
+    record_movement(con, inventory_id, delta, reason, ref_type, ref_id)
+    return delta
+
+
+def take_checkpoints(con, at: str | None = None) -> int:
+    """Grava o saldo atual de cada item que teve movimento desde o último checkpoint.
+    Rodar periodicamente (flask estoque-checkpoint) mantém curto o replay de stock_at().
+    """
+    at = at or _now()
+    cur = con.execute(
+        """
+        INSERT OR IGNORE INTO stock_checkpoints(inventory_id, movement_id, at, balance)
+        SELECT i.id, m.last_id, ?, i.stock
+          FROM inventory i
+          JOIN (SELECT inventory_id, MAX(id) AS last_id FROM stock_movements GROUP BY inventory_id) m
+            ON m.inventory_id = i.id
+         WHERE m.last_id > COALESCE((SELECT MAX(c.movement_id) FROM stock_checkpoints c WHERE c.inventory_id = i.id), 0)
+        """,
+        (at,),
+    )
+    return cur.rowcount
+
+
+def stock_at(con, inventory_id: int, at: str) -> float:
+    """Saldo do item no instante `at` (ISO): checkpoint mais recente + replay curto."""
+    cp = con.execute(
+        """
+        SELECT movement_id, balance FROM stock_checkpoints
+         WHERE inventory_id = ? AND at <= ?
+         ORDER BY movement_id DESC LIMIT 1
+        """,
+        (inventory_id, at),
+    ).fetchone()
+    base_id, base = (int(cp[0]), float(cp[1])) if cp else (0, 0.0)
+    r = con.execute(
+        """
+        SELECT COALESCE(SUM(qty_delta), 0) FROM stock_movements
+         WHERE inventory_id = ? AND id > ? AND created_at <= ?
+        """,
+        (inventory_id, base_id, at),
+    ).fetchone()
+    return base + float(r[0] or 0)
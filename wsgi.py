@@ -1,6 +1,9 @@
 # Gunicorn entrypoint: gunicorn wsgi:app
-from app import app, init_db
+from app import app, init_db, start_fin_outbox_worker
 
 # Garante que o banco exista e tenha as tabelas/colunas necessárias.
 with app.app_context():
     init_db()
+
+# Worker do outbox (OS -> Financeiro) roda em segundo plano em cada processo.
+start_fin_outbox_worker()
@@ -1,13 +1,18 @@
 import sqlite3
 import os
 
+import movimentos_estoque as ledger
+
 DB_PATH = os.path.join(os.path.dirname(__file__), "oficina.db")
 
 if not os.path.exists(DB_PATH):
     raise SystemExit("❌ Não achei o 'oficina.db'. Abra o FCAR pelo menos 1 vez pra ele criar o banco.")
 
 con = sqlite3.connect(DB_PATH)
+ledger.ensure_schema(con)
 cur = con.cursor()
+# registra a saída do saldo de cada item no livro antes de apagar o cadastro
+ledger.record_movements(con, cur.execute("SELECT id, -stock FROM inventory WHERE stock <> 0").fetchall(), ledger.ZERAR)
 cur.execute("DELETE FROM inventory;")
 con.commit()
 con.close()